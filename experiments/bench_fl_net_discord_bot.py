@@ -0,0 +1,157 @@
+import os
+import statistics
+import time
+
+import fl.net.discord.bot
+
+
+COUNT_MSG = 2000
+SECS_TIMEOUT = 30.0
+
+
+# -----------------------------------------------------------------------------
+def _echo_bot(cfg_bot, queue_to_bot, queue_from_bot):
+    """
+    Stand-in for _discord_bot which echoes items back to the system.
+
+    discord.py is imported (if available) so
+    that the memory footprint includes the
+    client library, but no connection to
+    discord is made. This isolates the cost
+    of the process or thread transport.
+
+    """
+
+    try:
+        import discord  # pylint: disable=W0611
+    except ImportError:
+        pass
+
+    queue_from_bot.put(
+        dict(type="log_metric", pid=os.getpid(), rss=fl.net.discord.bot.rss_bytes())
+    )
+    while True:
+        item = queue_to_bot.get()
+        queue_from_bot.put(item)
+
+
+# -----------------------------------------------------------------------------
+def _wait_for_items(bot, count, list_to_bot=None):
+    """
+    Step the bot coroutine until count items have been received.
+
+    """
+
+    list_item = list()
+    list_send = list(list_to_bot or ())
+    time_deadline = time.perf_counter() + SECS_TIMEOUT
+    while len(list_item) < count:
+        if time.perf_counter() > time_deadline:
+            raise RuntimeError("Timed out waiting for the bot.")
+        list_item.extend(bot.send(list_send))
+        list_send = list()
+
+        # Yield the GIL between steps, as the
+        # host control loop would, so that the
+        # client thread is not starved in
+        # thread mode.
+        #
+        time.sleep(0)
+    return list_item
+
+
+# -----------------------------------------------------------------------------
+def _measure(str_mode):
+    """
+    Return startup time, RSS and message latency for the specified mode.
+
+    """
+
+    cfg_bot = dict(
+        str_token="benchmark",
+        secs_sleep=0.001,
+        id_system=None,
+        id_node=None,
+        mode=str_mode,
+    )
+
+    time_start = time.perf_counter()
+    bot = fl.net.discord.bot.coro(cfg_bot)
+    next(bot)
+    (item_ready,) = _wait_for_items(bot, 1)
+    secs_startup = time.perf_counter() - time_start
+
+    rss_host = fl.net.discord.bot.rss_bytes()
+    if item_ready["pid"] == os.getpid():
+        rss_total = rss_host
+    else:
+        rss_total = rss_host + item_ready["rss"]
+
+    list_secs = list()
+    for idx in range(COUNT_MSG):
+        item = dict(type="msg_dm", id_user=idx, content="x" * 200)
+        time_send = time.perf_counter()
+        _wait_for_items(bot, 1, list_to_bot=[item])
+        list_secs.append(time.perf_counter() - time_send)
+
+    time_burst = time.perf_counter()
+    _wait_for_items(
+        bot,
+        COUNT_MSG,
+        list_to_bot=[dict(type="msg_dm", id_user=idx) for idx in range(COUNT_MSG)],
+    )
+    secs_burst = time.perf_counter() - time_burst
+
+    bot.close()
+    return dict(
+        mode=str_mode,
+        secs_startup=secs_startup,
+        mib_rss=rss_total / (1024 * 1024),
+        usecs_p50=1e6 * statistics.median(list_secs),
+        usecs_p99=1e6 * statistics.quantiles(list_secs, n=100)[98],
+        msg_per_sec=COUNT_MSG / secs_burst,
+    )
+
+
+# -----------------------------------------------------------------------------
+def main():
+    """
+    Compare the process and thread modes of fl.net.discord.bot.coro.
+
+    Each mode is run with a stand-in for the
+    discord client, so the figures measure
+    startup, memory and latency of the
+    transport between the system and the
+    client rather than of discord itself.
+
+    """
+
+    fl.net.discord.bot._discord_bot = _echo_bot
+
+    str_fmt = "{mode:<8} {start:>10} {rss:>10} {p50:>10} {p99:>10} {rate:>10}"
+    print(
+        str_fmt.format(
+            mode="mode",
+            start="startup s",
+            rss="RSS MiB",
+            p50="p50 us",
+            p99="p99 us",
+            rate="msg/s",
+        )
+    )
+    for str_mode in ("process", "thread"):
+        result = _measure(str_mode)
+        print(
+            str_fmt.format(
+                mode=result["mode"],
+                start="{:.3f}".format(result["secs_startup"]),
+                rss="{:.1f}".format(result["mib_rss"]),
+                p50="{:.0f}".format(result["usecs_p50"]),
+                p99="{:.0f}".format(result["usecs_p99"]),
+                rate="{:.0f}".format(result["msg_per_sec"]),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import multiprocessing.reduction
+import pickle
+import timeit
+
+import fl.net.ipc
+
+
+COUNT_ITER = 20000
+COUNT_REPEAT = 5
+
+
+# -----------------------------------------------------------------------------
+def _sample_items():
+    """
+    Return a list of representative items that cross the IPC queues.
+
+    """
+
+    return [
+        dict(
+            type="msg_guild",
+            id_prev=None,
+            id_msg=1133468915722616893,
+            id_author=1101530813427544074,
+            name_author="participant_01",
+            id_channel=1101531220316676117,
+            name_channel="deliberation",
+            content="I think we should prioritise the community garden.",
+        ),
+        dict(
+            type="msg_dm",
+            id_msg=1133468915722616894,
+            id_author=1101530813427544074,
+            name_author="participant_01",
+            content="Adding to my earlier point about the garden.",
+        ),
+        dict(
+            type="btn",
+            id_btn="submit_3fa2c1",
+            id_user=1101530813427544074,
+            name_user="participant_01",
+            id_channel=1133468915722616000,
+        ),
+        dict(
+            type="appcmd_guild",
+            id_guild=1101530813427544000,
+            name_guild="harmonica",
+            name_channel="general",
+            nick_user=None,
+            name_command="ask",
+            id_channel=1101531220316676117,
+            id_user=1101530813427544074,
+            name_user="admin_01",
+            args=("What should we do with the vacant lot?",),
+        ),
+        dict(
+            type="msg_dm",
+            id_user=1101530813427544074,
+            content="participant_01 joined session 3fa2c1 as participant #4.",
+        ),
+    ]
+
+
+# -----------------------------------------------------------------------------
+def _pickle_serialize(item):
+    """
+    Serialize and deserialize a plain item dict as multiprocessing does.
+
+    """
+
+    return pickle.loads(multiprocessing.reduction.ForkingPickler.dumps(item))
+
+
+# -----------------------------------------------------------------------------
+def _codec_serialize(item):
+    """
+    Encode and decode an item dict with fl.net.ipc.
+
+    """
+
+    return fl.net.ipc.decode(fl.net.ipc.encode(item))
+
+
+# -----------------------------------------------------------------------------
+def _codec_hop(item):
+    """
+    Emulate a multiprocessing.Queue hop for an fl.net.ipc.EncodedQueue.
+
+    The encoded bytes are pickled again by
+    the queue, so this is the end to end
+    cost of enabling the codec on an
+    existing multiprocessing.Queue.
+
+    """
+
+    data = multiprocessing.reduction.ForkingPickler.dumps(fl.net.ipc.encode(item))
+    return fl.net.ipc.decode(pickle.loads(data))
+
+
+# -----------------------------------------------------------------------------
+def _usecs_per_call(fcn):
+    """
+    Return the best observed time per call to fcn in microseconds.
+
+    """
+
+    list_secs = timeit.repeat(fcn, number=COUNT_ITER, repeat=COUNT_REPEAT)
+    return 1e6 * min(list_secs) / COUNT_ITER
+
+
+# -----------------------------------------------------------------------------
+def main():
+    """
+    Compare bytes per message and serialization time for pickle and fl.net.ipc.
+
+    Columns are the serialized size with
+    pickle and with the codec, the time to
+    serialize and deserialize with pickle
+    and with the codec, and the time for a
+    full queue hop with the codec (pickle
+    of the encoded bytes included).
+
+    """
+
+    str_fmt = "{type:<14} {bp:>8} {bc:>8} {tp:>10} {tc:>10} {th:>10}"
+    print(
+        str_fmt.format(
+            type="type",
+            bp="B pickle",
+            bc="B codec",
+            tp="us pickle",
+            tc="us codec",
+            th="us hop",
+        )
+    )
+    for item in _sample_items():
+        assert _codec_hop(item) == item
+        print(
+            str_fmt.format(
+                type=item["type"],
+                bp=len(multiprocessing.reduction.ForkingPickler.dumps(item)),
+                bc=len(fl.net.ipc.encode(item)),
+                tp="{:.2f}".format(_usecs_per_call(lambda: _pickle_serialize(item))),
+                tc="{:.2f}".format(_usecs_per_call(lambda: _codec_serialize(item))),
+                th="{:.2f}".format(_usecs_per_call(lambda: _codec_hop(item))),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1050 @@
+import asyncio
+import json
+import logging
+import random
+import socket
+import threading
+import time
+
+import aiohttp.web
+
+import fl.net.openai.client
+
+
+COUNT_REQUEST = 32
+SECS_LATENCY = 0.25
+COUNT_RPM = 1200
+RATIO_503 = 0.3
+SECS_OUTAGE = 1.0
+COUNT_TOKEN_SUMMARY = 60
+SECS_TOKEN = 0.03
+SECS_TIMEOUT = 60.0
+
+
+# =============================================================================
+class MockOpenAi:
+    """
+    Local stand-in for the OpenAI chat completions API.
+
+    Each request is answered after a fixed
+    latency, so that the figures measure how
+    well the client overlaps requests rather
+    than the speed of the model.
+
+    If count_rpm is set, requests are limited
+    by a token bucket which holds one second
+    of capacity and is continuously refilled,
+    and requests beyond the limit are
+    rejected with a 429, as OpenAI does.
+
+    A random ratio_503 of requests, and all
+    requests until time_outage_end, fail
+    with a 503 to emulate a degraded API.
+
+    If secs_token is set, chat completions
+    are generated one token at a time and
+    can be streamed.
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, secs_latency=SECS_LATENCY, count_rpm=None):
+        """
+        Construct the mock server.
+
+        """
+
+        self.secs_latency = secs_latency
+        self.count_rpm = count_rpm
+        self.level = None if count_rpm is None else count_rpm / 60
+        self.time_update = time.monotonic()
+        self.port = None
+        self.ratio_503 = 0.0
+        self.secs_token = None
+        self.time_outage_end = 0.0
+        self.count_429 = 0
+        self.count_503 = 0
+        self.count_request = 0
+        self.count_in_flight = 0
+        self.count_in_flight_max = 0
+        self._event_started = threading.Event()
+
+    # -------------------------------------------------------------------------
+    @property
+    def api_base(self):
+        """
+        Return the base URL for the API.
+
+        """
+
+        return "http://127.0.0.1:{port}/v1".format(port=self.port)
+
+    # -------------------------------------------------------------------------
+    def start(self):
+        """
+        Start the server in a daemon thread and wait until it is serving.
+
+        """
+
+        threading.Thread(target=self._run, name="mock-openai", daemon=True).start()
+        self._event_started.wait()
+        return self
+
+    # -------------------------------------------------------------------------
+    def _run(self):
+        """
+        Run the server event loop. This is the thread entry point.
+
+        """
+
+        asyncio.run(self._serve())
+
+    # -------------------------------------------------------------------------
+    async def _serve(self):
+        """
+        Serve the API forever.
+
+        """
+
+        app = aiohttp.web.Application()
+        app.router.add_post("/v1/chat/completions", self._handle_chat_completions)
+        app.router.add_post("/v1/embeddings", self._handle_embeddings)
+        runner = aiohttp.web.AppRunner(app, access_log=None)
+        await runner.setup()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        self.port = sock.getsockname()[1]
+        await aiohttp.web.SockSite(runner, sock).start()
+        self._event_started.set()
+        await asyncio.Event().wait()
+
+    # -------------------------------------------------------------------------
+    async def _handle_chat_completions(self, request):
+        """
+        POST /v1/chat/completions
+
+        """
+
+        body = await request.json()
+        if random.random() < self.ratio_503 or time.monotonic() < self.time_outage_end:
+            self.count_503 += 1
+            return aiohttp.web.json_response(
+                dict(error=dict(message="The server is overloaded.", type="server")),
+                status=503,
+            )
+
+        if self.count_rpm is not None:
+            time_now = time.monotonic()
+            rate = self.count_rpm / 60
+            self.level = min(rate, self.level + rate * (time_now - self.time_update))
+            self.time_update = time_now
+            if self.level < 1.0:
+                self.count_429 += 1
+                return aiohttp.web.json_response(
+                    dict(
+                        error=dict(
+                            message="Rate limit reached for requests.",
+                            type="requests",
+                            code="rate_limit_exceeded",
+                        )
+                    ),
+                    status=429,
+                )
+            self.level -= 1.0
+
+        self.count_request += 1
+        if self.secs_token is not None:
+            return await self._generate(request, body)
+
+        self.count_in_flight += 1
+        self.count_in_flight_max = max(self.count_in_flight_max, self.count_in_flight)
+        try:
+            await asyncio.sleep(self.secs_latency)
+        finally:
+            self.count_in_flight -= 1
+
+        return aiohttp.web.json_response(
+            dict(
+                id="chatcmpl-mock",
+                object="chat.completion",
+                created=int(time.time()),
+                model=body["model"],
+                choices=[
+                    dict(
+                        index=0,
+                        message=dict(role="assistant", content="Summary."),
+                        finish_reason="stop",
+                    )
+                ],
+                usage=dict(prompt_tokens=10, completion_tokens=2, total_tokens=12),
+            )
+        )
+
+    # -------------------------------------------------------------------------
+    async def _generate(self, request, body):
+        """
+        Answer a chat completion token by token, streamed if requested.
+
+        """
+
+        list_token = list(
+            "word{idx} ".format(idx=idx) for idx in range(COUNT_TOKEN_SUMMARY)
+        )
+        map_chunk = dict(
+            id="chatcmpl-mock",
+            object="chat.completion.chunk",
+            created=int(time.time()),
+            model=body["model"],
+        )
+
+        if not body.get("stream", False):
+            await asyncio.sleep(self.secs_latency + self.secs_token * len(list_token))
+            return aiohttp.web.json_response(
+                dict(
+                    map_chunk,
+                    object="chat.completion",
+                    choices=[
+                        dict(
+                            index=0,
+                            message=dict(role="assistant", content="".join(list_token)),
+                            finish_reason="stop",
+                        )
+                    ],
+                )
+            )
+
+        response = aiohttp.web.StreamResponse(
+            headers={"Content-Type": "text/event-stream"}
+        )
+        await response.prepare(request)
+        await asyncio.sleep(self.secs_latency)
+        for idx, token in enumerate(list_token):
+            is_last = idx == len(list_token) - 1
+            chunk = dict(
+                map_chunk,
+                choices=[
+                    dict(
+                        index=0,
+                        delta=dict(content=token),
+                        finish_reason="stop" if is_last else None,
+                    )
+                ],
+            )
+            await response.write(
+                "data: {chunk}\n\n".format(chunk=json.dumps(chunk)).encode()
+            )
+            await asyncio.sleep(self.secs_token)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    # -------------------------------------------------------------------------
+    async def _handle_embeddings(self, request):
+        """
+        POST /v1/embeddings
+
+        The embedding of each input is its
+        length, so that results can be
+        matched back to their inputs.
+
+        """
+
+        body = await request.json()
+        list_input = body["input"]
+        if isinstance(list_input, str):
+            list_input = [list_input]
+
+        self.count_request += 1
+        await asyncio.sleep(self.secs_latency)
+        return aiohttp.web.json_response(
+            dict(
+                object="list",
+                model=body["model"],
+                data=[
+                    dict(object="embedding", index=idx, embedding=[float(len(text))])
+                    for (idx, text) in enumerate(list_input)
+                ],
+                usage=dict(prompt_tokens=len(list_input), total_tokens=len(list_input)),
+            )
+        )
+
+
+# -----------------------------------------------------------------------------
+def _cfg(api_base, **kwargs):
+    """
+    Return request handler configuration for the mock server.
+
+    """
+
+    cfg = dict(
+        api_key="benchmark",
+        api_base=api_base,
+        secs_interval=0.001,
+        is_bit=False,
+        is_async=True,
+        default=dict(id_endpoint="chat_completions", model="gpt-3.5-turbo"),
+        id_system=None,
+        id_node=None,
+        level_log=logging.WARNING,
+    )
+    cfg.update(kwargs)
+    return cfg
+
+
+# -----------------------------------------------------------------------------
+def _run_requests(cfg, list_request):
+    """
+    Send list_request through a request handler and wait for every result.
+
+    Return the elapsed time and the list of
+    results in the order they were received.
+
+    """
+
+    request_handler = fl.net.openai.client.coro_request_handler(cfg=cfg)
+    list_result = list()
+    list_send = list(list_request)
+    time_start = time.perf_counter()
+    time_deadline = time_start + SECS_TIMEOUT
+    while len(list_result) < len(list_request):
+        if time.perf_counter() > time_deadline:
+            raise RuntimeError("Timed out waiting for results.")
+        for item in request_handler.send((list_send, 0)):
+            if item.get("type", None) == "openai_result":
+                list_result.append(item)
+        list_send = list()
+        time.sleep(0.001)
+    return (time.perf_counter() - time_start, list_result)
+
+
+# -----------------------------------------------------------------------------
+def main():
+    """
+    Measure request daemon throughput for different levels of parallelism.
+
+    Every request takes SECS_LATENCY to answer,
+    so with count_parallel=1 throughput is
+    bounded by 1 / SECS_LATENCY.
+
+    """
+
+    _measure_parallelism()
+    print()
+    _measure_rate_limit()
+    print()
+    _measure_retry()
+    print()
+    _measure_circuit_breaker()
+    print()
+    _measure_cache()
+    print()
+    _measure_embedding_batch()
+    print()
+    _measure_stream()
+    print()
+    _measure_template()
+    print()
+    _measure_validation()
+    print()
+    _measure_workflow_routing()
+    print()
+    _measure_workflow_spinup()
+    print()
+    _measure_workflow_pool()
+    print()
+    _measure_priority()
+    print()
+    _measure_single_flight()
+
+
+# -----------------------------------------------------------------------------
+def _measure_parallelism():
+    """
+    Print request throughput for different levels of parallelism.
+
+    """
+
+    mock = MockOpenAi().start()
+    list_request = list(
+        dict(
+            messages=[dict(role="user", content="Summarise {idx}.".format(idx=idx))],
+            state=dict(idx=idx),
+        )
+        for idx in range(COUNT_REQUEST)
+    )
+
+    str_fmt = "{par:>8} {secs:>10} {rate:>10} {peak:>10}"
+    print(str_fmt.format(par="parallel", secs="secs", rate="req/s", peak="peak"))
+    for count_parallel in (1, 4, 16):
+        mock.count_in_flight_max = 0
+        (secs, list_result) = _run_requests(
+            _cfg(mock.api_base, count_parallel=count_parallel), list_request
+        )
+        assert sorted(r["state"]["idx"] for r in list_result) == list(
+            range(COUNT_REQUEST)
+        )
+        print(
+            str_fmt.format(
+                par=count_parallel,
+                secs="{:.2f}".format(secs),
+                rate="{:.1f}".format(COUNT_REQUEST / secs),
+                peak=mock.count_in_flight_max,
+            )
+        )
+
+
+# -----------------------------------------------------------------------------
+def _measure_rate_limit():
+    """
+    Print 429 counts and throughput with and without the rate limiter.
+
+    The mock server allows COUNT_RPM requests
+    per minute (enforced per second), and the
+    client runs 16 requests in parallel.
+
+    """
+
+    mock = MockOpenAi(secs_latency=0.05, count_rpm=COUNT_RPM).start()
+    list_request = list(
+        dict(
+            messages=[dict(role="user", content="Summarise {idx}.".format(idx=idx))],
+            state=dict(idx=idx),
+        )
+        for idx in range(COUNT_REQUEST * 2)
+    )
+
+    str_fmt = "{limit:>8} {secs:>10} {ok:>10} {err:>10}"
+    print(str_fmt.format(limit="limiter", secs="secs", ok="ok", err="429"))
+    for is_limited in (False, True):
+        mock.count_429 = 0
+        mock.level = COUNT_RPM / 60
+        rate_limit = dict(default=dict(rpm=COUNT_RPM)) if is_limited else None
+        (secs, list_result) = _run_requests(
+            _cfg(mock.api_base, count_parallel=16, rate_limit=rate_limit),
+            list_request,
+        )
+        print(
+            str_fmt.format(
+                limit="on" if is_limited else "off",
+                secs="{:.2f}".format(secs),
+                ok=sum(1 for r in list_result if r["error"] is None),
+                err=mock.count_429,
+            )
+        )
+
+
+# -----------------------------------------------------------------------------
+def _measure_retry():
+    """
+    Print results delivered with and without retries when some requests fail.
+
+    The mock server fails RATIO_503 of
+    requests with a 503. Without retries
+    each of those loses its result.
+
+    """
+
+    mock = MockOpenAi(secs_latency=0.05).start()
+    mock.ratio_503 = RATIO_503
+    list_request = list(
+        dict(
+            messages=[dict(role="user", content="Summarise {idx}.".format(idx=idx))],
+            state=dict(idx=idx),
+        )
+        for idx in range(COUNT_REQUEST * 2)
+    )
+
+    map_retry = dict(
+        ServiceUnavailableError=dict(count_retry=5, secs_base=0.05, secs_max=1.0)
+    )
+    str_fmt = "{retry:>8} {secs:>10} {ok:>10} {err:>10}"
+    print(str_fmt.format(retry="retry", secs="secs", ok="ok", err="503"))
+    for is_retry in (False, True):
+        mock.count_503 = 0
+        (secs, list_result) = _run_requests(
+            _cfg(
+                mock.api_base,
+                count_parallel=16,
+                retry=map_retry if is_retry else None,
+                circuit_breaker=None,
+            ),
+            list_request,
+        )
+        print(
+            str_fmt.format(
+                retry="on" if is_retry else "off",
+                secs="{:.2f}".format(secs),
+                ok=sum(1 for r in list_result if r["error"] is None),
+                err=mock.count_503,
+            )
+        )
+
+
+# -----------------------------------------------------------------------------
+def _measure_circuit_breaker():
+    """
+    Print API calls made during an outage with and without the breaker.
+
+    Every request fails for SECS_OUTAGE.
+    Requests are submitted for the length
+    of the outage and then for as long
+    again, with retries enabled.
+
+    """
+
+    mock = MockOpenAi(secs_latency=0.05).start()
+    map_retry = dict(
+        ServiceUnavailableError=dict(count_retry=3, secs_base=0.05, secs_max=0.2)
+    )
+
+    str_fmt = "{breaker:>8} {calls:>10} {ok:>10} {fast:>10}"
+    print(str_fmt.format(breaker="breaker", calls="calls", ok="ok", fast="rejected"))
+    for is_breaker in (False, True):
+        request_handler = fl.net.openai.client.coro_request_handler(
+            cfg=_cfg(
+                mock.api_base,
+                count_parallel=16,
+                retry=map_retry,
+                circuit_breaker=(
+                    dict(count_failure=5, secs_reset=0.5) if is_breaker else None
+                ),
+            )
+        )
+        mock.count_request = 0
+        mock.count_503 = 0
+        mock.time_outage_end = time.monotonic() + SECS_OUTAGE
+        time_end = mock.time_outage_end + SECS_OUTAGE
+        list_result = list()
+        count_sent = 0
+        while count_sent > len(list_result) or time.monotonic() < time_end:
+            list_send = list()
+            if time.monotonic() < time_end:
+                list_send.append(
+                    dict(
+                        messages=[dict(role="user", content="Summarise.")],
+                        state=dict(idx=count_sent),
+                    )
+                )
+                count_sent += 1
+            for item in request_handler.send((list_send, 0)):
+                if item.get("type", None) == "openai_result":
+                    list_result.append(item)
+            time.sleep(0.01)
+
+        print(
+            str_fmt.format(
+                breaker="on" if is_breaker else "off",
+                calls=mock.count_request + mock.count_503,
+                ok=sum(1 for r in list_result if r["error"] is None),
+                fast=sum(
+                    1
+                    for r in list_result
+                    if r["error"] == "OpenAI is unavailable. Please try again later."
+                ),
+            )
+        )
+
+
+# -----------------------------------------------------------------------------
+def _measure_cache():
+    """
+    Print API calls and elapsed time for repeated requests with the cache.
+
+    The requests cycle through 8 distinct
+    prompts at temperature 0, as a re-run
+    of the same summaries would.
+
+    """
+
+    mock = MockOpenAi(secs_latency=0.05).start()
+    list_request = list(
+        dict(
+            messages=[
+                dict(role="user", content="Summarise {idx}.".format(idx=idx % 8))
+            ],
+            temperature=0.0,
+            state=dict(idx=idx),
+        )
+        for idx in range(COUNT_REQUEST * 2)
+    )
+
+    str_fmt = "{cache:>8} {secs:>10} {calls:>10}"
+    print(str_fmt.format(cache="cache", secs="secs", calls="calls"))
+    for is_cache in (False, True):
+        mock.count_request = 0
+        cfg_cache = None
+        if is_cache:
+            cfg_cache = dict(map_endpoint=dict(chat_completions=dict()))
+        (secs, list_result) = _run_requests(
+            _cfg(mock.api_base, count_parallel=4, cache=cfg_cache), list_request
+        )
+        assert all(r["response"] is not None for r in list_result)
+        print(
+            str_fmt.format(
+                cache="on" if is_cache else "off",
+                secs="{:.2f}".format(secs),
+                calls=mock.count_request,
+            )
+        )
+
+
+# -----------------------------------------------------------------------------
+def _measure_embedding_batch():
+    """
+    Print API calls and elapsed time for embedding many transcript lines.
+
+    """
+
+    mock = MockOpenAi(secs_latency=0.05).start()
+    count_line = 2000
+    list_request = list(
+        dict(
+            id_endpoint="embeddings",
+            model="text-embedding-ada-002",
+            input="Line {idx} of the transcript.".format(idx=idx) + " x" * (idx % 7),
+            state=dict(idx=idx),
+        )
+        for idx in range(count_line)
+    )
+
+    str_fmt = "{batch:>8} {secs:>10} {calls:>10}"
+    print(str_fmt.format(batch="batch", secs="secs", calls="calls"))
+    for is_batch in (False, True):
+        mock.count_request = 0
+        (secs, list_result) = _run_requests(
+            _cfg(
+                mock.api_base,
+                count_parallel=16,
+                embedding_batch=dict() if is_batch else None,
+            ),
+            list_request,
+        )
+        for result in list_result:
+            (item,) = result["response"]["data"]
+            assert item["embedding"] == [float(len(result["request"]["input"]))]
+        print(
+            str_fmt.format(
+                batch="on" if is_batch else "off",
+                secs="{:.2f}".format(secs),
+                calls=mock.count_request,
+            )
+        )
+
+
+# -----------------------------------------------------------------------------
+def _measure_stream():
+    """
+    Print time to first visible text for a summary, with and without streaming.
+
+    The mock server generates COUNT_TOKEN_SUMMARY
+    tokens at SECS_TOKEN each. Without streaming,
+    nothing can be shown until all of them are
+    done.
+
+    """
+
+    mock = MockOpenAi(secs_latency=0.2).start()
+    mock.secs_token = SECS_TOKEN
+
+    str_fmt = "{stream:>8} {first:>10} {total:>10} {delta:>10}"
+    print(
+        str_fmt.format(
+            stream="stream", first="first s", total="total s", delta="deltas"
+        )
+    )
+    for is_stream in (False, True):
+        request_handler = fl.net.openai.client.coro_request_handler(
+            cfg=_cfg(mock.api_base)
+        )
+        list_send = [
+            dict(
+                messages=[dict(role="user", content="Summarise the session.")],
+                stream=is_stream,
+                state=dict(id_prompt="summary"),
+            )
+        ]
+        list_delta = list()
+        secs_first = None
+        result = None
+        time_start = time.perf_counter()
+        while result is None:
+            if time.perf_counter() - time_start > SECS_TIMEOUT:
+                raise RuntimeError("Timed out waiting for results.")
+            for item in request_handler.send((list_send, 0)):
+                if item.get("type", None) == "openai_result_delta":
+                    list_delta.append(item["delta"])
+                elif item.get("type", None) == "openai_result":
+                    result = item
+                else:
+                    continue
+                if secs_first is None:
+                    secs_first = time.perf_counter() - time_start
+            list_send = list()
+            time.sleep(0.001)
+        secs_total = time.perf_counter() - time_start
+
+        str_content = result["response"]["choices"][0]["message"]["content"]
+        assert len(str_content.split()) == COUNT_TOKEN_SUMMARY
+        assert not list_delta or "".join(list_delta) == str_content
+        print(
+            str_fmt.format(
+                stream="on" if is_stream else "off",
+                first="{:.2f}".format(secs_first),
+                total="{:.2f}".format(secs_total),
+                delta=len(list_delta),
+            )
+        )
+
+
+# -----------------------------------------------------------------------------
+def _measure_template():
+    """
+    Print the rate at which the template handler builds parameterised requests.
+
+    The request handler is replaced with one
+    which discards requests, so that only
+    the template handler is measured.
+
+    """
+
+    def coro_discard():
+        list_from_api = list()
+        while True:
+            yield list_from_api
+
+    request_handler = coro_discard()
+    request_handler.send(None)
+    template_handler = fl.net.openai.client.coro_template_handler(
+        cfg=_cfg(None), request_handler=request_handler
+    )
+
+    template = dict(
+        type=dict(id="prompt_template", ver="1.0"),
+        id_endpoint="chat_completions",
+        uid_template="summary",
+        kwargs_req=dict(model="gpt-3.5-turbo"),
+        messages=[
+            dict(role="system", content="You facilitate a {kind} deliberation."),
+            dict(role="user", content="Summarise for {name}:\n\n{transcript}"),
+        ],
+    )
+    count_param = 5000
+    list_param = list(
+        dict(
+            type=dict(id="prompt_params", ver="1.0"),
+            uid_template="summary",
+            kwargs_tmpl=dict(
+                kind="citizens",
+                name="participant {idx}".format(idx=idx),
+                transcript="Line of the transcript.\n" * 40,
+            ),
+            kwargs_req=dict(),
+            state=dict(idx=idx),
+        )
+        for idx in range(count_param)
+    )
+
+    template_handler.send(([template], 0))
+    time_start = time.perf_counter()
+    for _ in range(10):
+        template_handler.send((list(list_param), 0))
+    secs = time.perf_counter() - time_start
+    print("{rate:.0f} requests built per second".format(rate=10 * count_param / secs))
+
+
+# -----------------------------------------------------------------------------
+def _measure_validation():
+    """
+    Print the rate at which raw requests are validated and merged with defaults.
+
+    """
+
+    default = dict(id_endpoint="chat_completions", model="gpt-3.5-turbo", user="bench")
+    list_request = list(
+        dict(
+            id_endpoint="chat_completions",
+            messages=[dict(role="user", content="Question {idx}".format(idx=idx))],
+            temperature=0.7,
+            max_tokens=256,
+            state=dict(idx=idx),
+        )
+        for idx in range(1000)
+    )
+
+    count_rep = 100
+    time_start = time.perf_counter()
+    for _ in range(count_rep):
+        for request_raw in list_request:
+            fl.net.openai.client._build_endpoint_specific_parameters(
+                request_raw=request_raw, default=default
+            )
+    secs = time.perf_counter() - time_start
+    print(
+        "{rate:.0f} requests validated per second".format(
+            rate=count_rep * len(list_request) / secs
+        )
+    )
+
+
+# -----------------------------------------------------------------------------
+def _measure_workflow_routing():
+    """
+    Print the time per tick for many registered workflows with little input.
+
+    """
+
+    def coro_discard():
+        while True:
+            yield list()
+
+    str_spec = "def coro(cfg):\n    while True:\n        yield []\n"
+    str_fmt = "{count:>10} {usecs:>14}"
+    print(str_fmt.format(count="workflows", usecs="usecs/tick"))
+    for count_workflow in (10, 100, 1000):
+        template_handler = coro_discard()
+        template_handler.send(None)
+        workflow_handler = fl.net.openai.client.coro_workflow_handler(
+            cfg=_cfg(None), request_handler=None, template_handler=template_handler
+        )
+        workflow_handler.send(
+            (
+                list(
+                    dict(
+                        type=dict(id="prompt_workflow", ver="1.0"),
+                        uid_workflow=str(idx),
+                        spec=str_spec,
+                        coroutine=None,
+                    )
+                    for idx in range(count_workflow)
+                ),
+                0,
+            )
+        )
+
+        count_tick = 1000
+        time_start = time.perf_counter()
+        for idx_tick in range(count_tick):
+            list_input = list(
+                dict(type=dict(id="prompt_params"), uid_workflow=str(idx % 10))
+                for idx in range(10)
+            )
+            workflow_handler.send((list_input, idx_tick))
+        secs = time.perf_counter() - time_start
+        print(
+            str_fmt.format(
+                count=count_workflow, usecs="{:.1f}".format(1e6 * secs / count_tick)
+            )
+        )
+
+
+# -----------------------------------------------------------------------------
+def _measure_workflow_spinup():
+    """
+    Print the time to start many instances of one inline workflow spec.
+
+    """
+
+    str_spec = "\n".join(
+        "def step_{idx}(list_in):\n    return [x for x in list_in if x]\n".format(
+            idx=idx
+        )
+        for idx in range(50)
+    )
+    str_spec += "\ndef coro(cfg):\n    while True:\n        yield step_0((yield []))\n"
+
+    count_workflow = 500
+    time_start = time.perf_counter()
+    for _ in range(count_workflow):
+        fl.net.openai.client._ensure_init_workflow(
+            _cfg(None), dict(spec=str_spec, coroutine=None)
+        )
+    secs = time.perf_counter() - time_start
+    print(
+        "{count} workflows started in {secs:.3f} secs".format(
+            count=count_workflow, secs=secs
+        )
+    )
+
+
+# -----------------------------------------------------------------------------
+def _measure_workflow_pool():
+    """
+    Print the time per tick for CPU-heavy workflows, in and out of process.
+
+    Each of 8 workflows does about 20 ms of
+    work per step, so the speedup from the
+    pool is bounded by the number of cores.
+
+    """
+
+    def coro_discard():
+        while True:
+            yield list()
+
+    str_spec = (
+        "def coro(cfg):\n"
+        "    while True:\n"
+        "        list_in = yield []\n"
+        "        sum(idx * idx for idx in range(300000))\n"
+    )
+    list_workflow = list(
+        dict(
+            type=dict(id="prompt_workflow", ver="1.0"),
+            uid_workflow=str(idx),
+            spec=str_spec,
+            coroutine=None,
+        )
+        for idx in range(8)
+    )
+
+    str_fmt = "{process:>10} {msecs:>14}"
+    print(str_fmt.format(process="processes", msecs="msecs/tick"))
+    for count_process in (None, 2, 4, 8):
+        template_handler = coro_discard()
+        template_handler.send(None)
+        workflow_handler = fl.net.openai.client.coro_workflow_handler(
+            cfg=_cfg(None, count_process_workflow=count_process),
+            request_handler=None,
+            template_handler=template_handler,
+        )
+        workflow_handler.send((list(dict(item) for item in list_workflow), 0))
+
+        count_tick = 10
+        time_start = time.perf_counter()
+        for idx_tick in range(count_tick):
+            list_input = list(
+                dict(type=dict(id="prompt_params"), uid_workflow=str(idx))
+                for idx in range(8)
+            )
+            workflow_handler.send((list_input, idx_tick))
+        secs = time.perf_counter() - time_start
+        print(
+            str_fmt.format(
+                process=count_process or "inline",
+                msecs="{:.1f}".format(1e3 * secs / count_tick),
+            )
+        )
+
+
+# -----------------------------------------------------------------------------
+def _measure_priority():
+    """
+    Print the latency of interactive requests queued behind a bulk backlog.
+
+    """
+
+    mock = MockOpenAi().start()
+    count_bulk = 40
+    list_request = list(
+        dict(
+            messages=[
+                dict(role="user", content="Summarise part {idx}.".format(idx=idx))
+            ],
+            state=dict(id_priority="bulk"),
+        )
+        for idx in range(count_bulk)
+    )
+    list_request.extend(
+        dict(
+            messages=[dict(role="user", content="Hello {idx}".format(idx=idx))],
+            state=dict(id_priority="interactive"),
+        )
+        for idx in range(4)
+    )
+
+    str_fmt = "{mode:>10} {interactive:>12} {bulk:>12}"
+    print(str_fmt.format(mode="priority", interactive="interactive", bulk="bulk"))
+    for str_mode, cfg_priority in (
+        ("off", None),
+        ("weighted", dict()),
+        ("strict", dict(is_strict=True)),
+    ):
+        request_handler = fl.net.openai.client.coro_request_handler(
+            cfg=_cfg(mock.api_base, count_parallel=4, priority=cfg_priority)
+        )
+        map_list_secs = dict(interactive=list(), bulk=list())
+        list_send = list(dict(request) for request in list_request)
+        count_result = 0
+        time_start = time.perf_counter()
+        while count_result < len(list_request):
+            if time.perf_counter() - time_start > SECS_TIMEOUT:
+                raise RuntimeError("Timed out waiting for results.")
+            for item in request_handler.send((list_send, 0)):
+                if item.get("type", None) == "openai_result":
+                    map_list_secs[item["state"]["id_priority"]].append(
+                        time.perf_counter() - time_start
+                    )
+                    count_result += 1
+            list_send = list()
+            time.sleep(0.001)
+        print(
+            str_fmt.format(
+                mode=str_mode,
+                interactive="{:.2f}".format(max(map_list_secs["interactive"])),
+                bulk="{:.2f}".format(max(map_list_secs["bulk"])),
+            )
+        )
+
+
+# -----------------------------------------------------------------------------
+def _measure_single_flight():
+    """
+    Print API calls and elapsed time for a burst of identical summaries.
+
+    Four identical requests are sent 0.1 secs
+    apart, as if several people pressed the
+    same Summary button. Each must still get
+    the whole text in its own deltas.
+
+    """
+
+    mock = MockOpenAi(secs_latency=0.2).start()
+    mock.secs_token = SECS_TOKEN
+    count_request = 4
+
+    str_fmt = "{flight:>8} {calls:>8} {secs:>8}"
+    print(str_fmt.format(flight="flight", calls="calls", secs="secs"))
+    for is_single_flight in (False, True):
+        mock.count_request = 0
+        request_handler = fl.net.openai.client.coro_request_handler(
+            cfg=_cfg(mock.api_base, count_parallel=4, is_single_flight=is_single_flight)
+        )
+        map_text = dict()  # idx -> text from deltas
+        map_result = dict()  # idx -> result
+        time_start = time.perf_counter()
+        while len(map_result) < count_request:
+            secs = time.perf_counter() - time_start
+            if secs > SECS_TIMEOUT:
+                raise RuntimeError("Timed out waiting for results.")
+            list_send = list()
+            if len(map_text) < count_request and secs >= 0.1 * len(map_text):
+                map_text[len(map_text)] = ""
+                list_send.append(
+                    dict(
+                        messages=[dict(role="user", content="Summarise the session.")],
+                        stream=True,
+                        state=dict(idx=len(map_text) - 1),
+                    )
+                )
+            for item in request_handler.send((list_send, 0)):
+                if item.get("type", None) == "openai_result_delta":
+                    map_text[item["state"]["idx"]] += item["delta"]
+                elif item.get("type", None) == "openai_result":
+                    map_result[item["state"]["idx"]] = item
+            time.sleep(0.001)
+        secs_total = time.perf_counter() - time_start
+
+        for idx, result in map_result.items():
+            str_content = result["response"]["choices"][0]["message"]["content"]
+            assert map_text[idx] == str_content
+        print(
+            str_fmt.format(
+                flight="on" if is_single_flight else "off",
+                calls=mock.count_request,
+                secs="{:.2f}".format(secs_total),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
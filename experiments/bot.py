@@ -2,11 +2,59 @@ import asyncio
 import collections
 import logging
 import multiprocessing
+import multiprocessing.resource_tracker
+import multiprocessing.shared_memory
 import os
 import queue
+import sys
+import threading
+import time
+import traceback
+
+import fl.net.ipc
 
 
 PREFIX_COMMAND = "/"
+PREFIX_BUTTON = "btn:"
+SECS_INTERACTION_TOKEN = 900
+COUNT_CHAR_MSG = 2000
+
+
+# Acknowledgement strategies for application
+# commands. Each can be set per command in
+# cfg_appcmd items, with a default for all
+# commands in cfg_bot["appcmd_ack"].
+#
+#   followup  - Defer, then send an ephemeral
+#               followup once the command has
+#               been forwarded. Two REST calls.
+#   immediate - Respond at once with a final
+#               ephemeral message. One REST call.
+#   deferred  - Defer, and let the first
+#               appcmd_reply item from the
+#               system replace the deferred
+#               placeholder. One REST call plus
+#               the reply itself.
+#
+TUP_APPCMD_ACK = ("followup", "immediate", "deferred")
+
+
+# Discord client cache settings for each
+# memory profile. The default profile leaves
+# the discord.py defaults untouched. The
+# lean and minimal profiles disable the
+# member cache and guild chunking, and
+# shrink (or disable) the message cache,
+# so that more bot processes can be packed
+# onto each host.
+#
+MAP_MEMORY_PROFILE = dict(
+    default=dict(),
+    lean=dict(is_member_cache=False, chunk_guilds_at_startup=False, max_messages=100),
+    minimal=dict(
+        is_member_cache=False, chunk_guilds_at_startup=False, max_messages=None
+    ),
+)
 
 
 # This global register exists so that we
@@ -21,15 +69,95 @@ FileData = collections.namedtuple(
     "FileData", ["filename", "spoiler", "description", "buffer"]
 )
 
+# Large attachments can be passed by reference
+# rather than by value, so that the content is
+# not pickled through queue_to_bot and copied
+# again inside the discord client process.
+#
+# FilePath refers to a file on the local
+# filesystem. If is_owned is True, the file
+# is removed once the message has been sent.
+#
+# FileShm refers to a named shared memory
+# segment, typically created with file_shm().
+# The segment is always unlinked once the
+# message has been sent.
+#
+FilePath = collections.namedtuple(
+    "FilePath", ["filename", "spoiler", "description", "path", "is_owned"]
+)
+
+FileShm = collections.namedtuple(
+    "FileShm", ["filename", "spoiler", "description", "name_shm", "size"]
+)
+
 ButtonData = collections.namedtuple("ButtonData", ["label", "id_btn"])
 
+LoopStall = collections.namedtuple("LoopStall", ["secs", "where", "stack"])
+
+
+# -----------------------------------------------------------------------------
+def file_shm(filename, buffer, spoiler=False, description=None):
+    """
+    Return a FileShm for a shared memory copy of the specified buffer.
+
+    Ownership of the segment passes to the
+    discord client process, which unlinks it
+    once the message has been sent.
+
+    """
+
+    size = len(buffer)
+    shm = multiprocessing.shared_memory.SharedMemory(create=True, size=max(size, 1))
+    shm.buf[:size] = buffer
+
+    # Stop the resource tracker in this process
+    # from unlinking the segment at exit, since
+    # it is now owned by the receiving process.
+    #
+    multiprocessing.resource_tracker.unregister(shm._name, "shared_memory")
+    name_shm = shm.name
+    shm.close()
+
+    return FileShm(
+        filename=filename,
+        spoiler=spoiler,
+        description=description,
+        name_shm=name_shm,
+        size=size,
+    )
+
+
+# -----------------------------------------------------------------------------
+def release_file(file_ref):
+    """
+    Release any resources held by the specified FilePath or FileShm.
+
+    """
+
+    if isinstance(file_ref, FileShm):
+        try:
+            shm = multiprocessing.shared_memory.SharedMemory(name=file_ref.name_shm)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+    elif isinstance(file_ref, FilePath) and file_ref.is_owned:
+        try:
+            os.remove(file_ref.path)
+        except FileNotFoundError:
+            pass
+
 
 # -----------------------------------------------------------------------------
 def coro(cfg_bot):
     """
     Yield results for workflow coroutines sent to the OpenAI web API.
 
-    Start the client in a separate process.
+    Start the client in a separate process, or
+    in a separate thread if cfg_bot["mode"] is
+    "thread".
 
     """
 
@@ -51,15 +179,88 @@ def coro(cfg_bot):
     if not isinstance(cfg_bot["id_node"], (str, type(None))):
         raise ValueError('cfg_bot["id_node"] must be a string or None.')
 
+    _validate_filter_configuration(cfg_bot.get("filter", dict()))
+
+    if cfg_bot.get("memory_profile", "default") not in MAP_MEMORY_PROFILE:
+        raise ValueError(
+            'cfg_bot["memory_profile"] must be one of: {ids}.'.format(
+                ids=", ".join(MAP_MEMORY_PROFILE)
+            )
+        )
+
+    if not isinstance(cfg_bot.get("max_messages", None), (int, type(None))):
+        raise ValueError('cfg_bot["max_messages"] must be an integer or None.')
+
+    if not isinstance(cfg_bot.get("count_msg_tracked", 10000), int):
+        raise ValueError('cfg_bot["count_msg_tracked"] must be an integer.')
+
+    for str_key in ("url_api", "url_gateway"):
+        if not isinstance(cfg_bot.get(str_key, None), (str, type(None))):
+            raise ValueError(
+                'cfg_bot["{key}"] must be a string or None.'.format(key=str_key)
+            )
+
+    secs_report_memory = cfg_bot.get("secs_report_memory", None)
+    if not isinstance(secs_report_memory, (int, float, type(None))):
+        raise ValueError(
+            'cfg_bot["secs_report_memory"] must be an integer, float or None.'
+        )
+
+    if not isinstance(
+        cfg_bot.get("secs_lag_threshold", None), (int, float, type(None))
+    ):
+        raise ValueError(
+            'cfg_bot["secs_lag_threshold"] must be an integer, float or None.'
+        )
+
+    if not isinstance(cfg_bot.get("secs_lag_interval", 0.1), (int, float)):
+        raise ValueError('cfg_bot["secs_lag_interval"] must be an integer or float.')
+
+    if not isinstance(cfg_bot.get("secs_stream_edit", 1.0), (int, float)):
+        raise ValueError('cfg_bot["secs_stream_edit"] must be an integer or float.')
+
+    if not isinstance(cfg_bot.get("str_stream_placeholder", "..."), str):
+        raise ValueError('cfg_bot["str_stream_placeholder"] must be a string.')
+
+    if cfg_bot.get("appcmd_ack", "followup") not in TUP_APPCMD_ACK:
+        raise ValueError(
+            'cfg_bot["appcmd_ack"] must be one of: {ids}.'.format(
+                ids=", ".join(TUP_APPCMD_ACK)
+            )
+        )
+
+    if cfg_bot.get("mode", "process") not in ("process", "thread"):
+        raise ValueError('cfg_bot["mode"] must be "process" or "thread".')
+
+    # By default, the discord client runs in a
+    # separate daemon process. In thread mode
+    # it runs its event loop in a daemon thread
+    # inside this process instead, linked by
+    # in-memory queues, which avoids pickling
+    # and the memory overhead of a second
+    # interpreter on small deployments.
+    #
     str_name_process = "discord-bot"
     fcn_bot = _discord_bot
-    queue_to_bot = multiprocessing.Queue()  # system  --> discord
-    queue_from_bot = multiprocessing.Queue()  # discord --> system
-    tup_args = (cfg_bot, queue_to_bot, queue_from_bot)
-    proc_bot = multiprocessing.Process(
-        target=fcn_bot, args=tup_args, name=str_name_process, daemon=True
-    )  # So we get terminated
-    proc_bot.start()
+    if cfg_bot.get("mode", "process") == "thread":
+        queue_to_bot = queue.Queue()  # system  --> discord
+        queue_from_bot = queue.Queue()  # discord --> system
+        tup_args = (cfg_bot, queue_to_bot, queue_from_bot)
+        thread_bot = threading.Thread(
+            target=fcn_bot, args=tup_args, name=str_name_process, daemon=True
+        )  # So we get terminated
+        thread_bot.start()
+    else:
+        queue_to_bot = multiprocessing.Queue()  # system  --> discord
+        queue_from_bot = multiprocessing.Queue()  # discord --> system
+        if cfg_bot.get("is_ipc_codec", False):
+            queue_to_bot = fl.net.ipc.EncodedQueue(queue_to_bot)
+            queue_from_bot = fl.net.ipc.EncodedQueue(queue_from_bot)
+        tup_args = (cfg_bot, queue_to_bot, queue_from_bot)
+        proc_bot = multiprocessing.Process(
+            target=fcn_bot, args=tup_args, name=str_name_process, daemon=True
+        )  # So we get terminated
+        proc_bot.start()
 
     list_to_bot = list()
     list_from_bot = list()
@@ -78,13 +279,24 @@ def coro(cfg_bot):
         # or to use to configure new commands
         # (in the case of command configuration).
         #
-        for item in list_to_bot:
+        # If the queue is full, the rest of the
+        # items are dropped, and any files they
+        # reference are released, as the bot
+        # process will never see them.
+        #
+        for idx, item in enumerate(list_to_bot):
             try:
                 queue_to_bot.put(item, block=False)
             except queue.Full as err:
+                list_dropped = list_to_bot[idx:]
+                for item_dropped in list_dropped:
+                    if isinstance(item_dropped.get("file", None), (FilePath, FileShm)):
+                        release_file(item_dropped["file"])
                 list_from_bot.append(
                     dict(
-                        type="log_event", content="Item dropped: queue_to_bot is full."
+                        type="log_event",
+                        content="{num} item(s) dropped: "
+                        "queue_to_bot is full.".format(num=len(list_dropped)),
                     )
                 )
                 break
@@ -102,12 +314,324 @@ def coro(cfg_bot):
                 break
 
 
+# =============================================================================
+class TrackedMessage:
+    """
+    Compact record of a forwarded message which may later be edited.
+
+    """
+
+    __slots__ = ("id_author", "name_author", "id_channel", "name_channel", "is_dm")
+
+    # -------------------------------------------------------------------------
+    def __init__(self, id_author, name_author, id_channel, name_channel, is_dm):
+        """
+        Construct the record.
+
+        """
+
+        self.id_author = id_author
+        self.name_author = name_author
+        self.id_channel = id_channel
+        self.name_channel = name_channel
+        self.is_dm = is_dm
+
+
+# =============================================================================
+class TrackedMessageIndex:
+    """
+    Bounded index from message id to TrackedMessage.
+
+    Only messages from tracked users which
+    have been forwarded to the rest of the
+    system are tracked, so that raw edit
+    events can be attributed without
+    relying on the discord.py global message
+    cache. When the index is full, the
+    oldest message is evicted.
+
+    """
+
+    __slots__ = ("_map_msg", "_count_max")
+
+    # -------------------------------------------------------------------------
+    def __init__(self, count_max):
+        """
+        Construct the index.
+
+        """
+
+        self._map_msg = dict()  # id_msg -> TrackedMessage
+        self._count_max = count_max
+
+    # -------------------------------------------------------------------------
+    def __len__(self):
+        """
+        Return the number of tracked messages.
+
+        """
+
+        return len(self._map_msg)
+
+    # -------------------------------------------------------------------------
+    def add(self, id_msg, record):
+        """
+        Track the specified message, evicting the oldest if full.
+
+        """
+
+        map_msg = self._map_msg
+        if id_msg not in map_msg and len(map_msg) >= self._count_max:
+            del map_msg[next(iter(map_msg))]
+        map_msg[id_msg] = record
+
+    # -------------------------------------------------------------------------
+    def get(self, id_msg):
+        """
+        Return the TrackedMessage for id_msg, or None if not tracked.
+
+        """
+
+        return self._map_msg.get(id_msg, None)
+
+    # -------------------------------------------------------------------------
+    def discard_author(self, set_id_author):
+        """
+        Stop tracking all messages from the specified authors.
+
+        """
+
+        list_id_msg = list(
+            id_msg
+            for (id_msg, record) in self._map_msg.items()
+            if record.id_author in set_id_author
+        )
+        for id_msg in list_id_msg:
+            del self._map_msg[id_msg]
+
+
+# =============================================================================
+class LoopWatchdog:
+    """
+    Measure event loop lag and sample the stack of blocking code.
+
+    A heartbeat task on the event loop sleeps
+    for secs_interval at a time and records
+    how late it wakes up. A separate sampler
+    thread checks the heartbeat, and if the
+    loop has not run for secs_threshold, it
+    takes a sample of the stack of the loop
+    thread, along with the name of the task
+    that is running (if any).
+
+    When the loop recovers, the heartbeat
+    task turns the sample into a LoopStall,
+    so samples are only ever consumed from
+    the loop thread.
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, secs_interval=0.1, secs_threshold=0.25, count_frame=8):
+        """
+        Construct the watchdog.
+
+        """
+
+        self.secs_interval = secs_interval
+        self.secs_threshold = secs_threshold
+        self.count_frame = count_frame
+        self.count_stall = 0
+        self.secs_lag_last = 0.0
+        self.secs_lag_max = 0.0
+        self.deque_stall = collections.deque(maxlen=32)
+        self.loop = None
+        self._id_thread = None
+        self._time_beat = time.monotonic()
+        self._sample_pending = None
+
+    # -------------------------------------------------------------------------
+    def is_running(self):
+        """
+        Return True iff the heartbeat task is running.
+
+        """
+
+        return self.loop is not None
+
+    # -------------------------------------------------------------------------
+    async def run(self):
+        """
+        Run the heartbeat until cancelled. Starts the sampler thread.
+
+        """
+
+        self.loop = asyncio.get_running_loop()
+        self._id_thread = threading.get_ident()
+        self._time_beat = time.monotonic()
+        event_stop = threading.Event()
+        threading.Thread(
+            target=self._sample_while_running,
+            args=(event_stop,),
+            name="loop-watchdog",
+            daemon=True,
+        ).start()
+
+        try:
+            while True:
+                time_sleep = time.monotonic()
+                await asyncio.sleep(self.secs_interval)
+                time_wake = time.monotonic()
+                self._time_beat = time_wake
+
+                secs_lag = max(0.0, time_wake - time_sleep - self.secs_interval)
+                self.secs_lag_last = secs_lag
+                self.secs_lag_max = max(self.secs_lag_max, secs_lag)
+                if secs_lag >= self.secs_threshold:
+                    (where, stack) = self._sample_pending or ("unknown", "")
+                    self._sample_pending = None
+                    self.count_stall += 1
+                    self.deque_stall.append(
+                        LoopStall(secs=secs_lag, where=where, stack=stack)
+                    )
+        finally:
+            event_stop.set()
+            self.loop = None
+
+    # -------------------------------------------------------------------------
+    def _sample_while_running(self, event_stop):
+        """
+        Sample the loop thread stack once per stall. Sampler thread entry point.
+
+        """
+
+        secs_limit = self.secs_interval + self.secs_threshold
+        time_beat_sampled = None
+        while not event_stop.wait(self.secs_threshold / 2):
+            time_beat = self._time_beat
+            if time_beat == time_beat_sampled:
+                continue
+            if (time.monotonic() - time_beat) < secs_limit:
+                continue
+            time_beat_sampled = time_beat
+            self._sample_pending = self._sample()
+
+    # -------------------------------------------------------------------------
+    def _sample(self):
+        """
+        Return (where, stack) for the code currently running on the loop.
+
+        """
+
+        frame = sys._current_frames().get(self._id_thread, None)
+        if frame is None:
+            return ("unknown", "")
+
+        list_frame = traceback.extract_stack(frame, limit=self.count_frame)
+        task = asyncio.current_task(self.loop)
+        if task is not None:
+            where = "task {name} ({coro})".format(
+                name=task.get_name(), coro=task.get_coro().__qualname__
+            )
+        else:
+            where = "callback {name} ({file}:{line})".format(
+                name=list_frame[-1].name,
+                file=list_frame[-1].filename,
+                line=list_frame[-1].lineno,
+            )
+        return (where, "".join(traceback.format_list(list_frame)))
+
+
+# -----------------------------------------------------------------------------
+def rss_bytes(pid=None):
+    """
+    Return the resident set size of the specified process in bytes.
+
+    Defaults to the current process. Uses
+    /proc where it is available, otherwise
+    falls back to the peak resident set size
+    of the current process. Returns None if
+    the value cannot be determined.
+
+    """
+
+    str_pid = "self" if pid is None else str(pid)
+    try:
+        with open("/proc/{pid}/statm".format(pid=str_pid)) as file:
+            count_page = int(file.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    else:
+        return count_page * os.sysconf("SC_PAGE_SIZE")
+
+    if pid is not None:
+        return None
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # ru_maxrss is in bytes on macOS but in
+    # kilobytes everywhere else.
+    #
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return maxrss
+    return maxrss * 1024
+
+
+# -----------------------------------------------------------------------------
+def _validate_filter_configuration(cfg_filter):
+    """
+    Validate the provided message filter configuration dict.
+
+    Throws a ValueError if it is not valid.
+
+    """
+
+    if not isinstance(cfg_filter, dict):
+        raise ValueError('cfg_bot["filter"] must be a dict.')
+
+    set_key_allowed = set(
+        ("id_guild", "id_channel", "id_user", "is_dm_only", "is_tracked_only")
+    )
+    set_key_surplus = set(cfg_filter.keys()) - set_key_allowed
+    if set_key_surplus:
+        raise ValueError(
+            "Filter config has extra fields: "
+            '"{key}".'.format(key='", "'.join(set_key_surplus))
+        )
+
+    for key in ("id_guild", "id_channel", "id_user"):
+        value = cfg_filter.get(key, None)
+        if value is None:
+            continue
+        if not isinstance(value, (list, tuple, set, frozenset)):
+            raise ValueError(
+                'Filter config "{key}" value should be a collection '
+                "of integer ids or None.".format(key=key)
+            )
+        if not all(isinstance(id_item, int) for id_item in value):
+            raise ValueError(
+                'Filter config "{key}" value should only contain '
+                "integer ids.".format(key=key)
+            )
+
+    for key in ("is_dm_only", "is_tracked_only"):
+        if not isinstance(cfg_filter.get(key, False), bool):
+            raise ValueError(
+                'Filter config "{key}" value should be a bool.'.format(key=key)
+            )
+
+
 # -----------------------------------------------------------------------------
 def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
     """
     Run the discord client.
 
-    This function is expected to be run in a separate daemon process.
+    This function is expected to be run in a separate daemon process,
+    or in a daemon thread when the bot is configured in thread mode.
 
     """
 
@@ -119,13 +643,18 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
     import keyword
     import logging
     import os
+    import re
     import textwrap
+    import time
     import typing
 
     import discord
     import discord.app_commands
     import discord.ext
     import discord.ext.commands
+    import discord.gateway
+    import discord.http
+    import yarl
 
     # We distinguish between event logging, metric
     # logging and data logging. Event logging is
@@ -160,6 +689,18 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
         str_id=id_log_event, level=level_log_event
     )
 
+    # The REST and gateway endpoints can be
+    # overridden, e.g. to point the client at
+    # the local simulator in fl.net.discord.sim
+    # for load testing.
+    #
+    if cfg_bot.get("url_api", None) is not None:
+        discord.http.Route.BASE = cfg_bot["url_api"]
+    if cfg_bot.get("url_gateway", None) is not None:
+        discord.gateway.DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(
+            cfg_bot["url_gateway"]
+        )
+
     intents = discord.Intents.default()
     intents.guilds = True
     intents.dm_messages = True
@@ -168,7 +709,122 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
     intents.messages = True
     intents.reactions = True
     intents.guild_messages = True
-    bot = discord.ext.commands.Bot(command_prefix=PREFIX_COMMAND, intents=intents)
+
+    # Configure the client caches according
+    # to the selected memory profile. An
+    # explicit max_messages setting takes
+    # precedence over the profile.
+    #
+    map_profile = MAP_MEMORY_PROFILE[cfg_bot.get("memory_profile", "default")]
+    kwargs_cache = dict()
+    if "is_member_cache" in map_profile:
+        if map_profile["is_member_cache"]:
+            kwargs_cache["member_cache_flags"] = discord.MemberCacheFlags.from_intents(
+                intents
+            )
+        else:
+            kwargs_cache["member_cache_flags"] = discord.MemberCacheFlags.none()
+    if "chunk_guilds_at_startup" in map_profile:
+        kwargs_cache["chunk_guilds_at_startup"] = map_profile["chunk_guilds_at_startup"]
+    if "max_messages" in map_profile:
+        kwargs_cache["max_messages"] = map_profile["max_messages"]
+    if "max_messages" in cfg_bot:
+        kwargs_cache["max_messages"] = cfg_bot["max_messages"]
+
+    bot = discord.ext.commands.Bot(
+        command_prefix=PREFIX_COMMAND, intents=intents, **kwargs_cache
+    )
+
+    # Messages are filtered at source, before
+    # they are put onto queue_from_bot, so that
+    # irrelevant traffic from busy guilds never
+    # gets pickled and sent to the rest of the
+    # system.
+    #
+    #   set_id_guild    - Guild allowlist. None allows all guilds.
+    #   set_id_channel  - Channel allowlist. None allows all channels.
+    #   is_dm_only      - Only forward direct messages.
+    #   is_tracked_only - Only forward messages from tracked users.
+    #   set_id_user     - Tracked users. Updated via cfg_filter items.
+    #
+    # The guild and channel allowlists do not
+    # apply to direct messages.
+    #
+    cfg_filter = cfg_bot.get("filter", dict())
+    state_filter = dict(
+        set_id_guild=None,
+        set_id_channel=None,
+        is_dm_only=cfg_filter.get("is_dm_only", False),
+        is_tracked_only=cfg_filter.get("is_tracked_only", False),
+        set_id_user=set(cfg_filter.get("id_user", None) or ()),
+    )
+    for key in ("id_guild", "id_channel"):
+        if cfg_filter.get(key, None) is not None:
+            state_filter["set_" + key] = frozenset(cfg_filter[key])
+
+    # Forwarded messages from tracked users
+    # are recorded in a compact index so that
+    # edits can be handled from raw gateway
+    # events, even once the message has
+    # dropped out of (or never entered) the
+    # message cache. Messages from other users
+    # are not indexed, so that busy channels
+    # do not evict session messages.
+    #
+    index_msg = TrackedMessageIndex(count_max=cfg_bot.get("count_msg_tracked", 10000))
+
+    # Threads created for msg_thread items.
+    #
+    #   map_thread     - key_thread -> info_thread.
+    #   map_key_thread - Thread id -> key_thread, so that
+    #                    messages posted in those threads
+    #                    can be forwarded with the
+    #                    key_thread that they belong to.
+    #
+    # These outlive the queue service task,
+    # so that threads are not created again
+    # after the gateway reconnects.
+    #
+    map_thread = dict()
+    map_key_thread = dict()
+
+    # Messages whose text is still arriving,
+    # as a map from key_stream -> info_stream,
+    # for msg_stream items. Like threads, these
+    # outlive the queue service task.
+    #
+    map_stream = dict()
+
+    # The queue service task. on_ready is called
+    # again each time the gateway reconnects,
+    # but only one task may service the queues.
+    #
+    state_service = dict(task=None)
+
+    # Event loop lag is measured by a watchdog,
+    # so that handlers which block the loop are
+    # found before they cause gateway heartbeat
+    # timeouts. Setting secs_lag_threshold to
+    # None disables the watchdog.
+    #
+    watchdog = None
+    if cfg_bot.get("secs_lag_threshold", 0.25) is not None:
+        watchdog = LoopWatchdog(
+            secs_interval=cfg_bot.get("secs_lag_interval", 0.1),
+            secs_threshold=cfg_bot.get("secs_lag_threshold", 0.25),
+        )
+
+    # Application command acknowledgement state.
+    #
+    #   map_ack     - Command name -> (ack strategy, ack text).
+    #   map_pending - Interaction id -> (time, interaction, is_replied)
+    #                 for commands acknowledged in deferred mode,
+    #                 oldest first, until the token expires.
+    #
+    state_appcmd = dict(
+        map_ack=dict(),
+        map_pending=collections.OrderedDict(),
+    )
 
     # -------------------------------------------------------------------------
     @bot.event
@@ -187,11 +843,26 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
         """
 
         log_event.info("Discord bot is ready.")
-        task_msg = bot.loop.create_task(
-            coro=_service_all_queues(
-                cfg_bot, handler_log_event, queue_to_bot, queue_from_bot
+        _report_memory()
+        log_event.info(
+            "Memory: {rss} bytes RSS, {guilds} guilds, {users} users, "
+            "{members} members, {messages} messages cached.".format(
+                rss=map_log_metric["mem.rss_bytes"],
+                guilds=map_log_metric["cache.guilds"],
+                users=map_log_metric["cache.users"],
+                members=map_log_metric["cache.members"],
+                messages=map_log_metric["cache.messages"],
             )
         )
+        if watchdog is not None and not watchdog.is_running():
+            bot.loop.create_task(coro=watchdog.run())
+        task = state_service["task"]
+        if task is None or task.done():
+            state_service["task"] = bot.loop.create_task(
+                coro=_service_all_queues(
+                    cfg_bot, handler_log_event, queue_to_bot, queue_from_bot
+                )
+            )
 
     # -------------------------------------------------------------------------
     async def _service_all_queues(
@@ -228,7 +899,32 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
             map_app_cmd=dict(),
         )
 
+        secs_report_memory = cfg_bot.get("secs_report_memory", 300)
+        time_report_memory = time.monotonic()
+
         while True:
+            # Periodically add memory usage and
+            # cache sizes to the metric log.
+            #
+            if secs_report_memory is not None:
+                time_now = time.monotonic()
+                if (time_now - time_report_memory) >= secs_report_memory:
+                    time_report_memory = time_now
+                    _report_memory()
+                    _report_loop_lag()
+
+            # Report any event loop stalls as soon
+            # as the loop has recovered from them.
+            #
+            if watchdog is not None and watchdog.deque_stall:
+                _report_loop_stalls()
+
+            # Apply any throttled edits to streamed
+            # messages which have become due.
+            #
+            if map_stream:
+                await _flush_streams(state)
+
             # Try to send log data from the
             # discord bot to the rest of the
             # system.
@@ -246,6 +942,58 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
             if do_wait:
                 await asyncio.sleep(cfg_bot["secs_sleep"])
 
+    # -------------------------------------------------------------------------
+    def _report_memory():
+        """
+        Add process memory usage and client cache sizes to the metric log.
+
+        """
+
+        map_log_metric["mem.rss_bytes"] = rss_bytes()
+        map_log_metric["cache.guilds"] = len(bot.guilds)
+        map_log_metric["cache.users"] = len(bot.users)
+        map_log_metric["cache.members"] = sum(
+            len(guild.members) for guild in bot.guilds
+        )
+        map_log_metric["cache.messages"] = len(bot.cached_messages)
+        map_log_metric["cache.private_channels"] = len(bot.private_channels)
+        map_log_metric["cache.msg_tracked"] = len(index_msg)
+
+    # -------------------------------------------------------------------------
+    def _report_loop_lag():
+        """
+        Add event loop lag since the last report to the metric log.
+
+        """
+
+        if watchdog is None:
+            return
+
+        map_log_metric["loop.lag_ms_last"] = 1000.0 * watchdog.secs_lag_last
+        map_log_metric["loop.lag_ms_max"] = 1000.0 * watchdog.secs_lag_max
+        map_log_metric["loop.count_stall"] = watchdog.count_stall
+        watchdog.secs_lag_max = 0.0
+
+    # -------------------------------------------------------------------------
+    def _report_loop_stalls():
+        """
+        Add event loop stalls sampled by the watchdog to the logs.
+
+        """
+
+        while watchdog.deque_stall:
+            stall = watchdog.deque_stall.popleft()
+            ms_stall = 1000.0 * stall.secs
+            log_event.warning(
+                "Event loop blocked for {ms:.0f} ms in {where}:\n{stack}".format(
+                    ms=ms_stall, where=stall.where, stack=stall.stack
+                )
+            )
+            map_log_metric["loop.stall_ms_max"] = max(
+                ms_stall, map_log_metric.get("loop.stall_ms_max", 0.0)
+            )
+        map_log_metric["loop.count_stall"] = watchdog.count_stall
+
     # -------------------------------------------------------------------------
     def _service_queue_from_bot(handler_log_event, map_log_metric, queue_from_bot):
         """
@@ -310,6 +1058,14 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
                 await _configure_command(state=state, cfg_cmd=item)
             elif type_item in {"msg_guild", "msg_dm"}:
                 await _send_message(state=state, msg=item)
+            elif type_item == "cfg_filter":
+                _configure_filter(cfg_filter=item)
+            elif type_item == "appcmd_reply":
+                await _reply_to_appcmd(msg=item)
+            elif type_item == "msg_thread":
+                await _send_to_thread(state=state, msg=item)
+            elif type_item == "msg_stream":
+                await _send_to_stream(state=state, msg=item)
             else:
                 raise RuntimeError(
                     "Did not recognise item type: {type}".format(type=type_item)
@@ -376,10 +1132,67 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
                 )
             else:
                 state["map_app_cmd"][str_name] = cmd
+                state_appcmd["map_ack"][str_name] = (
+                    cfg_cmd.get("ack", cfg_bot.get("appcmd_ack", "followup")),
+                    cfg_cmd.get("ack_text", "OK"),
+                )
 
         else:
             pass
 
+    # -------------------------------------------------------------------------
+    def _configure_filter(cfg_filter):
+        """
+        Update the set of tracked users for the message filter.
+
+        cfg_filter items may contain "track"
+        and/or "untrack" fields, each of which
+        is a collection of user ids.
+
+        """
+
+        set_id_user = state_filter["set_id_user"]
+        set_id_user.update(cfg_filter.get("track", ()))
+        set_id_user.difference_update(cfg_filter.get("untrack", ()))
+        index_msg.discard_author(set(cfg_filter.get("untrack", ())))
+        log_event.debug(
+            "Message filter tracking {count} users.".format(count=len(set_id_user))
+        )
+
+    # -------------------------------------------------------------------------
+    def _is_forwarded(message):
+        """
+        Return True iff message passes the source-side message filter.
+
+        """
+
+        is_dm = isinstance(message.channel, discord.DMChannel)
+        if state_filter["is_dm_only"] and not is_dm:
+            return False
+
+        if not is_dm:
+            set_id_guild = state_filter["set_id_guild"]
+            if set_id_guild is not None:
+                if message.guild is None or message.guild.id not in set_id_guild:
+                    return False
+
+            # Threads created for msg_thread items
+            # are always allowed, as their parent
+            # channel was chosen by the system.
+            #
+            set_id_channel = state_filter["set_id_channel"]
+            if set_id_channel is not None:
+                id_channel = message.channel.id
+                if id_channel not in set_id_channel:
+                    if id_channel not in map_key_thread:
+                        return False
+
+        if state_filter["is_tracked_only"]:
+            if message.author.id not in state_filter["set_id_user"]:
+                return False
+
+        return True
+
     # -------------------------------------------------------------------------
     def _validate_command_configuration(cfg_cmd):
         """
@@ -402,8 +1215,8 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
             return is_valid
 
         set_key_required = set(("type", "name", "description"))
-        set_key_optional = set(("param",))
-        set_key_str = set(("type", "name", "description"))
+        set_key_optional = set(("param", "ack", "ack_text"))
+        set_key_str = set(("type", "name", "description", "ack", "ack_text"))
         set_key_dict = set(("param",))
         set_key_allowed = set_key_required | set_key_optional
         set_key_actual = set(cfg_cmd.keys())
@@ -465,6 +1278,15 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
                     'and not a reserved keyword. Got "{name}".'.format(name=name_param)
                 )
 
+        str_ack = cfg_cmd.get("ack", "followup")
+        if str_ack not in TUP_APPCMD_ACK:
+            raise ValueError(
+                'Command config "ack" value should be one of '
+                '"{allow}". Got "{act}" instead.'.format(
+                    allow='", "'.join(TUP_APPCMD_ACK), act=str_ack
+                )
+            )
+
     # -------------------------------------------------------------------------
     async def on_cmd(ctx):
         """
@@ -520,10 +1342,15 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
 
         """
 
-        await interaction.response.defer(ephemeral=True)
-        log_event.debug(
-            'Appcmd "{name}" invoked.'.format(name=interaction.command.name)
+        str_name = interaction.command.name
+        (str_ack, str_text) = state_appcmd["map_ack"].get(
+            str_name, (cfg_bot.get("appcmd_ack", "followup"), "OK")
         )
+        if str_ack == "immediate":
+            await interaction.response.send_message(str_text, ephemeral=True)
+        else:
+            await interaction.response.defer(ephemeral=True)
+        log_event.debug('Appcmd "{name}" invoked.'.format(name=str_name))
         if interaction.guild is None:
             map_cmd = dict(type="appcmd_dm")
         else:
@@ -536,19 +1363,88 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
             )
         map_cmd.update(
             dict(
-                name_command=interaction.command.name,
+                name_command=str_name,
                 id_channel=interaction.channel.id,
                 id_user=interaction.user.id,
                 name_user=interaction.user.name,
                 args=args,
+                id_interaction=interaction.id,
             )
         )
 
+        # In deferred mode, the interaction is
+        # held so that the first appcmd_reply
+        # for it can replace the placeholder.
+        #
+        if str_ack == "deferred":
+            _prune_pending_interactions()
+            state_appcmd["map_pending"][interaction.id] = (
+                time.monotonic(),
+                interaction,
+                False,
+            )
+
         try:
             queue_from_bot.put(map_cmd, block=False)
         except queue.Full:
             log_event.error("Command input dropped: " "queue_from_bot is full.")
-        await interaction.followup.send("OK", ephemeral=True)
+        if str_ack == "followup":
+            await interaction.followup.send(str_text, ephemeral=True)
+
+    # -------------------------------------------------------------------------
+    async def _reply_to_appcmd(msg):
+        """
+        Reply to an application command acknowledged in deferred mode.
+
+        The first reply replaces the deferred
+        placeholder with a single edit of the
+        original response. Any further replies
+        to the same interaction are sent as
+        ephemeral followups.
+
+        """
+
+        _validate_message_data(msg)
+        msg.pop("type")
+        id_interaction = msg.pop("id_interaction")
+
+        _prune_pending_interactions()
+        map_pending = state_appcmd["map_pending"]
+        if id_interaction not in map_pending:
+            log_event.warning(
+                "Reply to unknown or expired interaction: {id}".format(
+                    id=id_interaction
+                )
+            )
+            return
+
+        (time_created, interaction, is_replied) = map_pending[id_interaction]
+        if "button" in msg and isinstance(msg["button"], ButtonData):
+            msg["view"] = _view_for_button(msg.pop("button"))
+
+        try:
+            if is_replied:
+                await interaction.followup.send(ephemeral=True, **msg)
+            else:
+                await interaction.edit_original_response(**msg)
+                map_pending[id_interaction] = (time_created, interaction, True)
+        except discord.DiscordException as err:
+            log_event.error("Failed to reply to appcmd: {err}".format(err=err))
+
+    # -------------------------------------------------------------------------
+    def _prune_pending_interactions():
+        """
+        Forget deferred interactions whose tokens have expired.
+
+        """
+
+        map_pending = state_appcmd["map_pending"]
+        time_expired = time.monotonic() - SECS_INTERACTION_TOKEN
+        while map_pending:
+            (time_created, _, _) = next(iter(map_pending.values()))
+            if time_created > time_expired:
+                break
+            map_pending.popitem(last=False)
 
     # Update the global callback register so that
     # on_appcmd can be called from generated code
@@ -557,14 +1453,13 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
     map_register["on_appcmd"] = on_appcmd
 
     # -------------------------------------------------------------------------
-    async def on_button(interaction, *args):
+    async def on_button(interaction, id_btn):
         """
         Generic button press callback.
 
         """
 
         await interaction.response.defer(ephemeral=True)
-        id_btn = interaction.data["custom_id"]
         log_event.debug("Button pressed: {id}".format(id=id_btn))
 
         map_cmd = dict(
@@ -580,23 +1475,187 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
             log_event.error("Button input dropped: queue_from_bot is full.")
 
     # =========================================================================
-    class ButtonView(discord.ui.View):
+    class ButtonDynamic(
+        discord.ui.DynamicItem[discord.ui.Button],
+        template=re.escape(PREFIX_BUTTON) + r"(?P<id_btn>.+)",
+    ):
+        """
+        A persistent button which is dispatched by custom_id pattern.
+
+        The class is registered once at startup,
+        so button presses are routed to on_button
+        without holding a view (or a view timeout
+        timer) in memory for each message that
+        has been sent. Buttons keep working after
+        a restart.
+
+        """
+
+        # ---------------------------------------------------------------------
+        def __init__(self, id_btn, label=None, style=discord.ButtonStyle.green):
+            """
+            Construct the button.
+
+            """
+
+            super().__init__(
+                discord.ui.Button(
+                    style=style, label=label, custom_id=PREFIX_BUTTON + id_btn
+                )
+            )
+            self.id_btn = id_btn
+
+        # ---------------------------------------------------------------------
+        @classmethod
+        async def from_custom_id(cls, interaction, item, match):
+            """
+            Construct the button from the custom_id of a pressed button.
+
+            """
+
+            return cls(id_btn=match["id_btn"], label=item.label, style=item.style)
+
+        # ---------------------------------------------------------------------
+        async def callback(self, interaction):
+            """
+            Forward the button press to on_button.
+
+            """
+
+            await on_button(interaction, self.id_btn)
+
+    bot.add_dynamic_items(ButtonDynamic)
+
+    # =========================================================================
+    class SharedMemoryReader(io.RawIOBase):
+        """
+        A seekable read-only file object over a shared memory segment.
+
+        Data is read directly from the segment
+        in chunks, so the attachment is never
+        materialised as a single bytes object.
+
+        """
+
+        # ---------------------------------------------------------------------
+        def __init__(self, shm, size):
+            """
+            Construct the reader.
+
+            """
+
+            super().__init__()
+            self._shm = shm
+            self._view = shm.buf[:size]
+            self._pos = 0
+
+        # ---------------------------------------------------------------------
+        def readable(self):
+            """
+            Return True. The reader is always readable.
+
+            """
+
+            return True
+
+        # ---------------------------------------------------------------------
+        def seekable(self):
+            """
+            Return True. The reader is always seekable.
+
+            """
+
+            return True
+
+        # ---------------------------------------------------------------------
+        def tell(self):
+            """
+            Return the current read position.
+
+            """
+
+            return self._pos
+
+        # ---------------------------------------------------------------------
+        def seek(self, offset, whence=io.SEEK_SET):
+            """
+            Change the read position and return the new position.
+
+            """
+
+            if whence == io.SEEK_SET:
+                pos = offset
+            elif whence == io.SEEK_CUR:
+                pos = self._pos + offset
+            elif whence == io.SEEK_END:
+                pos = len(self._view) + offset
+            else:
+                raise ValueError("Invalid whence: {val}".format(val=whence))
+            self._pos = max(0, pos)
+            return self._pos
+
+        # ---------------------------------------------------------------------
+        def readinto(self, buffer):
+            """
+            Read the next chunk of the segment into buffer.
+
+            """
+
+            with self._view[self._pos : self._pos + len(buffer)] as chunk:
+                size = len(chunk)
+                buffer[:size] = chunk
+            self._pos += size
+            return size
+
+        # ---------------------------------------------------------------------
+        def close(self):
+            """
+            Release the view and detach from the shared memory segment.
+
+            """
+
+            if not self.closed:
+                self._view.release()
+                self._shm.close()
+            super().close()
+
+    # -------------------------------------------------------------------------
+    def _open_file_ref(file_ref):
         """
-        A view containing a single button.
+        Return a discord.File and cleanup function for a FilePath or FileShm.
+
+        The cleanup function must be called once
+        the send has completed, successfully or
+        otherwise.
 
         """
 
+        if isinstance(file_ref, FileShm):
+            shm = multiprocessing.shared_memory.SharedMemory(name=file_ref.name_shm)
+            fp = SharedMemoryReader(shm=shm, size=file_ref.size)
+        else:
+            fp = file_ref.path
+
+        file = discord.File(
+            fp=fp,
+            filename=file_ref.filename,
+            spoiler=file_ref.spoiler,
+            description=file_ref.description,
+        )
+
         # ---------------------------------------------------------------------
-        def __init__(self, style, label, id_btn, callback, timeout=600):
+        def _cleanup():
             """
-            Construct the button view.
+            Close the file and release the underlying resources.
 
             """
 
-            super().__init__(timeout=timeout)
-            self.button = discord.ui.Button(style=style, label=label, custom_id=id_btn)
-            self.button.callback = callback
-            self.add_item(self.button)
+            file.close()
+            if isinstance(fp, SharedMemoryReader):
+                fp.close()
+            release_file(file_ref)
+
+        return (file, _cleanup)
 
     # -------------------------------------------------------------------------
     async def _send_message(state, msg):
@@ -666,6 +1725,14 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
         # in an in-memory buffer rather
         # than as a file handle.
         #
+        # Larger files can be passed by reference
+        # using the FilePath and FileShm named
+        # tuples instead. These are streamed to
+        # discord in chunks, and any temporary
+        # file or shared memory segment is
+        # released once the send has completed.
+        #
+        list_cleanup = list()
         if "file" in msg and isinstance(msg["file"], FileData):
             file_data = msg.pop("file")
             msg["file"] = discord.File(
@@ -674,21 +1741,358 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
                 spoiler=file_data.spoiler,
                 description=file_data.description,
             )
+        elif "file" in msg and isinstance(msg["file"], (FilePath, FileShm)):
+            file_ref = msg.pop("file")
+            try:
+                (msg["file"], fcn_cleanup) = _open_file_ref(file_ref)
+            except OSError as err:
+                log_event.error("Unable to open attachment: {err}".format(err=err))
+                release_file(file_ref)
+            else:
+                list_cleanup.append(fcn_cleanup)
 
         if "button" in msg and isinstance(msg["button"], ButtonData):
-            button_data = msg.pop("button")
-            msg["view"] = ButtonView(
-                style=discord.ButtonStyle.green,
-                label=button_data.label,
-                id_btn=button_data.id_btn,
-                callback=on_button,
+            msg["view"] = _view_for_button(msg.pop("button"))
+
+        try:
+            if maybe_user_or_channel is not None:
+                try:
+                    await maybe_user_or_channel.send(**msg)
+                except discord.DiscordException as err:
+                    log_event.error("Failed to send message: {err}".format(err=err))
+        finally:
+            for fcn_cleanup in list_cleanup:
+                fcn_cleanup()
+
+    # -------------------------------------------------------------------------
+    async def _send_to_thread(state, msg):
+        """
+        Deliver a message to a private thread, with DM fallback.
+
+        msg_thread items name a parent channel
+        and a key_thread (e.g. a session id)
+        which identifies the thread. The thread
+        is created on first use, users listed
+        in add_user are added to it (and those
+        in remove_user removed), and any other
+        fields are sent to the thread once, as
+        for a msg_guild item.
+
+        Users who cannot be added to the thread
+        are sent the optional fallback message
+        as a DM instead, and are sent anything
+        later posted to the thread as a DM too.
+        If the thread cannot be created, every
+        user falls back to DMs.
+
+        Messages which users post in the thread
+        are forwarded as msg_guild items, and
+        edits to them as edit_guild items, with
+        the key_thread of the thread.
+
+        """
+
+        _validate_message_data(msg)
+        msg.pop("type")
+        id_channel = msg.pop("id_channel")
+        key_thread = msg.pop("key_thread")
+        name_thread = msg.pop("name", None) or str(key_thread)
+        tup_id_add = tuple(msg.pop("add_user", ()))
+        tup_id_remove = tuple(msg.pop("remove_user", ()))
+        fallback = msg.pop("fallback", None)
+
+        if key_thread not in map_thread:
+            map_thread[key_thread] = dict(
+                thread=await _create_thread(state, id_channel, name_thread),
+                set_member=set(),
+                set_fallback=set(),
+            )
+        info_thread = map_thread[key_thread]
+        thread = info_thread["thread"]
+        if thread is not None:
+            map_key_thread[thread.id] = key_thread
+        set_member = info_thread["set_member"]
+        set_fallback = info_thread["set_fallback"]
+
+        # Add new members concurrently. Each add
+        # is a single call in a per-thread rate
+        # limit bucket, which is much cheaper
+        # than opening a DM channel per user.
+        #
+        list_id_new = list(
+            id_user
+            for id_user in dict.fromkeys(tup_id_add)
+            if id_user not in set_member and id_user not in set_fallback
+        )
+        list_id_fallback = list()
+        if thread is None:
+            list_id_fallback.extend(list_id_new)
+        else:
+            list_coro = list(
+                thread.add_user(discord.Object(id=id_user)) for id_user in list_id_new
+            )
+            list_result = await asyncio.gather(*list_coro, return_exceptions=True)
+            for id_user, result in zip(list_id_new, list_result):
+                if result is None:
+                    set_member.add(id_user)
+                elif isinstance(result, discord.DiscordException):
+                    log_event.warning(
+                        "Unable to add user {id} to thread: {err}".format(
+                            id=id_user, err=result
+                        )
+                    )
+                    list_id_fallback.append(id_user)
+                else:
+                    raise result
+        set_fallback.update(list_id_fallback)
+
+        for id_user in tup_id_remove:
+            set_fallback.discard(id_user)
+            if id_user not in set_member:
+                continue
+            set_member.discard(id_user)
+            try:
+                await thread.remove_user(discord.Object(id=id_user))
+            except discord.DiscordException as err:
+                log_event.warning(
+                    "Unable to remove user {id} from thread: {err}".format(
+                        id=id_user, err=err
+                    )
+                )
+
+        if fallback is not None:
+            for id_user in list_id_fallback:
+                await _send_message(
+                    state=state, msg=dict(fallback, type="msg_dm", id_user=id_user)
+                )
+
+        # Anything left in msg is a message to
+        # post. File references (FilePath and
+        # FileShm) are released after the first
+        # send, so only FileData attachments are
+        # repeated in fallback DMs.
+        #
+        if msg:
+            if thread is not None:
+                await _send_message(
+                    state=state, msg=dict(msg, type="msg_guild", id_channel=thread.id)
+                )
+            for id_user in sorted(set_fallback):
+                await _send_message(
+                    state=state, msg=dict(msg, type="msg_dm", id_user=id_user)
+                )
+
+    # -------------------------------------------------------------------------
+    async def _create_thread(state, id_channel, name_thread):
+        """
+        Return a new private thread in the specified channel, or None.
+
+        """
+
+        map_channel = state["map_channel"]
+        try:
+            if map_channel.get(id_channel, None) is None:
+                map_channel[id_channel] = await bot.fetch_channel(id_channel)
+            channel = map_channel[id_channel]
+            if not isinstance(channel, discord.TextChannel):
+                raise ValueError(
+                    "Channel {id} does not support threads.".format(id=id_channel)
+                )
+            thread = await channel.create_thread(
+                name=name_thread[:100],
+                type=discord.ChannelType.private_thread,
+                invitable=False,
+            )
+        except (discord.DiscordException, ValueError) as err:
+            log_event.error("Unable to create thread: {err}".format(err=err))
+            return None
+
+        map_channel[thread.id] = thread
+        return thread
+
+    # -------------------------------------------------------------------------
+    async def _send_to_stream(state, msg):
+        """
+        Send, or progressively edit, a message whose text is still arriving.
+
+        msg_stream items carry all of the text
+        so far for the stream named by
+        key_stream, with a destination: id_user
+        for a DM, id_channel for a channel, or
+        key_thread for a thread created by an
+        earlier msg_thread item.
+
+        The first item for a stream is sent at
+        once, with a placeholder if there is no
+        text yet. Later items are coalesced, so
+        that each stream is edited at most once
+        every secs_stream_edit, which keeps well
+        within the discord rate limit for edits.
+        The item with is_final set is always
+        applied at once, after which the stream
+        is forgotten.
+
+        Text which is too long for one message
+        continues in further messages. Users who
+        could not be added to a key_thread
+        thread are sent the final text as DMs.
+
+        key_thread items may also carry the
+        id_channel and add_user fields of a
+        msg_thread item. If the thread is not
+        known, for example because the item
+        which should have created it failed,
+        these are used to create it as for a
+        msg_thread item. Without id_channel,
+        the add_user users are sent the final
+        text as DMs instead.
+
+        """
+
+        _validate_message_data(msg)
+        key_stream = msg["key_stream"]
+        if key_stream not in map_stream:
+            (target, tup_id_fallback) = await _stream_target(state, msg)
+            map_stream[key_stream] = dict(
+                target=target,
+                fallback=tup_id_fallback,
+                list_message=list(),
+                list_sent=list(),
+                content="",
+                content_sent=None,
+                is_final=False,
+                time_edit=0.0,
+            )
+        info_stream = map_stream[key_stream]
+        info_stream["content"] = msg.get("content", None) or ""
+        info_stream["is_final"] = bool(msg.get("is_final", False))
+        if info_stream["content_sent"] is None or info_stream["is_final"]:
+            await _edit_stream(state, key_stream)
+
+    # -------------------------------------------------------------------------
+    async def _flush_streams(state):
+        """
+        Apply pending edits to streamed messages which are due.
+
+        """
+
+        secs_edit = cfg_bot.get("secs_stream_edit", 1.0)
+        time_now = time.monotonic()
+        for key_stream, info_stream in list(map_stream.items()):
+            if info_stream["content"] == info_stream["content_sent"]:
+                continue
+            if time_now - info_stream["time_edit"] < secs_edit:
+                continue
+            await _edit_stream(state, key_stream)
+
+    # -------------------------------------------------------------------------
+    async def _stream_target(state, msg):
+        """
+        Return the channel or user for a msg_stream item and any fallback users.
+
+        """
+
+        try:
+            key_thread = msg.get("key_thread", None)
+            if key_thread is not None:
+                tup_id_user = tuple(msg.get("add_user", ()))
+                if key_thread not in map_thread and msg.get("id_channel", None):
+                    await _send_to_thread(
+                        state=state,
+                        msg=dict(
+                            type="msg_thread",
+                            id_channel=msg["id_channel"],
+                            key_thread=key_thread,
+                            add_user=tup_id_user,
+                        ),
+                    )
+                info_thread = map_thread.get(key_thread, None)
+                if info_thread is None and tup_id_user:
+                    return (None, tup_id_user)
+                if info_thread is None:
+                    raise ValueError("Unknown thread: {key}".format(key=key_thread))
+                return (info_thread["thread"], tuple(info_thread["set_fallback"]))
+
+            if msg.get("id_user", None) is not None:
+                map_user = state["map_user"]
+                if map_user.get(msg["id_user"], None) is None:
+                    map_user[msg["id_user"]] = await bot.fetch_user(msg["id_user"])
+                return (map_user[msg["id_user"]], ())
+
+            map_channel = state["map_channel"]
+            if map_channel.get(msg["id_channel"], None) is None:
+                map_channel[msg["id_channel"]] = await bot.fetch_channel(
+                    msg["id_channel"]
+                )
+            return (map_channel[msg["id_channel"]], ())
+
+        except (discord.DiscordException, KeyError, ValueError) as err:
+            log_event.error(
+                "Unable to find destination for stream {key}: {err}".format(
+                    key=msg["key_stream"], err=err
+                )
             )
+            return (None, ())
 
-        if maybe_user_or_channel is not None:
+    # -------------------------------------------------------------------------
+    async def _edit_stream(state, key_stream):
+        """
+        Bring the messages for a stream up to date with its text.
+
+        """
+
+        info_stream = map_stream[key_stream]
+        content = info_stream["content"]
+        list_chunk = list(
+            content[idx : idx + COUNT_CHAR_MSG]
+            for idx in range(0, len(content), COUNT_CHAR_MSG)
+        ) or [cfg_bot.get("str_stream_placeholder", "...")]
+
+        target = info_stream["target"]
+        list_message = info_stream["list_message"]
+        list_sent = info_stream["list_sent"]
+        info_stream["time_edit"] = time.monotonic()
+        info_stream["content_sent"] = content
+        if target is not None:
             try:
-                await maybe_user_or_channel.send(**msg)
+                for idx, chunk in enumerate(list_chunk):
+                    if idx >= len(list_message):
+                        list_message.append(await target.send(content=chunk))
+                        list_sent.append(chunk)
+                    elif list_sent[idx] != chunk:
+                        await list_message[idx].edit(content=chunk)
+                        list_sent[idx] = chunk
             except discord.DiscordException as err:
-                log_event.error("Failed to send message: {err}".format(err=err))
+                log_event.error(
+                    "Failed to update streamed message: {err}".format(err=err)
+                )
+
+        if info_stream["is_final"]:
+            del map_stream[key_stream]
+            for id_user in info_stream["fallback"]:
+                for chunk in list_chunk:
+                    await _send_message(
+                        state=state,
+                        msg=dict(type="msg_dm", id_user=id_user, content=chunk),
+                    )
+
+    # -------------------------------------------------------------------------
+    def _view_for_button(button_data):
+        """
+        Return a view containing a persistent button for button_data.
+
+        """
+
+        view = discord.ui.View(timeout=None)
+        view.add_item(ButtonDynamic(id_btn=button_data.id_btn, label=button_data.label))
+
+        # Stop the view before it is sent so that
+        # discord.py does not keep it in the view
+        # store. Presses are dispatched via the
+        # ButtonDynamic template instead.
+        #
+        view.stop()
+        return view
 
     # -------------------------------------------------------------------------
     def _validate_message_data(msg):
@@ -759,6 +2163,12 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
         if message.content.startswith(PREFIX_COMMAND):
             return
 
+        if not _is_forwarded(message):
+            map_log_metric["count_msg_filtered"] = (
+                map_log_metric.get("count_msg_filtered", 0) + 1
+            )
+            return
+
         if isinstance(message.channel, discord.DMChannel):
             item = dict(
                 type="msg_dm",
@@ -779,32 +2189,47 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
                 name_channel=message.channel.name,
                 content=message.content,
             )
+            key_thread = map_key_thread.get(message.channel.id, None)
+            if key_thread is not None:
+                item["key_thread"] = key_thread
             log_event.info('Guild message: "{txt}"'.format(txt=message.content))
 
         try:
             queue_from_bot.put(item, block=False)
         except queue.Full:
             log_event.error("Message dropped. queue_from_bot is full.")
+        else:
+            if message.author.id not in state_filter["set_id_user"]:
+                return
+            is_dm = item["type"] == "msg_dm"
+            index_msg.add(
+                message.id,
+                TrackedMessage(
+                    id_author=message.author.id,
+                    name_author=message.author.name,
+                    id_channel=message.channel.id,
+                    name_channel=None if is_dm else message.channel.name,
+                    is_dm=is_dm,
+                ),
+            )
 
     # -------------------------------------------------------------------------
     @bot.event
-    async def on_message_edit(msg_before, msg_after):
+    async def on_raw_message_edit(payload):
         """
-        Handle message-edits that are sent to the client.
+        Handle raw message-edit events that are sent to the client.
 
         This coroutine is invoked
         whenever a message receives
-        an update event. If the
-        message is not found in the
-        internal message cache, then
-        these events will not be
-        called.
-
-        Messages might not be in
-        cache if the message is
-        too old or the client is
-        participating in high
-        traffic guilds.
+        an update event, regardless
+        of the state of the internal
+        message cache.
+
+        Only edits to messages which
+        were previously forwarded by
+        on_message, and which are
+        still in the tracked message
+        index, are handled.
 
         This coroutine is intended to
         simply forward the content of
@@ -814,35 +2239,48 @@ def _discord_bot(cfg_bot, queue_to_bot, queue_from_bot):
 
         """
 
-        if msg_after.author.bot:
+        record = index_msg.get(payload.message_id)
+        if record is None:
+            return
+
+        # Updates which do not change the
+        # content, such as embeds being
+        # resolved, have no content field.
+        #
+        content = payload.data.get("content", None)
+        if content is None:
             return
 
-        if msg_after.content.startswith(PREFIX_COMMAND):
+        if content.startswith(PREFIX_COMMAND):
             return
 
-        if isinstance(msg_before.channel, discord.DMChannel):
+        if record.is_dm:
             item = dict(
                 type="edit_dm",
-                id_prev=msg_before.id,
-                id_msg=msg_after.id,
-                id_author=msg_after.author.id,
-                name_author=msg_after.author.name,
-                content=msg_after.content,
+                id_prev=payload.message_id,
+                id_msg=payload.message_id,
+                id_author=record.id_author,
+                name_author=record.name_author,
+                content=content,
             )
-            log_event.info('DM edit: "{txt}"'.format(txt=msg_after.content))
+            log_event.info('DM edit: "{txt}"'.format(txt=content))
         else:
+            map_member = payload.data.get("member", None) or dict()
             item = dict(
                 type="edit_guild",
-                id_prev=msg_before.id,
-                id_msg=msg_after.id,
-                id_author=msg_after.author.id,
-                name_author=msg_after.author.name,
-                nick_author=msg_after.author.nick,
-                id_channel=msg_after.channel.id,
-                name_channel=msg_after.channel.name,
-                content=msg_after.content,
+                id_prev=payload.message_id,
+                id_msg=payload.message_id,
+                id_author=record.id_author,
+                name_author=record.name_author,
+                nick_author=map_member.get("nick", None),
+                id_channel=record.id_channel,
+                name_channel=record.name_channel,
+                content=content,
             )
-            log_event.info('Guild msg edit: "{txt}"'.format(txt=msg_after.content))
+            key_thread = map_key_thread.get(record.id_channel, None)
+            if key_thread is not None:
+                item["key_thread"] = key_thread
+            log_event.info('Guild msg edit: "{txt}"'.format(txt=content))
 
         try:
             queue_from_bot.put(item, block=False)
@@ -0,0 +1,1338 @@
+import argparse
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import random
+import re
+import socket
+import statistics
+import threading
+import time
+
+import aiohttp
+import aiohttp.web
+
+import fl.net.discord.bot
+
+
+EPOCH_DISCORD_MS = 1420070400000
+PERMISSIONS_ALL = str((1 << 47) - 1)
+SECS_HEARTBEAT = 41.25
+COUNT_MESSAGE_MAX = 100000
+
+# REST routes implemented by the simulator.
+#
+# Each entry is (method, path regex, handler
+# name). The first named group in each path,
+# if any, is the major parameter used to key
+# the rate limit bucket, as it is on the real
+# discord API.
+#
+TUP_ROUTE = (
+    ("GET", r"/users/@me", "_rest_get_me"),
+    ("GET", r"/gateway(?:/bot)?", "_rest_get_gateway"),
+    ("GET", r"/oauth2/applications/@me", "_rest_get_application"),
+    ("GET", r"/users/(?P<id_user>\d+)", "_rest_get_user"),
+    ("POST", r"/users/@me/channels", "_rest_create_dm"),
+    ("GET", r"/channels/(?P<id_channel>\d+)", "_rest_get_channel"),
+    ("POST", r"/channels/(?P<id_channel>\d+)/messages", "_rest_create_message"),
+    (
+        "PATCH",
+        r"/channels/(?P<id_channel>\d+)/messages/(?P<id_msg>\d+)",
+        "_rest_edit_message",
+    ),
+    ("POST", r"/channels/(?P<id_channel>\d+)/threads", "_rest_create_thread"),
+    (
+        "PUT",
+        r"/channels/(?P<id_channel>\d+)/thread-members/(?P<id_user>\d+)",
+        "_rest_add_thread_member",
+    ),
+    (
+        "DELETE",
+        r"/channels/(?P<id_channel>\d+)/thread-members/(?P<id_user>\d+)",
+        "_rest_no_content",
+    ),
+    (
+        "POST",
+        r"/interactions/(?P<id_interaction>\d+)/(?P<token>[^/]+)/callback",
+        "_rest_interaction_callback",
+    ),
+    ("POST", r"/webhooks/(?P<id_app>\d+)/(?P<token>[^/]+)", "_rest_create_followup"),
+    (
+        "PATCH",
+        r"/webhooks/(?P<id_app>\d+)/(?P<token>[^/]+)/messages/(?P<id_msg>[^/]+)",
+        "_rest_edit_followup",
+    ),
+    (
+        "PUT",
+        r"/applications/(?P<id_app>\d+)(?:/guilds/\d+)?/commands",
+        "_rest_sync_commands",
+    ),
+)
+
+
+# =============================================================================
+class Simulator:
+    """
+    Local stand-in for the discord gateway and REST API.
+
+    The simulator implements just enough of
+    the gateway protocol (hello, identify,
+    heartbeat and dispatch) and of the REST
+    API (users, channels, messages, threads,
+    interaction responses and followups) for
+    fl.net.discord.bot to log in, receive
+    messages, app commands and button presses,
+    and send messages.
+
+    Every REST response carries rate limit
+    headers, and requests beyond count_limit
+    per secs_window in a bucket get a 429.
+
+    The simulator runs its own event loop in
+    a daemon thread. The inject_* methods may
+    be called from any thread.
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(
+        self,
+        count_guild=1,
+        count_channel=4,
+        count_limit=50,
+        secs_window=1.0,
+        host="127.0.0.1",
+    ):
+        """
+        Construct the simulator and its guilds and channels.
+
+        """
+
+        self.host = host
+        self.port = None
+        self.count_limit = count_limit
+        self.secs_window = secs_window
+
+        self._iter_snowflake = itertools.count()
+        self.id_app = self._snowflake()
+        self.id_owner = self._snowflake()
+        self.user_bot = _payload_user(self.id_app, "simbot", is_bot=True)
+
+        self.map_user = dict()  # id_user -> user payload
+        self.map_guild = dict()  # id_guild -> guild payload
+        self.map_channel = dict()  # id_channel -> channel payload
+        self.map_dm = dict()  # id_user -> id_channel
+        self.map_message = collections.OrderedDict()  # id_msg -> message payload
+        self.map_bucket = dict()  # key_bucket -> [count_remaining, time_reset]
+        self.set_id_user_blocked = set()  # users who cannot join threads
+
+        # Metrics. These are written from the
+        # simulator thread and may be read from
+        # any thread.
+        #
+        self.count_rest = collections.Counter()  # handler name -> count
+        self.count_429 = 0
+        self.map_nonce = dict()  # nonce -> (time_rx, id_msg)
+
+        self.list_id_channel = list()
+        for idx_guild in range(count_guild):
+            id_guild = self._snowflake()
+            list_channel = list()
+            for idx_channel in range(count_channel):
+                id_channel = self._snowflake()
+                channel = _payload_channel_text(
+                    id_channel, id_guild, "channel-{idx}".format(idx=idx_channel)
+                )
+                self.map_channel[id_channel] = channel
+                self.list_id_channel.append(id_channel)
+                list_channel.append(channel)
+            self.map_guild[id_guild] = _payload_guild(
+                id_guild=id_guild,
+                name="guild-{idx}".format(idx=idx_guild),
+                id_owner=self.id_owner,
+                list_channel=list_channel,
+                list_member=[_payload_member(self.user_bot)],
+            )
+
+        self.list_route = list(
+            (str_method, re.compile(str_path), name_handler)
+            for (str_method, str_path, name_handler) in TUP_ROUTE
+        )
+        self.set_queue_tx = set()
+        self.set_ws = set()
+        self.loop = None
+        self.event_started = threading.Event()
+        self.event_identified = threading.Event()
+        self._iter_seq = itertools.count(start=1)
+        self._thread = None
+        self._event_stop = None
+
+    # -------------------------------------------------------------------------
+    @property
+    def url_api(self):
+        """
+        Return the base URL for the REST API.
+
+        """
+
+        return "http://{host}:{port}/api/v10".format(host=self.host, port=self.port)
+
+    # -------------------------------------------------------------------------
+    @property
+    def url_gateway(self):
+        """
+        Return the URL for the gateway.
+
+        """
+
+        return "ws://{host}:{port}/gateway".format(host=self.host, port=self.port)
+
+    # -------------------------------------------------------------------------
+    def start(self):
+        """
+        Start the simulator in a daemon thread and wait until it is serving.
+
+        """
+
+        self._thread = threading.Thread(
+            target=self._run, name="discord-sim", daemon=True
+        )
+        self._thread.start()
+        self.event_started.wait()
+        return self
+
+    # -------------------------------------------------------------------------
+    def stop(self):
+        """
+        Stop the simulator.
+
+        """
+
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._event_stop.set)
+            self._thread.join()
+
+    # -------------------------------------------------------------------------
+    def user(self, id_user):
+        """
+        Return the payload for the specified user, creating it if needed.
+
+        """
+
+        try:
+            return self.map_user[id_user]
+        except KeyError:
+            user = _payload_user(id_user, "user-{id}".format(id=id_user))
+            self.map_user[id_user] = user
+            return user
+
+    # -------------------------------------------------------------------------
+    def inject_dm(self, id_user, content):
+        """
+        Dispatch a direct message from the specified user. Return its id.
+
+        """
+
+        id_channel = self._ensure_dm(id_user)
+        message = self._payload_message(
+            id_channel=id_channel, author=self.user(id_user), content=content
+        )
+        self._dispatch_threadsafe("MESSAGE_CREATE", message)
+        return int(message["id"])
+
+    # -------------------------------------------------------------------------
+    def inject_guild_message(self, id_user, id_channel, content):
+        """
+        Dispatch a guild message from the specified user. Return its id.
+
+        """
+
+        message = self._payload_message(
+            id_channel=id_channel, author=self.user(id_user), content=content
+        )
+        self._dispatch_threadsafe("MESSAGE_CREATE", message)
+        return int(message["id"])
+
+    # -------------------------------------------------------------------------
+    def inject_message_edit(self, id_msg, content):
+        """
+        Dispatch an edit to a previously injected message.
+
+        """
+
+        message = dict(self.map_message[id_msg])
+        message["content"] = content
+        message["edited_timestamp"] = _timestamp()
+        self._dispatch_threadsafe("MESSAGE_UPDATE", message)
+
+    # -------------------------------------------------------------------------
+    def inject_appcmd(self, id_user, name_command, map_option, id_channel=None):
+        """
+        Dispatch an application command invocation from the specified user.
+
+        If id_channel is None, the command is
+        invoked from a direct message channel.
+
+        """
+
+        if id_channel is None:
+            id_channel = self._ensure_dm(id_user)
+        data = dict(
+            id=str(self._snowflake()),
+            name=name_command,
+            type=1,
+            options=list(
+                dict(name=name, type=3, value=value)
+                for (name, value) in map_option.items()
+            ),
+        )
+        interaction = self._payload_interaction(
+            type_interaction=2, data=data, id_user=id_user, id_channel=id_channel
+        )
+        self._dispatch_threadsafe("INTERACTION_CREATE", interaction)
+        return int(interaction["id"])
+
+    # -------------------------------------------------------------------------
+    def inject_button(self, id_user, id_msg, idx_button=0):
+        """
+        Dispatch a button press on a message sent by the bot.
+
+        """
+
+        message = self.map_message[id_msg]
+        list_button = list(
+            component
+            for row in message.get("components", ())
+            for component in row.get("components", ())
+        )
+        data = dict(custom_id=list_button[idx_button]["custom_id"], component_type=2)
+        interaction = self._payload_interaction(
+            type_interaction=3,
+            data=data,
+            id_user=id_user,
+            id_channel=int(message["channel_id"]),
+            message=message,
+        )
+        self._dispatch_threadsafe("INTERACTION_CREATE", interaction)
+        return int(interaction["id"])
+
+    # -------------------------------------------------------------------------
+    def _snowflake(self):
+        """
+        Return a new unique snowflake id.
+
+        """
+
+        ms_since_epoch = int(time.time() * 1000) - EPOCH_DISCORD_MS
+        return (ms_since_epoch << 22) | (next(self._iter_snowflake) & 0x3FFFFF)
+
+    # -------------------------------------------------------------------------
+    def _ensure_dm(self, id_user):
+        """
+        Return the id of the DM channel for the specified user.
+
+        """
+
+        try:
+            return self.map_dm[id_user]
+        except KeyError:
+            id_channel = self._snowflake()
+            self.map_channel[id_channel] = dict(
+                id=str(id_channel),
+                type=1,
+                recipients=[self.user(id_user)],
+                last_message_id=None,
+            )
+            self.map_dm[id_user] = id_channel
+            return id_channel
+
+    # -------------------------------------------------------------------------
+    def _payload_message(
+        self, id_channel, author, content, components=None, nonce=None
+    ):
+        """
+        Return a new message payload and remember it.
+
+        """
+
+        channel = self.map_channel[id_channel]
+        message = dict(
+            id=str(self._snowflake()),
+            channel_id=str(id_channel),
+            author=author,
+            content=content,
+            timestamp=_timestamp(),
+            edited_timestamp=None,
+            tts=False,
+            mention_everyone=False,
+            mentions=[],
+            mention_roles=[],
+            attachments=[],
+            embeds=[],
+            pinned=False,
+            type=0,
+            flags=0,
+            components=components or [],
+        )
+        if nonce is not None:
+            message["nonce"] = nonce
+        if "guild_id" in channel:
+            message["guild_id"] = channel["guild_id"]
+            message["member"] = _payload_member(author)
+
+        self.map_message[int(message["id"])] = message
+        if len(self.map_message) > COUNT_MESSAGE_MAX:
+            self.map_message.popitem(last=False)
+        return message
+
+    # -------------------------------------------------------------------------
+    def _payload_interaction(
+        self, type_interaction, data, id_user, id_channel, message=None
+    ):
+        """
+        Return a new interaction payload.
+
+        """
+
+        id_interaction = self._snowflake()
+        channel = self.map_channel[id_channel]
+        user = self.user(id_user)
+        interaction = dict(
+            id=str(id_interaction),
+            application_id=str(self.id_app),
+            type=type_interaction,
+            data=data,
+            token="token-{id}".format(id=id_interaction),
+            version=1,
+            locale="en-US",
+            app_permissions=PERMISSIONS_ALL,
+            channel_id=str(id_channel),
+            channel=channel,
+            entitlements=[],
+        )
+        if "guild_id" in channel:
+            interaction["guild_id"] = channel["guild_id"]
+            interaction["guild_locale"] = "en-US"
+            interaction["member"] = _payload_member(user)
+        else:
+            interaction["user"] = user
+        if message is not None:
+            interaction["message"] = message
+        return interaction
+
+    # -------------------------------------------------------------------------
+    def _dispatch_threadsafe(self, str_event, data):
+        """
+        Dispatch a gateway event from any thread.
+
+        """
+
+        self.loop.call_soon_threadsafe(self._dispatch, str_event, data)
+
+    # -------------------------------------------------------------------------
+    def _dispatch(self, str_event, data, set_queue_tx=None):
+        """
+        Dispatch a gateway event to all identified connections.
+
+        """
+
+        str_frame = json.dumps(dict(op=0, t=str_event, s=next(self._iter_seq), d=data))
+        for queue_tx in set_queue_tx or self.set_queue_tx:
+            queue_tx.put_nowait(str_frame)
+
+    # -------------------------------------------------------------------------
+    def _run(self):
+        """
+        Run the simulator event loop. This is the thread entry point.
+
+        """
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._serve())
+        self.loop.close()
+
+    # -------------------------------------------------------------------------
+    async def _serve(self):
+        """
+        Serve the gateway and REST API until stopped.
+
+        """
+
+        self._event_stop = asyncio.Event()
+        app = aiohttp.web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/gateway", self._handle_gateway)
+        app.router.add_route("*", "/api/v10/{path:.*}", self._handle_rest)
+        app.on_shutdown.append(self._close_gateway)
+
+        runner = aiohttp.web.AppRunner(app, access_log=None)
+        await runner.setup()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((self.host, 0))
+        self.port = sock.getsockname()[1]
+        site = aiohttp.web.SockSite(runner, sock)
+        await site.start()
+        self.event_started.set()
+
+        await self._event_stop.wait()
+        await runner.cleanup()
+
+    # -------------------------------------------------------------------------
+    async def _handle_gateway(self, request):
+        """
+        Handle a gateway websocket connection.
+
+        """
+
+        ws = aiohttp.web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        self.set_ws.add(ws)
+
+        queue_tx = asyncio.Queue()
+        task_tx = asyncio.create_task(_send_frames(ws, queue_tx))
+        queue_tx.put_nowait(
+            json.dumps(
+                dict(op=10, d=dict(heartbeat_interval=int(SECS_HEARTBEAT * 1000)))
+            )
+        )
+
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                frame = json.loads(msg.data)
+                op = frame.get("op", None)
+
+                # Heartbeat.
+                #
+                if op == 1:
+                    queue_tx.put_nowait(json.dumps(dict(op=11)))
+
+                # Identify.
+                #
+                elif op == 2:
+                    self._dispatch("READY", self._payload_ready(), {queue_tx})
+                    for guild in self.map_guild.values():
+                        self._dispatch("GUILD_CREATE", guild, {queue_tx})
+                    self.set_queue_tx.add(queue_tx)
+                    self.event_identified.set()
+
+                # Resume. We do not keep session
+                # state, so ask the client to
+                # identify again.
+                #
+                elif op == 6:
+                    queue_tx.put_nowait(json.dumps(dict(op=9, d=False)))
+
+        finally:
+            self.set_ws.discard(ws)
+            self.set_queue_tx.discard(queue_tx)
+            task_tx.cancel()
+
+        return ws
+
+    # -------------------------------------------------------------------------
+    async def _close_gateway(self, app):
+        """
+        Close all gateway connections so that shutdown does not wait on them.
+
+        """
+
+        for ws in list(self.set_ws):
+            await ws.close(code=aiohttp.WSCloseCode.GOING_AWAY)
+
+    # -------------------------------------------------------------------------
+    def _payload_ready(self):
+        """
+        Return the payload for the READY event.
+
+        """
+
+        return dict(
+            v=10,
+            user=self.user_bot,
+            guilds=list(
+                dict(id=guild["id"], unavailable=True)
+                for guild in self.map_guild.values()
+            ),
+            session_id="session-{id}".format(id=self._snowflake()),
+            resume_gateway_url=self.url_gateway,
+            application=dict(id=str(self.id_app), flags=0),
+        )
+
+    # -------------------------------------------------------------------------
+    async def _handle_rest(self, request):
+        """
+        Route a REST API request to its handler, applying rate limits.
+
+        """
+
+        str_path = "/" + request.match_info["path"]
+        for str_method, regex_path, name_handler in self.list_route:
+            if request.method != str_method:
+                continue
+            match = regex_path.fullmatch(str_path)
+            if match is None:
+                continue
+            break
+        else:
+            return _json_response(dict(message="404: Not Found", code=0), status=404)
+
+        tup_major = match.groups()[:1]
+        key_bucket = (str_method, regex_path.pattern) + tup_major
+        (is_limited, map_header) = self._take_token(key_bucket)
+        if is_limited:
+            self.count_429 += 1
+            map_header["Retry-After"] = map_header["X-RateLimit-Reset-After"]
+            map_header["X-RateLimit-Scope"] = "user"
+            map_header["Via"] = "1.1 simulator"
+            return _json_response(
+                dict(
+                    message="You are being rate limited.",
+                    retry_after=float(map_header["X-RateLimit-Reset-After"]),
+                    code=0,
+                    **{"global": False}
+                ),
+                status=429,
+                headers=map_header,
+            )
+
+        self.count_rest[name_handler] += 1
+        body = await _read_body(request)
+        (status, data) = getattr(self, name_handler)(body, **match.groupdict())
+        if data is None:
+            return aiohttp.web.Response(status=status, headers=map_header)
+        return _json_response(data, status=status, headers=map_header)
+
+    # -------------------------------------------------------------------------
+    def _take_token(self, key_bucket):
+        """
+        Take a request token from the bucket. Return (is_limited, headers).
+
+        """
+
+        time_now = time.time()
+        bucket = self.map_bucket.get(key_bucket, None)
+        if bucket is None or time_now >= bucket[1]:
+            bucket = [self.count_limit, time_now + self.secs_window]
+            self.map_bucket[key_bucket] = bucket
+
+        is_limited = bucket[0] <= 0
+        if not is_limited:
+            bucket[0] -= 1
+
+        map_header = {
+            "X-RateLimit-Limit": str(self.count_limit),
+            "X-RateLimit-Remaining": str(bucket[0]),
+            "X-RateLimit-Reset": "{:.3f}".format(bucket[1]),
+            "X-RateLimit-Reset-After": "{:.3f}".format(max(0.0, bucket[1] - time_now)),
+            "X-RateLimit-Bucket": "{:016x}".format(hash(key_bucket) & (2**64 - 1)),
+        }
+        return (is_limited, map_header)
+
+    # -------------------------------------------------------------------------
+    def _rest_get_me(self, body):
+        """
+        GET /users/@me
+
+        """
+
+        return (200, self.user_bot)
+
+    # -------------------------------------------------------------------------
+    def _rest_get_gateway(self, body):
+        """
+        GET /gateway and GET /gateway/bot
+
+        """
+
+        return (
+            200,
+            dict(
+                url=self.url_gateway,
+                shards=1,
+                session_start_limit=dict(
+                    total=1000, remaining=1000, reset_after=0, max_concurrency=1
+                ),
+            ),
+        )
+
+    # -------------------------------------------------------------------------
+    def _rest_get_application(self, body):
+        """
+        GET /oauth2/applications/@me
+
+        """
+
+        return (
+            200,
+            dict(
+                id=str(self.id_app),
+                name="simbot",
+                icon=None,
+                description="",
+                bot_public=True,
+                bot_require_code_grant=False,
+                owner=self.user(self.id_owner),
+                verify_key="",
+                flags=0,
+            ),
+        )
+
+    # -------------------------------------------------------------------------
+    def _rest_get_user(self, body, id_user):
+        """
+        GET /users/{id_user}
+
+        """
+
+        return (200, self.user(int(id_user)))
+
+    # -------------------------------------------------------------------------
+    def _rest_create_dm(self, body):
+        """
+        POST /users/@me/channels
+
+        """
+
+        id_channel = self._ensure_dm(int(body["recipient_id"]))
+        return (200, self.map_channel[id_channel])
+
+    # -------------------------------------------------------------------------
+    def _rest_get_channel(self, body, id_channel):
+        """
+        GET /channels/{id_channel}
+
+        """
+
+        try:
+            return (200, self.map_channel[int(id_channel)])
+        except KeyError:
+            return (404, dict(message="Unknown Channel", code=10003))
+
+    # -------------------------------------------------------------------------
+    def _rest_create_message(self, body, id_channel):
+        """
+        POST /channels/{id_channel}/messages
+
+        """
+
+        if int(id_channel) not in self.map_channel:
+            return (404, dict(message="Unknown Channel", code=10003))
+
+        nonce = body.get("nonce", None)
+        message = self._payload_message(
+            id_channel=int(id_channel),
+            author=self.user_bot,
+            content=body.get("content", None) or "",
+            components=body.get("components", None),
+            nonce=nonce,
+        )
+        if nonce is not None:
+            self.map_nonce[str(nonce)] = (time.perf_counter(), int(message["id"]))
+        return (200, message)
+
+    # -------------------------------------------------------------------------
+    def _rest_edit_message(self, body, id_channel, id_msg):
+        """
+        PATCH /channels/{id_channel}/messages/{id_msg}
+
+        """
+
+        try:
+            message = self.map_message[int(id_msg)]
+        except KeyError:
+            return (404, dict(message="Unknown Message", code=10008))
+
+        for key in ("content", "components", "embeds"):
+            if key in body:
+                message[key] = body[key]
+        message["edited_timestamp"] = _timestamp()
+        return (200, message)
+
+    # -------------------------------------------------------------------------
+    def _rest_create_thread(self, body, id_channel):
+        """
+        POST /channels/{id_channel}/threads
+
+        """
+
+        try:
+            channel_parent = self.map_channel[int(id_channel)]
+        except KeyError:
+            return (404, dict(message="Unknown Channel", code=10003))
+
+        id_thread = self._snowflake()
+        thread = dict(
+            id=str(id_thread),
+            type=body.get("type", 12),
+            guild_id=channel_parent["guild_id"],
+            parent_id=channel_parent["id"],
+            owner_id=str(self.id_app),
+            name=body.get("name", "thread"),
+            last_message_id=None,
+            rate_limit_per_user=0,
+            message_count=0,
+            member_count=1,
+            thread_metadata=dict(
+                archived=False,
+                auto_archive_duration=body.get("auto_archive_duration", 1440),
+                archive_timestamp=_timestamp(),
+                locked=False,
+                invitable=body.get("invitable", False),
+            ),
+        )
+        self.map_channel[id_thread] = thread
+
+        # As on discord, the new thread is sent
+        # to the client, and is listed in its
+        # guild when the client identifies again.
+        #
+        guild = self.map_guild[int(channel_parent["guild_id"])]
+        guild["threads"].append(thread)
+        self._dispatch("THREAD_CREATE", dict(thread, newly_created=True))
+        return (201, thread)
+
+    # -------------------------------------------------------------------------
+    def _rest_add_thread_member(self, body, id_channel, id_user):
+        """
+        PUT /channels/{id_channel}/thread-members/{id_user}
+
+        Users in set_id_user_blocked cannot be
+        added, so that DM fallback paths can be
+        exercised.
+
+        """
+
+        if int(id_user) in self.set_id_user_blocked:
+            return (403, dict(message="Missing Access", code=50001))
+        return (204, None)
+
+    # -------------------------------------------------------------------------
+    def _rest_no_content(self, body, **kwargs):
+        """
+        Respond with 204 No Content.
+
+        """
+
+        return (204, None)
+
+    # -------------------------------------------------------------------------
+    def _rest_interaction_callback(self, body, id_interaction, token):
+        """
+        POST /interactions/{id_interaction}/{token}/callback
+
+        """
+
+        return (204, None)
+
+    # -------------------------------------------------------------------------
+    def _rest_create_followup(self, body, id_app, token):
+        """
+        POST /webhooks/{id_app}/{token}
+
+        """
+
+        message = dict(
+            id=str(self._snowflake()),
+            channel_id=str(self.list_id_channel[0]),
+            author=self.user_bot,
+            content=body.get("content", None) or "",
+            timestamp=_timestamp(),
+            edited_timestamp=None,
+            tts=False,
+            mention_everyone=False,
+            mentions=[],
+            mention_roles=[],
+            attachments=[],
+            embeds=[],
+            pinned=False,
+            type=0,
+            flags=body.get("flags", 0),
+            components=body.get("components", None) or [],
+            webhook_id=str(id_app),
+        )
+        return (200, message)
+
+    # -------------------------------------------------------------------------
+    def _rest_edit_followup(self, body, id_app, token, id_msg):
+        """
+        PATCH /webhooks/{id_app}/{token}/messages/{id_msg}
+
+        """
+
+        return self._rest_create_followup(body, id_app=id_app, token=token)
+
+    # -------------------------------------------------------------------------
+    def _rest_sync_commands(self, body, id_app):
+        """
+        PUT /applications/{id_app}/commands
+
+        """
+
+        list_cmd = list()
+        for cmd in body or ():
+            cmd = dict(cmd)
+            cmd.update(
+                id=str(self._snowflake()), application_id=str(id_app), version="1"
+            )
+            list_cmd.append(cmd)
+        return (200, list_cmd)
+
+
+# -----------------------------------------------------------------------------
+async def _send_frames(ws, queue_tx):
+    """
+    Send queued gateway frames over the websocket in order.
+
+    """
+
+    while True:
+        str_frame = await queue_tx.get()
+        await ws.send_str(str_frame)
+
+
+# -----------------------------------------------------------------------------
+async def _read_body(request):
+    """
+    Return the decoded JSON body of a REST request, or an empty dict.
+
+    Multipart requests (i.e. messages with
+    file attachments) carry their JSON in
+    the payload_json field.
+
+    """
+
+    if not request.can_read_body:
+        return dict()
+
+    if request.content_type == "application/json":
+        return await request.json()
+
+    if request.content_type.startswith("multipart/"):
+        form = await request.post()
+        return json.loads(form.get("payload_json", "{}"))
+
+    return dict()
+
+
+# -----------------------------------------------------------------------------
+def _json_response(data, status=200, headers=None):
+    """
+    Return a JSON response.
+
+    discord.py only decodes bodies whose
+    content type is exactly application/json,
+    so no charset parameter is added.
+
+    """
+
+    return aiohttp.web.Response(
+        body=json.dumps(data).encode("utf-8"),
+        status=status,
+        headers=headers,
+        content_type="application/json",
+    )
+
+
+# -----------------------------------------------------------------------------
+def _timestamp():
+    """
+    Return the current time as an ISO 8601 string.
+
+    """
+
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+# -----------------------------------------------------------------------------
+def _payload_user(id_user, name, is_bot=False):
+    """
+    Return a user payload.
+
+    """
+
+    return dict(
+        id=str(id_user),
+        username=name,
+        discriminator="0",
+        global_name=name,
+        avatar=None,
+        bot=is_bot,
+        public_flags=0,
+    )
+
+
+# -----------------------------------------------------------------------------
+def _payload_member(user):
+    """
+    Return a guild member payload for the specified user payload.
+
+    """
+
+    return dict(
+        user=user,
+        roles=[],
+        joined_at=_timestamp(),
+        deaf=False,
+        mute=False,
+        nick=None,
+        flags=0,
+        permissions=PERMISSIONS_ALL,
+    )
+
+
+# -----------------------------------------------------------------------------
+def _payload_channel_text(id_channel, id_guild, name):
+    """
+    Return a guild text channel payload.
+
+    """
+
+    return dict(
+        id=str(id_channel),
+        type=0,
+        guild_id=str(id_guild),
+        name=name,
+        position=0,
+        permission_overwrites=[],
+        nsfw=False,
+        parent_id=None,
+        topic=None,
+        rate_limit_per_user=0,
+        last_message_id=None,
+    )
+
+
+# -----------------------------------------------------------------------------
+def _payload_guild(id_guild, name, id_owner, list_channel, list_member):
+    """
+    Return a guild payload for the GUILD_CREATE event.
+
+    """
+
+    return dict(
+        id=str(id_guild),
+        name=name,
+        icon=None,
+        owner_id=str(id_owner),
+        afk_timeout=300,
+        verification_level=0,
+        default_message_notifications=0,
+        explicit_content_filter=0,
+        roles=[
+            dict(
+                id=str(id_guild),
+                name="@everyone",
+                color=0,
+                hoist=False,
+                position=0,
+                permissions=PERMISSIONS_ALL,
+                managed=False,
+                mentionable=False,
+                flags=0,
+            )
+        ],
+        emojis=[],
+        stickers=[],
+        features=[],
+        mfa_level=0,
+        system_channel_id=None,
+        premium_tier=0,
+        preferred_locale="en-US",
+        nsfw_level=0,
+        member_count=len(list_member),
+        large=False,
+        joined_at=_timestamp(),
+        members=list_member,
+        channels=list_channel,
+        threads=[],
+        presences=[],
+        voice_states=[],
+        stage_instances=[],
+        guild_scheduled_events=[],
+        unavailable=False,
+    )
+
+
+# -----------------------------------------------------------------------------
+def run_load(
+    count_user=1000,
+    count_session=100,
+    rate_event=1000.0,
+    secs_duration=10.0,
+    ratio_reply=0.2,
+    str_mode="process",
+    count_limit=50,
+    str_ack="followup",
+):
+    """
+    Replay synthetic user traffic against fl.net.discord.bot.coro.
+
+    A simulator is started and the bot is
+    pointed at it. One join button message
+    is posted per session, then inbound
+    events (DMs, guild messages, button
+    presses on the session messages and
+    "ask" app commands) from random users
+    are injected at rate_event per second.
+    A fraction ratio_reply of inbound DMs
+    get a reply sent back through the bot.
+    The ask command is acknowledged with
+    the str_ack strategy, and in deferred
+    mode every invocation gets a reply.
+
+    Return a dict of throughput, latency
+    and rate limit measurements.
+
+    """
+
+    sim = Simulator(count_limit=count_limit).start()
+    cfg_bot = dict(
+        str_token="simulator",
+        secs_sleep=0.001,
+        id_system=None,
+        id_node=None,
+        mode=str_mode,
+        memory_profile="lean",
+        url_api=sim.url_api,
+        url_gateway=sim.url_gateway,
+        secs_report_memory=None,
+    )
+    bot = fl.net.discord.bot.coro(cfg_bot)
+    next(bot)
+
+    # Configure the ask command, then wait for
+    # the bot to connect and start forwarding
+    # messages.
+    #
+    list_item = list(
+        bot.send(
+            [
+                dict(
+                    type="cfg_appcmd",
+                    name="ask",
+                    description="Ask a question.",
+                    param=dict(topic="str"),
+                    ack=str_ack,
+                )
+            ]
+        )
+    )
+    sim.event_identified.wait(timeout=60.0)
+    time_deadline = time.perf_counter() + 60.0
+    time_probe = 0.0
+    is_ready = False
+    while not is_ready:
+        if time.perf_counter() > time_deadline:
+            raise RuntimeError("Timed out waiting for the bot to connect.")
+        if time.perf_counter() - time_probe > 0.5:
+            time_probe = time.perf_counter()
+            sim.inject_dm(id_user=1, content="probe")
+        list_item = bot.send([])
+        is_ready = any(item.get("type") == "msg_dm" for item in list_item)
+        time.sleep(0.001)
+
+    # Post a join button for each session and
+    # wait until they have all arrived.
+    #
+    list_to_bot = list()
+    for idx_session in range(count_session):
+        list_to_bot.append(
+            dict(
+                type="msg_guild",
+                id_channel=sim.list_id_channel[idx_session % len(sim.list_id_channel)],
+                content="Join deliberation #{idx}".format(idx=idx_session),
+                button=fl.net.discord.bot.ButtonData(
+                    label="Join", id_btn="join_{idx}".format(idx=idx_session)
+                ),
+                nonce="session-{idx}".format(idx=idx_session),
+            )
+        )
+    bot.send(list_to_bot)
+    time_deadline = time.perf_counter() + 60.0
+    while len(sim.map_nonce) < count_session:
+        if time.perf_counter() > time_deadline:
+            raise RuntimeError("Timed out waiting for session messages.")
+        bot.send([])
+        time.sleep(0.001)
+    list_id_msg_session = list(
+        sim.map_nonce["session-{idx}".format(idx=idx)][1]
+        for idx in range(count_session)
+    )
+
+    # Inject load.
+    #
+    rng = random.Random(0)
+    map_time_msg = dict()  # id_msg -> time_tx
+    map_time_btn = collections.defaultdict(collections.deque)  # (user, btn) -> time
+    map_time_cmd = collections.defaultdict(collections.deque)  # user -> time
+    map_time_reply = dict()  # nonce -> time_tx
+    list_secs_in = list()
+    count_tx = 0
+    count_rx = 0
+    count_429_start = sim.count_429
+    iter_nonce = itertools.count()
+
+    time_start = time.perf_counter()
+    time_stop = time_start + secs_duration
+    time_drain = time_stop + 10.0
+    while True:
+        time_now = time.perf_counter()
+        if time_now > time_drain:
+            break
+        is_drained = (
+            not map_time_msg
+            and not any(map_time_btn.values())
+            and not any(map_time_cmd.values())
+        )
+        if time_now > time_stop and is_drained:
+            break
+
+        count_due = int(rate_event * (min(time_now, time_stop) - time_start))
+        while count_tx < count_due:
+            id_user = 1000 + rng.randrange(count_user)
+            idx_session = rng.randrange(count_session)
+            roll = rng.random()
+            time_tx = time.perf_counter()
+            if roll < 0.5:
+                id_msg = sim.inject_dm(id_user, "dm {idx}".format(idx=count_tx))
+                map_time_msg[id_msg] = time_tx
+            elif roll < 0.7:
+                id_channel = rng.choice(sim.list_id_channel)
+                id_msg = sim.inject_guild_message(
+                    id_user, id_channel, "guild {idx}".format(idx=count_tx)
+                )
+                map_time_msg[id_msg] = time_tx
+            elif roll < 0.9:
+                sim.inject_button(id_user, list_id_msg_session[idx_session])
+                id_btn = "join_{idx}".format(idx=idx_session)
+                map_time_btn[(id_user, id_btn)].append(time_tx)
+            else:
+                sim.inject_appcmd(
+                    id_user,
+                    "ask",
+                    dict(topic="Topic {idx}".format(idx=idx_session)),
+                    id_channel=rng.choice(sim.list_id_channel),
+                )
+                map_time_cmd[id_user].append(time_tx)
+            count_tx += 1
+
+        list_to_bot = list()
+        for item in bot.send([]):
+            type_item = item.get("type", None)
+            time_rx = time.perf_counter()
+            if type_item in ("msg_dm", "msg_guild"):
+                time_tx = map_time_msg.pop(item["id_msg"], None)
+            elif type_item == "btn":
+                queue_time = map_time_btn.get((item["id_user"], item["id_btn"]), None)
+                time_tx = queue_time.popleft() if queue_time else None
+            elif type_item in ("appcmd_dm", "appcmd_guild"):
+                queue_time = map_time_cmd.get(item["id_user"], None)
+                time_tx = queue_time.popleft() if queue_time else None
+                if str_ack == "deferred":
+                    list_to_bot.append(
+                        dict(
+                            type="appcmd_reply",
+                            id_interaction=item["id_interaction"],
+                            content="answer",
+                        )
+                    )
+            else:
+                time_tx = None
+            if time_tx is None:
+                continue
+
+            count_rx += 1
+            list_secs_in.append(time_rx - time_tx)
+            if type_item == "msg_dm" and rng.random() < ratio_reply:
+                nonce = "reply-{idx}".format(idx=next(iter_nonce))
+                map_time_reply[nonce] = time_rx
+                list_to_bot.append(
+                    dict(
+                        type="msg_dm",
+                        id_user=item["id_author"],
+                        content="ack",
+                        nonce=nonce,
+                    )
+                )
+        bot.send(list_to_bot)
+        time.sleep(0.0005)
+
+    secs_elapsed = time.perf_counter() - time_start
+    list_secs_out = list(
+        sim.map_nonce[nonce][0] - time_tx
+        for (nonce, time_tx) in map_time_reply.items()
+        if nonce in sim.map_nonce
+    )
+
+    bot.close()
+    sim.stop()
+
+    return dict(
+        mode=str_mode,
+        count_tx=count_tx,
+        count_rx=count_rx,
+        rate_rx=count_rx / secs_elapsed,
+        ms_in_p50=_percentile_ms(list_secs_in, 50),
+        ms_in_p99=_percentile_ms(list_secs_in, 99),
+        count_reply=len(map_time_reply),
+        count_reply_rx=len(list_secs_out),
+        ms_out_p50=_percentile_ms(list_secs_out, 50),
+        ms_out_p99=_percentile_ms(list_secs_out, 99),
+        count_429=sim.count_429 - count_429_start,
+        count_rest=dict(sim.count_rest),
+    )
+
+
+# -----------------------------------------------------------------------------
+def _percentile_ms(list_secs, percentile):
+    """
+    Return the specified percentile of list_secs in milliseconds.
+
+    """
+
+    if len(list_secs) < 2:
+        return float("nan")
+    return 1000.0 * statistics.quantiles(list_secs, n=100)[percentile - 1]
+
+
+# -----------------------------------------------------------------------------
+def main():
+    """
+    Run a load test of fl.net.discord.bot against the simulator.
+
+    """
+
+    parser = argparse.ArgumentParser(description=main.__doc__.strip())
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=1000.0)
+    parser.add_argument("--secs", type=float, default=10.0)
+    parser.add_argument("--reply", type=float, default=0.2)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--mode", choices=("process", "thread"), default="process")
+    parser.add_argument(
+        "--ack", choices=fl.net.discord.bot.TUP_APPCMD_ACK, default="followup"
+    )
+    args = parser.parse_args()
+
+    result = run_load(
+        count_user=args.users,
+        count_session=args.sessions,
+        rate_event=args.rate,
+        secs_duration=args.secs,
+        ratio_reply=args.reply,
+        str_mode=args.mode,
+        count_limit=args.limit,
+        str_ack=args.ack,
+    )
+    for key, value in result.items():
+        print("{key:<16} {value}".format(key=key, value=value))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ import fl.util.edict
 import key
 
 import fl.net.discord.bot
+import fl.net.openai.token
 
 
 NOTHING = tuple()
@@ -13,6 +14,13 @@ PREFIX_JOIN = "join_"
 PREFIX_SUBMIT = "submit_"
 PREFIX_SUMMARY = "summary_"
 
+# Summaries use the first of these models
+# with room for the prompt and the reply.
+# Transcripts are trimmed to fit the last.
+#
+TUP_MODEL_SUMMARY = ("gpt-3.5-turbo", "gpt-3.5-turbo-16k")
+COUNT_TOKEN_SUMMARY = 1024
+
 
 # -----------------------------------------------------------------------------
 def coro(runtime, cfg, inputs, state, outputs):  # pylint: disable=W0613
@@ -26,16 +34,30 @@ def coro(runtime, cfg, inputs, state, outputs):  # pylint: disable=W0613
     #   state['session'] is a map from id_session -> info_session
     #   state['user']    is a map from id_user    -> info_user
     #   state['prompt']  is a map from id_prompt  -> str_prompt
+    #   state['summary'] is a map from id_session -> info_summary
+    #                    for summaries which are still streaming.
+    #   state['count_summary'] is the number of summaries requested.
+    #
+    #   info_summary is { 'id_request': id_request,
+    #                     'text':       str_summary }
     #
     #   info_session is { 'admin':       id_admin,
     #                     'topic':       str_topic,
+    #                     'channel':     id_channel or None,
     #                     'participant': set(id_user),
     #                     'contributor': set(id_user) }
+    #
+    #   Sessions started from a guild channel are
+    #   delivered via a private thread in that
+    #   channel. Sessions started from a DM have
+    #   no channel, and are delivered via DMs.
     #   info_user    is { 'name':       name_user,
     #                     'session':    id_session,
     #                     'transcript': list(content) }
     #
-    state = dict(session=dict(), user=dict(), prompt=dict())
+    state = dict(
+        session=dict(), user=dict(), prompt=dict(), summary=dict(), count_summary=0
+    )
     state["prompt"].update(cfg.get("prompt", dict()))
 
     # Main loop.
@@ -89,11 +111,15 @@ def _update(state, msg):
     }
     is_dm = str_type in {"msg_dm", "edit_dm"}
     is_guild = str_type in {"msg_guild", "edit_guild"}
+    is_thread = is_guild and msg.get("key_thread", None) is not None
     is_appcmd = str_type in {"appcmd_dm", "appcmd_guild"}
     is_msgcmd = str_type in {"msgcmd_dm", "msgcmd_guild"}
     is_res = str_type in {
         "openai_result",
     }
+    is_delta = str_type in {
+        "openai_result_delta",
+    }
 
     if is_appcmd and msg["name_command"] == "ask":
         discord += _on_cmd_ask(state, msg)
@@ -101,7 +127,7 @@ def _update(state, msg):
     if is_btn and msg["id_btn"].startswith(PREFIX_JOIN):
         discord += _on_btn_join(state, msg)
 
-    if is_dm and msg["id_author"] in state["user"]:
+    if (is_dm or is_thread) and _is_contribution(state, msg):
         discord += _on_msg_dm(state, msg)
 
     if is_btn and msg["id_btn"].startswith(PREFIX_SUBMIT):
@@ -109,6 +135,10 @@ def _update(state, msg):
 
     if is_btn and msg["id_btn"].startswith(PREFIX_SUMMARY):
         openai += _on_btn_summary(state, msg)
+        discord += _on_summary_start(state, msg)
+
+    if is_delta and msg["state"]["id_prompt"] == "summary":
+        discord += _on_summary_delta(state, msg)
 
     if is_res and msg["state"]["id_prompt"] == "summary":
         discord += _on_summary(state, msg)
@@ -137,9 +167,12 @@ def _on_cmd_ask(state, msg):
     id_user = msg["id_user"]
     str_topic = " ".join(msg["args"])
     id_session = uuid.uuid4().hex[:6]
+    msg_type = msg["type"]
+    id_channel = msg["id_channel"] if msg_type == "appcmd_guild" else None
     state["session"][id_session] = dict(
         admin=id_user,
         topic=str_topic,
+        channel=id_channel,
         participant=set(),  # set(id_user)
         contributor=set(),
     )  # set(id_user)
@@ -153,7 +186,6 @@ def _on_cmd_ask(state, msg):
 
     # Enqueue a message with the session join button.
     #
-    msg_type = msg["type"]
     if msg_type == "appcmd_dm":
         yield dict(
             type="msg_dm", id_user=id_user, content=str_invite, button=cfg_button
@@ -166,6 +198,18 @@ def _on_cmd_ask(state, msg):
             button=cfg_button,
         )
 
+        # Open a private thread for the session
+        # and post the topic and 'Submit' button
+        # to it once, for all participants.
+        #
+        yield dict(
+            type="msg_thread",
+            id_channel=id_channel,
+            key_thread=id_session,
+            name="Deliberation #{id}".format(id=id_session),
+            **_topic(state, id_session)
+        )
+
 
 # -----------------------------------------------------------------------------
 def _on_btn_join(state, msg):
@@ -177,6 +221,7 @@ def _on_btn_join(state, msg):
     # Remove the user from any previous session.
     #
     id_user = msg["id_user"]
+    id_session = msg["id_btn"][len(PREFIX_JOIN) :]
     if id_user in state["user"]:
         id_session_prev = state["user"][id_user]["session"]
         map_session_prev = state["session"][id_session_prev]
@@ -191,9 +236,16 @@ def _on_btn_join(state, msg):
         except KeyError:
             pass
 
+        if map_session_prev["channel"] is not None and id_session_prev != id_session:
+            yield dict(
+                type="msg_thread",
+                id_channel=map_session_prev["channel"],
+                key_thread=id_session_prev,
+                remove_user=[id_user],
+            )
+
     # Add the user to the current session.
     #
-    id_session = msg["id_btn"][len(PREFIX_JOIN) :]
     map_session = state["session"][id_session]
     set_participant = map_session["participant"]
     set_participant.add(id_user)
@@ -203,6 +255,12 @@ def _on_btn_join(state, msg):
     name_user = msg["name_user"]
     state["user"][id_user] = dict(name=name_user, session=id_session, transcript=list())
 
+    # Ask the bot to forward messages from the
+    # user, in case it is configured to filter
+    # out messages from untracked users.
+    #
+    yield dict(type="cfg_filter", track=[id_user])
+
     # Send a message to the admin.
     #
     yield dict(
@@ -214,22 +272,47 @@ def _on_btn_join(state, msg):
         ),
     )
 
-    # Send the topic and a 'Submit' button to the user.
+    # Add the user to the session thread, where
+    # the topic and a 'Submit' button have been
+    # posted. If the user cannot be added to the
+    # thread, or the session has no thread, then
+    # send them to the user as a DM instead.
     #
-    yield dict(
-        type="msg_dm",
-        id_user=id_user,
-        content=map_session["topic"],
-        button=fl.net.discord.bot.ButtonData(
-            label="Submit", id_btn=_id_btn(PREFIX_SUBMIT, id_session)
-        ),
-    )
+    if map_session["channel"] is not None:
+        yield dict(
+            type="msg_thread",
+            id_channel=map_session["channel"],
+            key_thread=id_session,
+            add_user=[id_user],
+            fallback=_topic(state, id_session),
+        )
+    else:
+        yield dict(type="msg_dm", id_user=id_user, **_topic(state, id_session))
+
+
+# -----------------------------------------------------------------------------
+def _is_contribution(state, msg):
+    """
+    Return True iff msg is part of a contribution to a session.
+
+    Participants contribute by DM, or in the
+    thread for their session. Messages in the
+    threads of other sessions are ignored.
+
+    """
+
+    state_user = state["user"].get(msg["id_author"], None)
+    if state_user is None:
+        return False
+
+    key_thread = msg.get("key_thread", None)
+    return key_thread is None or key_thread == state_user["session"]
 
 
 # -----------------------------------------------------------------------------
 def _on_msg_dm(state, msg):
     """
-    On message recieved.
+    On message recieved, by DM or in the session thread.
 
     """
 
@@ -290,15 +373,86 @@ def _on_btn_summary(state, msg):
             str_transcript += " - {item}\n".format(item=item)
 
     id_prompt = "summary"
-    str_prompt = state["prompt"][id_prompt].format(
-        str_topic=state["session"][id_session]["topic"], str_transcript=str_transcript
+    str_topic = state["session"][id_session]["topic"]
+    str_tmpl = state["prompt"][id_prompt]
+
+    # Trim the transcript so that the prompt
+    # and the reply fit the largest model.
+    # The request handler then picks the
+    # smallest model with enough room.
+    #
+    id_model = TUP_MODEL_SUMMARY[-1]
+    str_prompt_empty = str_tmpl.format(str_topic=str_topic, str_transcript="")
+    count_token_budget = (
+        fl.net.openai.token.context_size(id_model)
+        - COUNT_TOKEN_SUMMARY
+        - fl.net.openai.token.count_messages(
+            [{"role": "system", "content": str_prompt_empty}], id_model
+        )
+    )
+    str_transcript = fl.net.openai.token.trim(
+        str_transcript, count_token_budget, id_model
     )
+    str_prompt = str_tmpl.format(str_topic=str_topic, str_transcript=str_transcript)
 
+    # Each press gets its own id, so that the
+    # summary follows only the latest press if
+    # more than one is in flight. The OpenAI
+    # client sends identical requests once and
+    # gives each press the same text.
+    #
+    state["count_summary"] += 1
     yield dict(
-        state=dict(id_prompt=id_prompt, id_session=id_session),
-        model="gpt-3.5-turbo",
+        state=dict(
+            id_prompt=id_prompt,
+            id_session=id_session,
+            id_request=state["count_summary"],
+        ),
+        model=TUP_MODEL_SUMMARY[0],
+        model_by_context=TUP_MODEL_SUMMARY,
+        max_tokens=COUNT_TOKEN_SUMMARY,
         messages=[{"role": "system", "content": str_prompt}],
+        stream=True,
+    )
+
+
+# -----------------------------------------------------------------------------
+def _on_summary_start(state, msg):
+    """
+    On "Summary" button press, show a placeholder for the summary.
+
+    """
+
+    id_session = msg["id_btn"][len(PREFIX_SUMMARY) :]
+    state["summary"][id_session] = dict(id_request=state["count_summary"], text="")
+    for stream in _summary_streams(state, id_session):
+        yield dict(stream, type="msg_stream", content="")
+
+
+# -----------------------------------------------------------------------------
+def _on_summary_delta(state, msg):
+    """
+    On part of a summary recieved.
+
+    The bot edits the summary message as
+    the text arrives, throttling edits to
+    stay within the discord rate limits.
+
+    """
+
+    if msg["index"] != 0:
+        return
+
+    id_session = msg["state"]["id_session"]
+    summary = state["summary"].setdefault(
+        id_session, dict(id_request=msg["state"].get("id_request", None), text="")
     )
+    if summary["id_request"] != msg["state"].get("id_request", None):
+        return
+
+    summary["text"] += msg["delta"]
+    for stream in _summary_streams(state, id_session):
+        yield dict(stream, type="msg_stream", content=summary["text"])
 
 
 # -----------------------------------------------------------------------------
@@ -309,12 +463,57 @@ def _on_summary(state, msg):
     """
 
     id_session = msg["state"]["id_session"]
-    str_summary = msg["response"]["choices"][0]["message"]["content"]
+    summary = state["summary"].get(id_session, None)
+    if summary is not None:
+        if summary["id_request"] != msg["state"].get("id_request", None):
+            return  # Superseded by a later press.
+        del state["summary"][id_session]
+
+    if msg["error"] is not None:
+        str_summary = "Unable to summarise the session: {err}".format(err=msg["error"])
+    else:
+        str_summary = msg["response"]["choices"][0]["message"]["content"]
+
+    # Replace the streamed summary with the
+    # whole text. Sessions with a thread have
+    # a single summary message in the thread,
+    # and the bot sends it as a DM to any
+    # participants who are not in the thread.
+    #
+    for stream in _summary_streams(state, id_session):
+        yield dict(stream, type="msg_stream", content=str_summary, is_final=True)
+
+
+# -----------------------------------------------------------------------------
+def _summary_streams(state, id_session):
+    """
+    Yield the destination of each summary message for the session.
+
+    """
+
+    # The channel and participants are given
+    # as well as the thread, so that the bot
+    # can still deliver the summary if it no
+    # longer knows the thread.
+    #
+    map_session = state["session"][id_session]
+    id_channel = map_session["channel"]
+    if id_channel is not None:
+        yield dict(
+            key_stream=id_session,
+            key_thread=id_session,
+            id_channel=id_channel,
+            add_user=sorted(map_session["participant"]),
+        )
+        return
+
     for id_user, state_user in state["user"].items():
         if state_user["session"] != id_session:
             continue
-
-        yield dict(type="msg_dm", id_user=id_user, content=str_summary)
+        yield dict(
+            key_stream="{session}.{user}".format(session=id_session, user=id_user),
+            id_user=id_user,
+        )
 
 
 # -----------------------------------------------------------------------------
@@ -378,6 +577,21 @@ def _on_cmd_dbg_prompt_set(state, msg):
     return NOTHING
 
 
+# -----------------------------------------------------------------------------
+def _topic(state, id_session):
+    """
+    Return the message fields for the session topic and 'Submit' button.
+
+    """
+
+    return dict(
+        content=state["session"][id_session]["topic"],
+        button=fl.net.discord.bot.ButtonData(
+            label="Submit", id_btn=_id_btn(PREFIX_SUBMIT, id_session)
+        ),
+    )
+
+
 # -----------------------------------------------------------------------------
 def _id_btn(prefix, id_session):
     """ """
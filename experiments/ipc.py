@@ -0,0 +1,367 @@
+import collections
+import functools
+import marshal
+import operator
+import pickle
+
+
+# Version of the wire format. Bump this
+# whenever the message tuple layout or
+# any of the registered schemas change
+# in an incompatible way.
+#
+VERSION_WIRE = 1
+
+# Each item is encoded as a tuple of
+# (version, code, mask, values, extras),
+# where code identifies the schema, mask
+# records which schema fields are present
+# and values holds those fields in schema
+# order.
+#
+# The tuple is serialized with marshal
+# (format version 2, which skips the
+# reference table and is the fastest) if
+# possible. marshal only supports builtin
+# types, so we fall back to pickle for
+# anything else (e.g. named tuples or
+# OpenAIObject). Pickled data always
+# starts with the PROTO opcode, which a
+# marshalled tuple never does.
+#
+VERSION_MARSHAL = 2
+OPCODE_PICKLE_PROTO = pickle.PROTO[0]
+
+# Code used for items which do not have
+# a registered schema. The whole item is
+# carried in the extras dict.
+#
+CODE_GENERIC = 0
+
+
+# -----------------------------------------------------------------------------
+Schema = collections.namedtuple("Schema", ["code", "id_type", "fields"])
+
+# Items produced by the same code path tend
+# to have the same keys in the same order,
+# so we cache the encoding plan for each
+# distinct type and key tuple ("shape") we
+# see, as the plan depends on both. The
+# cache is bounded in case of pathological
+# producers.
+#
+Shape = collections.namedtuple("Shape", ["code", "mask", "getter", "keys_extra"])
+
+COUNT_SHAPE_MAX = 4096
+
+map_schema = dict()  # id_type -> Schema
+map_schema_by_code = dict()  # code -> Schema
+_map_shape = dict()  # (id_type, tuple(key)) -> Shape
+_map_keys_by_mask = dict()  # (code, mask) -> (id_type, tuple(key))
+
+
+# -----------------------------------------------------------------------------
+def register(code, id_type, fields):
+    """
+    Register a schema for items with the specified type string.
+
+    Fields are carried positionally on the
+    wire, so the order of fields in an
+    existing schema must not change without
+    also bumping VERSION_WIRE. Fields which
+    are absent from an item are omitted,
+    and any keys not named in the schema
+    are carried in a trailing extras dict.
+
+    """
+
+    if code == CODE_GENERIC or code in map_schema_by_code:
+        raise ValueError("Schema code already in use: {code}".format(code=code))
+
+    if id_type in map_schema:
+        raise ValueError("Schema already registered for: {id}".format(id=id_type))
+
+    if len(fields) > 32:
+        raise ValueError("Schema has more than 32 fields: {id}".format(id=id_type))
+
+    schema = Schema(code=code, id_type=id_type, fields=tuple(fields))
+    map_schema[id_type] = schema
+    map_schema_by_code[code] = schema
+    _map_shape.clear()
+    return schema
+
+
+# -----------------------------------------------------------------------------
+def encode(item):
+    """
+    Return the specified item dict encoded as bytes.
+
+    """
+
+    key_shape = (item.get("type", None), tuple(item))
+    try:
+        shape = _map_shape[key_shape]
+    except KeyError:
+        shape = _build_shape(item)
+        if len(_map_shape) < COUNT_SHAPE_MAX:
+            _map_shape[key_shape] = shape
+
+    if shape.code == CODE_GENERIC:
+        return _dumps((VERSION_WIRE, CODE_GENERIC, 0, (), item))
+
+    if shape.keys_extra:
+        extras = dict((key, item[key]) for key in shape.keys_extra)
+    else:
+        extras = None
+
+    return _dumps((VERSION_WIRE, shape.code, shape.mask, shape.getter(item), extras))
+
+
+# -----------------------------------------------------------------------------
+def _build_shape(item):
+    """
+    Return the encoding plan for items with the same keys as item.
+
+    """
+
+    schema = map_schema.get(item.get("type", None), None)
+    if schema is None:
+        return Shape(code=CODE_GENERIC, mask=0, getter=None, keys_extra=None)
+
+    mask = 0
+    list_key = list()
+    for idx, key in enumerate(schema.fields):
+        if key in item:
+            mask |= 1 << idx
+            list_key.append(key)
+
+    if len(list_key) == 0:
+        getter = _get_nothing
+    elif len(list_key) == 1:
+        getter = functools.partial(_get_one, list_key[0])
+    else:
+        getter = operator.itemgetter(*list_key)
+
+    keys_extra = tuple(
+        key for key in item if key != "type" and key not in schema.fields
+    )
+
+    return Shape(code=schema.code, mask=mask, getter=getter, keys_extra=keys_extra)
+
+
+# -----------------------------------------------------------------------------
+def _get_nothing(item):
+    """
+    Return an empty tuple.
+
+    """
+
+    return ()
+
+
+# -----------------------------------------------------------------------------
+def _get_one(key, item):
+    """
+    Return a length 1 tuple containing item[key].
+
+    """
+
+    return (item[key],)
+
+
+# -----------------------------------------------------------------------------
+def _dumps(body):
+    """
+    Return the specified body tuple serialized as bytes.
+
+    """
+
+    try:
+        return marshal.dumps(body, VERSION_MARSHAL)
+    except ValueError:
+        return pickle.dumps(body, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+# -----------------------------------------------------------------------------
+def decode(data):
+    """
+    Return the item dict encoded in the specified bytes.
+
+    """
+
+    if data[0] == OPCODE_PICKLE_PROTO:
+        (version, code, mask, values, extras) = pickle.loads(data)
+    else:
+        (version, code, mask, values, extras) = marshal.loads(data)
+
+    if version != VERSION_WIRE:
+        raise ValueError(
+            "Unsupported wire format version: {ver}. Expected {exp}.".format(
+                ver=version, exp=VERSION_WIRE
+            )
+        )
+
+    if code == CODE_GENERIC:
+        return extras
+
+    try:
+        (id_type, keys) = _map_keys_by_mask[(code, mask)]
+    except KeyError:
+        schema = map_schema_by_code[code]
+        id_type = schema.id_type
+        keys = tuple(
+            key for (idx, key) in enumerate(schema.fields) if mask & (1 << idx)
+        )
+        _map_keys_by_mask[(code, mask)] = (id_type, keys)
+
+    item = dict(zip(keys, values), type=id_type)
+    if extras:
+        item.update(extras)
+    return item
+
+
+# =============================================================================
+class EncodedQueue:
+    """
+    Queue wrapper which encodes items on put and decodes them on get.
+
+    The wrapped queue only ever carries bytes,
+    so a multiprocessing.Queue pickles a single
+    bytes object per item rather than the
+    whole item dict.
+
+    """
+
+    __slots__ = ("queue",)
+
+    # -------------------------------------------------------------------------
+    def __init__(self, queue):
+        """
+        Construct the wrapper.
+
+        """
+
+        self.queue = queue
+
+    # -------------------------------------------------------------------------
+    def put(self, item, block=True, timeout=None):
+        """
+        Encode and put the specified item onto the wrapped queue.
+
+        """
+
+        self.queue.put(encode(item), block, timeout)
+
+    # -------------------------------------------------------------------------
+    def get(self, block=True, timeout=None):
+        """
+        Get and decode the next item from the wrapped queue.
+
+        """
+
+        return decode(self.queue.get(block, timeout))
+
+
+# -----------------------------------------------------------------------------
+# Schemas for the item types which cross the
+# discord bot and OpenAI client queues. Codes
+# must never be reused.
+#
+# Note that msg_dm and msg_guild are used for
+# both inbound and outbound messages, so their
+# schemas include the fields for both.
+#
+register(1, "msg_dm", ("id_msg", "id_author", "name_author", "content", "id_user"))
+register(
+    2,
+    "msg_guild",
+    (
+        "id_prev",
+        "id_msg",
+        "id_author",
+        "name_author",
+        "id_channel",
+        "name_channel",
+        "content",
+    ),
+)
+register(3, "edit_dm", ("id_prev", "id_msg", "id_author", "name_author", "content"))
+register(
+    4,
+    "edit_guild",
+    (
+        "id_prev",
+        "id_msg",
+        "id_author",
+        "name_author",
+        "nick_author",
+        "id_channel",
+        "name_channel",
+        "content",
+    ),
+)
+register(5, "btn", ("id_btn", "id_user", "name_user", "id_channel"))
+register(
+    6,
+    "appcmd_dm",
+    ("name_command", "id_channel", "id_user", "name_user", "args", "id_interaction"),
+)
+register(
+    7,
+    "appcmd_guild",
+    (
+        "id_guild",
+        "name_guild",
+        "name_channel",
+        "nick_user",
+        "name_command",
+        "id_channel",
+        "id_user",
+        "name_user",
+        "args",
+        "id_interaction",
+    ),
+)
+register(
+    8, "msgcmd_dm", ("name_command", "args", "id_channel", "id_author", "name_author")
+)
+register(
+    9,
+    "msgcmd",
+    (
+        "id_guild",
+        "name_guild",
+        "name_channel",
+        "nick_author",
+        "name_command",
+        "args",
+        "id_channel",
+        "id_author",
+        "name_author",
+    ),
+)
+register(10, "cfg_msgcmd", ("name", "description", "param"))
+register(11, "cfg_appcmd", ("name", "description", "param", "ack", "ack_text"))
+register(12, "cfg_filter", ("track", "untrack"))
+register(13, "log_metric", ("created", "id", "value"))
+register(14, "openai_result", ("request", "response", "error", "state", "unix_time"))
+register(15, "appcmd_reply", ("id_interaction", "content"))
+register(
+    16,
+    "msg_thread",
+    (
+        "id_channel",
+        "key_thread",
+        "name",
+        "add_user",
+        "remove_user",
+        "content",
+        "fallback",
+    ),
+)
+register(17, "openai_result_delta", ("index", "delta", "state", "unix_time"))
+register(
+    18,
+    "msg_stream",
+    ("key_stream", "id_channel", "id_user", "key_thread", "content", "is_final"),
+)
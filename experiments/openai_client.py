@@ -1,22 +1,354 @@
+import asyncio
+import collections
+import functools
+import hashlib
+import heapq
 import importlib
+import json
 import logging
+import marshal
 import multiprocessing
+import os
+import pickle
 import queue
+import random
 import re
+import sqlite3
 import string
+import sys
 import time
+import traceback
+import zlib
 
+import aiohttp
 import openai
 
+import fl.net.ipc
+import fl.net.openai.token
 import fl.util
 
 
+# Retry policy for each class of transient
+# error, keyed by the name of the openai.error
+# class. Each attempt is delayed by a random
+# time of up to secs_base * 2 ** count_retry
+# (capped at secs_max), or for as long as
+# the Retry-After header asks, if that is
+# longer. Errors which are not listed (for
+# example InvalidRequestError) would fail in
+# the same way again, so are not retried.
+#
+MAP_RETRY_DEFAULT = dict(
+    RateLimitError=dict(count_retry=5, secs_base=1.0, secs_max=60.0),
+    ServiceUnavailableError=dict(count_retry=4, secs_base=1.0, secs_max=30.0),
+    APIError=dict(count_retry=3, secs_base=0.5, secs_max=30.0),
+    APIConnectionError=dict(count_retry=3, secs_base=0.5, secs_max=30.0),
+    Timeout=dict(count_retry=3, secs_base=0.5, secs_max=30.0),
+    TryAgain=dict(count_retry=3, secs_base=0.5, secs_max=30.0),
+)
+
+# Errors which indicate that OpenAI itself is
+# degraded, and so count towards opening the
+# circuit breaker. A 429 or a 4xx shows that
+# the API is up and answering.
+#
+SET_ERROR_BREAKER = set(
+    (
+        "ServiceUnavailableError",
+        "APIError",
+        "APIConnectionError",
+        "Timeout",
+        "TryAgain",
+    )
+)
+
+# Temperature which OpenAI uses for each
+# endpoint if none is given. Responses are
+# only cached if the temperature is no more
+# than the temperature_max for the endpoint,
+# so that sampled responses are not replayed
+# unless this is asked for. Endpoints which
+# are not listed do not sample.
+#
+MAP_TEMPERATURE_DEFAULT = dict(
+    completions=1.0,
+    chat_completions=1.0,
+    edits=1.0,
+    audio_transcriptions=0.0,
+    audio_translations=0.0,
+)
+
+# Defaults for cfg["embedding_batch"]. Each
+# batch is sent when secs_window has passed
+# since its first request, or sooner if one
+# more request would take it over either of
+# the caps. OpenAI accepts up to 2048 inputs
+# in one embeddings request.
+#
+MAP_EMBEDDING_BATCH_DEFAULT = dict(
+    secs_window=0.02,
+    count_input_max=256,
+    count_token_max=50000,
+)
+
+# Defaults for cfg["priority"]. Requests are
+# put in a priority class by an id_priority
+# in the request or its state, and classes
+# are listed in map_weight in order of
+# priority. Requests which have waited for
+# more than secs_aging are served first, so
+# that no class is starved.
+#
+MAP_PRIORITY_DEFAULT = dict(
+    map_weight=dict(interactive=8, default=2, bulk=1),
+    is_strict=False,
+    id_default="default",
+    secs_aging=30.0,
+)
+
+# Request parameters which do not change the
+# response, and so are left out of the cache
+# key.
+#
+SET_PARAM_UNCACHED = set(("user",))
+
+# Template fields which are filled in from
+# kwargs_tmpl for each endpoint. The content
+# of chat messages is filled in as well.
+#
+MAP_FIELD_TEMPLATE = dict(
+    completions=("prompt",),
+    chat_completions=(),
+    edits=("input", "instruction"),
+    images_generations=("prompt",),
+    images_edits=("prompt",),
+    images_variations=(),
+    embeddings=("input",),
+    audio_transcriptions=("prompt",),
+    audio_translations=("prompt",),
+)
+
+# The key of a format field is the part of
+# its name before any attribute or index,
+# e.g. "user" in "{user.name}".
+#
+REGEX_FIELD_KEY = re.compile(r"[^.\[]*")
+
+# OpenAI library function to call for each
+# endpoint.
+#
+MAP_FCN_ENDPOINT = dict(
+    completions=openai.Completion.create,
+    chat_completions=openai.ChatCompletion.create,
+    edits=openai.Edit.create,
+    images_generations=openai.Image.create,
+    images_edits=openai.Image.create_edit,
+    images_variations=openai.Image.create_variation,
+    embeddings=openai.Embedding.create,
+    audio_transcriptions=openai.Audio.transcribe,
+    audio_translations=openai.Audio.translate,
+)
+
+# Request parameters for each endpoint.
+# These are compiled into an EndpointSchema
+# for each endpoint when the module is
+# imported.
+#
+# Tuple is (required-internally, required-OpenAI, name-in-api, type)
+#
+Y = True
+N = False
+MAP_TUP_TUP_PARAM = dict(  # RI, RO, name-api,           type
+    completions=(
+        (N, Y, "model", (str,)),
+        (Y, N, "prompt", (str, list)),
+        (N, N, "suffix", (str,)),
+        (N, N, "max_tokens", (int,)),
+        (N, N, "temperature", (float,)),
+        (N, N, "top_p", (float,)),
+        (N, N, "n", (int,)),
+        (N, N, "stream", (bool,)),
+        (N, N, "logprobs", (int,)),
+        (N, N, "echo", (bool,)),
+        (N, N, "stop", (str, list)),
+        (N, N, "presence_penalty", (float,)),
+        (N, N, "frequency_penalty", (float,)),
+        (N, N, "best_of", (int,)),
+        (N, N, "logit_bias", (dict,)),
+        (N, N, "user", (str,)),
+    ),
+    chat_completions=(
+        (N, Y, "model", (str,)),
+        (Y, Y, "messages", (list,)),
+        (N, N, "temperature", (float,)),
+        (N, N, "top_p", (float,)),
+        (N, N, "n", (int,)),
+        (N, N, "stream", (bool,)),
+        (N, N, "stop", (str, list)),
+        (N, N, "max_tokens", (int,)),
+        (N, N, "presence_penalty", (float,)),
+        (N, N, "frequency_penalty", (float,)),
+        (N, N, "logit_bias", (dict,)),
+        (N, N, "user", (str,)),
+    ),
+    edits=(
+        (N, Y, "model", (str,)),
+        (Y, N, "input", (str,)),
+        (Y, Y, "instruction", (str,)),
+        (N, N, "n", (int,)),
+        (N, N, "temperature", (float,)),
+        (N, N, "top_p", (float,)),
+    ),
+    images_generations=(
+        (Y, Y, "prompt", (str,)),
+        (N, N, "n", (int,)),
+        (N, N, "size", (str,)),
+        (N, N, "response_format", (str,)),
+        (N, N, "user", (str,)),
+    ),
+    images_edits=(
+        (Y, Y, "image", (str,)),
+        (N, N, "mask", (str,)),
+        (Y, Y, "prompt", (str,)),
+        (N, N, "n", (int,)),
+        (N, N, "size", (str,)),
+        (N, N, "response_format", (str,)),
+        (N, N, "user", (str,)),
+    ),
+    images_variations=(
+        (Y, Y, "image", (str,)),
+        (N, N, "n", (int,)),
+        (N, N, "size", (str,)),
+        (N, N, "response_format", (str,)),
+        (N, N, "user", (str,)),
+    ),
+    embeddings=(
+        (N, Y, "model", (str,)),
+        (Y, Y, "input", (str, list)),
+        (N, N, "user", (str,)),
+    ),
+    audio_transcriptions=(
+        (Y, Y, "file", (str,)),
+        (N, Y, "model", (str,)),
+        (N, N, "prompt", (str,)),
+        (N, N, "response_format", (str,)),
+        (N, N, "temperature", (float,)),
+        (N, N, "language", (str,)),
+    ),
+    audio_translations=(
+        (Y, Y, "file", (str,)),
+        (N, Y, "model", (str,)),
+        (N, N, "prompt", (str,)),
+        (N, N, "response_format", (str,)),
+        (N, N, "temperature", (float,)),
+    ),
+)
+
+del Y, N
+
+# Built-in-test responses, keyed by API
+# version and endpoint. These are shared
+# between results, so must not be changed.
+#
+MAP_BIT_RESPONSE = {
+    ("v1", "completions"): {
+        "id": "cmpl-uqkvlQyYK7bGYrRHQ0eXlWi7",
+        "object": "text_completion",
+        "created": 1589478378,
+        "model": "text-davinci-003",
+        "choices": [
+            {
+                "text": "\n\nThis is a test",
+                "index": 0,
+                "logprobs": None,
+                "finish_reason": "length",
+            }
+        ],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 20, "total_tokens": 30},
+    },
+    ("v1", "chat_completions"): {
+        "id": "chatcmpl-abc123",
+        "object": "chat.completion",
+        "created": 1677858242,
+        "model": "gpt-3.5-turbo-0301",
+        "choices": [
+            {
+                "message": {"role": "assistant", "content": "\n\nTest"},
+                "finish_reason": "stop",
+                "index": 0,
+            }
+        ],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 20, "total_tokens": 30},
+    },
+    ("v1", "edits"): {
+        "object": "edit",
+        "created": 1589478378,
+        "choices": [{"text": "Test edit response", "index": 0}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 20, "total_tokens": 30},
+    },
+    ("v1", "images_generations"): {
+        "created": 1589478378,
+        "data": [
+            {"url": "https://random_test_url_424242.co.uk"},
+            {"url": "https://random_test_url_424242.co.uk"},
+        ],
+    },
+    ("v1", "images_edits"): {
+        "created": 1589478378,
+        "data": [
+            {"url": "https://random_test_url_424242.co.uk"},
+            {"url": "https://random_test_url_424242.co.uk"},
+        ],
+    },
+    ("v1", "images_variations"): {
+        "created": 1589478378,
+        "data": [
+            {"url": "https://random_test_url_424242.co.uk"},
+            {"url": "https://random_test_url_424242.co.uk"},
+        ],
+    },
+    ("v1", "embeddings"): {
+        "object": "list",
+        "model": "text-embedding-ada-002",
+        "data": [
+            {
+                "object": "embedding",
+                "embedding": [0.0023064255, -0.009327292, -0.0028842222],
+                "index": 0,
+            }
+        ],
+        "usage": {"prompt_tokens": 10, "total_tokens": 20},
+    },
+    ("v1", "audio_transcriptions"): {"text": "Test transcription response."},
+    ("v1", "audio_translations"): {"text": "Test translation response"},
+}
+
+map_code_workflow = dict()  # sha256 of inline workflow spec -> code object
+
+
 # -----------------------------------------------------------------------------
 @fl.util.coroutine
 def coro_workflow_handler(cfg, request_handler, template_handler):
     """
     Yield results for workflow coroutines sent to the OpenAI web API.
 
+    Each tick, a workflow coroutine is only
+    stepped if there are items for it, or if
+    the workflow has a secs_interval and that
+    long has passed since it was last
+    stepped, so the cost of a tick grows with
+    the work to do rather than with the
+    number of workflows.
+
+    If cfg["count_process_workflow"] is set,
+    workflow coroutines run in that many
+    worker processes instead of in this one,
+    so that a CPU-heavy workflow does not
+    hold up the others. See WorkflowPool.
+    A tick which takes the workers longer
+    than cfg["secs_timeout_workflow"] (60
+    seconds by default) raises an error.
+
     """
 
     # Configure logging for the workflow handling coroutine.
@@ -32,16 +364,37 @@ def coro_workflow_handler(cfg, request_handler, template_handler):
         str_id=id_log_event, level=level_log_event
     )
 
-    map_workflow = dict()  # id_workflow -> workflow data structure
+    count_process_workflow = cfg.get("count_process_workflow", None)
+    if count_process_workflow is None:
+        pool = None
+    elif isinstance(count_process_workflow, int) and count_process_workflow > 0:
+        secs_timeout = cfg.get("secs_timeout_workflow", 60.0)
+        if not isinstance(secs_timeout, (int, float)) or secs_timeout <= 0:
+            raise RuntimeError("secs_timeout_workflow must be a positive number.")
+        pool = WorkflowPool(cfg, count_process_workflow, secs_timeout)
+    else:
+        raise RuntimeError("count_process_workflow must be None or a positive integer.")
+
+    map_workflow = dict()  # uid_workflow -> workflow data structure
+    list_active = list()  # (uid_workflow, list of items) to step this tick
+    map_list_input = dict()  # uid_workflow -> list of items this tick
+    map_time_due = dict()  # uid_workflow -> unix time of the next timer
+    heap_timer = list()  # (unix time, uid_workflow), may hold stale entries
     list_to_api = list()
+    list_to_template = list()
     list_from_api = list()
 
     while True:
         list_to_api.clear()
         (list_to_api, unix_time) = yield list_from_api
 
-        # Update the workflow table.
+        # Group the incoming items by workflow in
+        # a single pass, and update the workflow
+        # table. A new or updated workflow gets
+        # its own prompt_workflow item as input,
+        # so it is stepped straight away.
         #
+        map_list_input.clear()
         for item in list_to_api:
             try:
                 id_type = item["type"]["id"]
@@ -53,24 +406,59 @@ def coro_workflow_handler(cfg, request_handler, template_handler):
                 log_event.error(msg)
                 raise RuntimeError(msg)
 
+            uid_workflow = item["uid_workflow"]
             if id_type == "prompt_workflow":
-                uid_workflow = item["uid_workflow"]
-                map_workflow[uid_workflow] = _ensure_init_workflow(cfg, item)
-
-        # Run each workflow in turn and
-        # build up the result and error
-        # lists.
+                if pool is None:
+                    map_workflow[uid_workflow] = _ensure_init_workflow(cfg, item)
+                else:
+                    map_workflow[uid_workflow] = item  # Initialised by its worker.
+                map_time_due.pop(uid_workflow, None)
+            map_list_input.setdefault(uid_workflow, list()).append(item)
+
+        # Workflows with a secs_interval are also
+        # stepped when their timer is due, even
+        # if they have no input. Timer entries
+        # which were superseded are skipped.
+        #
+        while heap_timer and heap_timer[0][0] <= unix_time:
+            (time_due, uid_workflow) = heapq.heappop(heap_timer)
+            if map_time_due.get(uid_workflow, None) == time_due:
+                del map_time_due[uid_workflow]
+                map_list_input.setdefault(uid_workflow, list())
+
+        # Step only the workflows with input or
+        # a due timer, and pass everything they
+        # produce to the template handler in a
+        # single batch.
+        #
+        list_active.clear()
+        for uid_workflow, list_input in map_list_input.items():
+            workflow = map_workflow.get(uid_workflow, None)
+            if workflow is None:
+                continue
+            list_active.append((uid_workflow, list_input))
+
+            secs_interval = workflow.get("secs_interval", None)
+            if secs_interval is not None:
+                time_due = unix_time + secs_interval
+                map_time_due[uid_workflow] = time_due
+                heapq.heappush(heap_timer, (time_due, uid_workflow))
+
+        list_to_template.clear()
+        if pool is None:
+            for uid_workflow, list_input in list_active:
+                coroutine = map_workflow[uid_workflow]["coroutine"]
+                list_to_template.extend(coroutine.send(list_input))
+        elif list_active:
+            list_to_template.extend(pool.step(list_active, unix_time))
+
+        # The template handler is stepped every
+        # tick, whether or not any workflow ran,
+        # so that results from earlier requests
+        # are collected.
         #
         list_from_api.clear()
-        for uid_workflow, workflow in map_workflow.items():
-            list_filt = list(
-                item for item in list_to_api if item["uid_workflow"] == uid_workflow
-            )
-            list_from_api.extend(
-                template_handler.send(
-                    (workflow["coroutine"].send(list_filt), unix_time)
-                )
-            )
+        list_from_api.extend(template_handler.send((list_to_template, unix_time)))
 
         # Attempt to send any available event log
         # line items to the rest of the system.
@@ -85,6 +473,11 @@ def _ensure_init_workflow(cfg, workflow):
     """
     Ensure that the specified workflow is imported and primed.
 
+    Inline specs are compiled at most once,
+    and each workflow instance runs the code
+    in a namespace of its own. Import specs
+    are resolved once.
+
     """
     if workflow["coroutine"] is not None:
         return workflow
@@ -95,12 +488,11 @@ def _ensure_init_workflow(cfg, workflow):
     has_whitespace = re.search(r"\s", str_spec)
     is_import_spec = not has_whitespace
     if is_import_spec:
-        (name_module, name_fcn) = str_spec.rsplit(".", 1)
-        module = importlib.import_module(name=name_module)
-        coroutine_function = getattr(object=module, name=name_fcn)
+        coroutine_function = _import_workflow(str_spec)
     else:
+        code = _compile_workflow(str_spec, cfg.get("path_workflow_code", None))
         namespace = dict()
-        exec(str_spec, namespace)
+        exec(code, namespace)
         coroutine_function = namespace["coro"]
 
     workflow["coroutine"] = coroutine_function(cfg)
@@ -108,6 +500,110 @@ def _ensure_init_workflow(cfg, workflow):
     return workflow
 
 
+# -----------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def _import_workflow(str_spec):
+    """
+    Return the coroutine function named by an import spec.
+
+    """
+
+    (name_module, name_fcn) = str_spec.rsplit(".", 1)
+    module = importlib.import_module(name=name_module)
+    return getattr(module, name_fcn)
+
+
+# -----------------------------------------------------------------------------
+def _compile_workflow(str_spec, path_dir=None):
+    """
+    Return the code object for an inline workflow spec.
+
+    Code objects are cached in memory by the
+    sha256 of the spec. If path_dir is given
+    they are also saved there as marshalled
+    bytecode, so that a restarted process
+    does not compile them again. Bytecode is
+    not portable between Python versions, so
+    the file name includes the cache tag of
+    the interpreter.
+
+    """
+
+    id_hash = hashlib.sha256(str_spec.encode("utf-8")).hexdigest()
+    code = map_code_workflow.get(id_hash, None)
+    if code is not None:
+        return code
+
+    path_file = None
+    if path_dir is not None:
+        name_file = "{hash}.{tag}.marshal".format(
+            hash=id_hash, tag=sys.implementation.cache_tag
+        )
+        path_file = os.path.join(path_dir, name_file)
+        try:
+            with open(path_file, "rb") as file:
+                code = marshal.load(file)
+        except (OSError, EOFError, ValueError, TypeError):
+            code = None
+
+    if code is None:
+        code = compile(str_spec, "<workflow {hash}>".format(hash=id_hash[:12]), "exec")
+        if path_file is not None:
+            # Write to a temporary file first so
+            # that other processes never read a
+            # partly written file.
+            #
+            path_tmp = "{path}.{pid}.tmp".format(path=path_file, pid=os.getpid())
+            try:
+                with open(path_tmp, "wb") as file:
+                    marshal.dump(code, file)
+                os.replace(path_tmp, path_file)
+            except OSError:
+                pass
+
+    map_code_workflow[id_hash] = code
+    return code
+
+
+# -----------------------------------------------------------------------------
+def _workflow_worker_main(cfg, queue_in, queue_out):
+    """
+    Step the workflows in one partition of a WorkflowPool, one batch per tick.
+
+    Each batch is a list of (uid_workflow,
+    list of items) tuples. The items produced
+    by the workflows are sent back in a
+    single list, or if a workflow raises an
+    exception, its traceback is sent back
+    instead.
+
+    Batches and replies are pickled by hand
+    rather than by the queue's feeder thread,
+    which would drop an unpicklable reply and
+    leave the pool waiting for it.
+
+    """
+
+    map_workflow = dict()  # uid_workflow -> workflow data structure
+
+    while True:
+        (list_batch, unix_time) = pickle.loads(queue_in.get())
+        list_out = list()
+        try:
+            for uid_workflow, list_input in list_batch:
+                for item in list_input:
+                    if item["type"]["id"] == "prompt_workflow":
+                        map_workflow[uid_workflow] = _ensure_init_workflow(cfg, item)
+                coroutine = map_workflow[uid_workflow]["coroutine"]
+                list_out.extend(coroutine.send(list_input))
+            data = pickle.dumps((list_out, None), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:  # pylint: disable=W0703
+            data = pickle.dumps(
+                (None, traceback.format_exc()), protocol=pickle.HIGHEST_PROTOCOL
+            )
+        queue_out.put(data)
+
+
 # -----------------------------------------------------------------------------
 @fl.util.coroutine
 def coro_template_handler(cfg, request_handler):
@@ -184,6 +680,21 @@ def coro_template_handler(cfg, request_handler):
                     log_event.error(msg)
                     raise RuntimeError(msg)
 
+                # Reject params which do not provide
+                # every key the template refers to,
+                # rather than fail part way through
+                # building the request.
+                #
+                set_key_missing = template["set_key_tmpl"].difference(
+                    item.get("kwargs_tmpl", None) or ()
+                )
+                if set_key_missing:
+                    msg = "Missing template params: {keys}. Template id: {id}.".format(
+                        keys=", ".join(sorted(set_key_missing)), id=uid_template
+                    )
+                    log_event.error(msg)
+                    raise RuntimeError(msg)
+
                 list_request.append(_build_request(template=template, param=item))
 
             # Update map_map_template with new
@@ -201,8 +712,15 @@ def coro_template_handler(cfg, request_handler):
                     )
                     log_event.error(msg)
                     raise RuntimeError(msg)
-                else:
-                    map_template[uid_template] = item
+
+                try:
+                    map_template[uid_template] = _compile_template(item)
+                except ValueError as err:
+                    msg = "Badly formed template id: {id}. {err}".format(
+                        id=uid_template, err=err
+                    )
+                    log_event.error(msg)
+                    raise RuntimeError(msg) from err
 
             # id_type not in (prompt_params,
             # prompt_template), logic error.
@@ -241,8 +759,8 @@ def _build_request(template, param):
           could be applied here as well
           instead of in the daemon.
 
-    Then fill in the template as needed
-    for each OpenAI request type.
+    Then fill in the template using the
+    renderers compiled by _compile_template.
 
     """
     id_endpoint = template["id_endpoint"]
@@ -251,52 +769,148 @@ def _build_request(template, param):
     request["id_endpoint"] = id_endpoint
     request["state"] = param["state"]
 
-    # completions --------------------------------
-    if id_endpoint == "completions":
-        request["prompt"] = template["prompt"].format(**param["kwargs_tmpl"])
+    kwargs_tmpl = param["kwargs_tmpl"]
+    for id_field, render in template["tup_render"]:
+        request[id_field] = render(kwargs_tmpl)
 
-    # chat_completions ---------------------------
     if id_endpoint == "chat_completions":
         request["messages"] = list()
-        for tmpl_msg in template["messages"]:
-            req_msg = {
-                "role": tmpl_msg["role"],
-                "content": tmpl_msg["content"].format(**param["kwargs_tmpl"]),
-            }
-            if "name" in tmpl_msg:
-                req_msg["name"] = tmpl_msg["name"]
+        for role, name, render in template["tup_render_msg"]:
+            req_msg = {"role": role, "content": render(kwargs_tmpl)}
+            if name is not None:
+                req_msg["name"] = name
             request["messages"].append(req_msg)
 
-    # edits --------------------------------------
-    if id_endpoint == "edits":
-        request["input"] = template["input"].format(**param["kwargs_tmpl"])
-        request["instruction"] = template["instruction"].format(**param["kwargs_tmpl"])
+    # If the template names a parameter that
+    # may be trimmed (e.g. a transcript), trim
+    # it so that the request fits the largest
+    # context window it may be sent to.
+    #
+    id_param_trim = template.get("id_param_trim", None)
+    if id_param_trim is not None:
+        count_token_excess = _count_token_excess(request)
+        if count_token_excess > 0:
+            str_param = param["kwargs_tmpl"][id_param_trim]
+            count_token_keep = (
+                fl.net.openai.token.count(str_param, request.get("model", None))
+                - count_token_excess
+            )
+            kwargs_tmpl = dict(param["kwargs_tmpl"])
+            kwargs_tmpl[id_param_trim] = fl.net.openai.token.trim(
+                str_param, count_token_keep, request.get("model", None)
+            )
+            return _build_request(
+                template=dict(template, id_param_trim=None),
+                param=dict(param, kwargs_tmpl=kwargs_tmpl),
+            )
+
+    return request
+
+
+# -----------------------------------------------------------------------------
+def _compile_template(template):
+    """
+    Return a copy of template with a renderer for each of its text fields.
 
-    # images_generations -------------------------
-    if id_endpoint == "images_generations":
-        request["prompt"] = template["prompt"].format(**param["kwargs_tmpl"])
+    Each field is parsed once, when the
+    template is registered, so that bad
+    fields are found then rather than when
+    a request is built, and the keys which
+    params have to provide are collected in
+    set_key_tmpl.
 
-    # images_edits -------------------------------
-    if id_endpoint == "images_edits":
-        request["prompt"] = template["prompt"].format(**param["kwargs_tmpl"])
+    Renderers are the bound format_map of
+    each field, which fill in kwargs_tmpl
+    without copying it.
 
-    # images_variations --------------------------
-    if id_endpoint == "images_variations":
-        pass  # No text prompt
+    """
+    try:
+        tup_id_field = MAP_FIELD_TEMPLATE[template["id_endpoint"]]
+    except KeyError:
+        raise ValueError("Did not recognize the endpoint.") from None
+
+    set_key_tmpl = set()
+    list_render = list()
+    for id_field in tup_id_field:
+        if not isinstance(template.get(id_field, None), str):
+            raise ValueError("Expected a {id} string.".format(id=id_field))
+        render = _compile_field(template[id_field], set_key_tmpl)
+        list_render.append((id_field, render))
+
+    list_render_msg = list()
+    if template["id_endpoint"] == "chat_completions":
+        for tmpl_msg in template.get("messages", None) or ():
+            if not isinstance(tmpl_msg.get("content", None), str):
+                raise ValueError("Expected a content string in each message.")
+            render = _compile_field(tmpl_msg["content"], set_key_tmpl)
+            list_render_msg.append(
+                (tmpl_msg["role"], tmpl_msg.get("name", None), render)
+            )
 
-    # embeddings ---------------------------------
-    if id_endpoint == "embeddings":
-        request["input"] = template["input"].format(**param["kwargs_tmpl"])
+    id_param_trim = template.get("id_param_trim", None)
+    if id_param_trim is not None and id_param_trim not in set_key_tmpl:
+        raise ValueError(
+            "id_param_trim is not used in the template: {id}.".format(id=id_param_trim)
+        )
 
-    # audio_transcriptions -----------------------
-    if id_endpoint == "audio_transcriptions":
-        request["prompt"] = template["prompt"].format(**param["kwargs_tmpl"])
+    return dict(
+        template,
+        tup_render=tuple(list_render),
+        tup_render_msg=tuple(list_render_msg),
+        set_key_tmpl=frozenset(set_key_tmpl),
+    )
 
-    # audio_translations -------------------------
-    if id_endpoint == "audio_translations":
-        request["prompt"] = template["prompt"].format(**param["kwargs_tmpl"])
 
-    return request
+# -----------------------------------------------------------------------------
+def _compile_field(str_tmpl, set_key_tmpl):
+    """
+    Add the keys used by str_tmpl to set_key_tmpl and return its renderer.
+
+    Fields nested in format specs, such as
+    width in "{value:{width}}", are included.
+    Positional fields are not allowed since
+    templates are filled in by keyword.
+
+    """
+    for _, id_field, str_spec, _ in string.Formatter().parse(str_tmpl):
+        if id_field is None:
+            continue
+        id_key = REGEX_FIELD_KEY.match(id_field).group(0)
+        if not id_key or id_key.isdigit():
+            raise ValueError(
+                "Positional fields are not supported: {{{id}}}.".format(id=id_field)
+            )
+        set_key_tmpl.add(id_key)
+        if str_spec:
+            _compile_field(str_spec, set_key_tmpl)
+    return str_tmpl.format_map
+
+
+# -----------------------------------------------------------------------------
+def _count_token_excess(request):
+    """
+    Return the number of tokens by which request exceeds its context, if any.
+
+    The context is the largest of the model
+    and any model_by_context in the request,
+    less max_tokens for the reply. Models set
+    only in the configured defaults are not
+    known yet, so their requests are not
+    trimmed here.
+
+    """
+
+    tup_id_model = tuple(request.get("model_by_context", None) or ())
+    tup_id_model += (request.get("model", None),)
+    count_context = max(
+        fl.net.openai.token.context_size(id_model) or 0 for id_model in tup_id_model
+    )
+    if count_context == 0:
+        return 0
+
+    count_token = fl.net.openai.token.count_request(request, tup_id_model[0])
+    count_token += request.get("max_tokens", 0)
+    return count_token - count_context
 
 
 # -----------------------------------------------------------------------------
@@ -338,6 +952,91 @@ def coro_request_handler(cfg):
             "Missing key(s): {missing}".format(missing=", ".join(set_key_missing))
         )
 
+    count_parallel = cfg.get("count_parallel", 1)
+    if not isinstance(count_parallel, int) or count_parallel < 1:
+        raise RuntimeError("count_parallel must be a positive integer.")
+
+    set_key_limit = set(("rpm", "tpm", "secs_burst"))
+    for id_model, limit in (cfg.get("rate_limit", None) or dict()).items():
+        if not isinstance(limit, dict) or not set(limit) <= set_key_limit:
+            raise RuntimeError(
+                "rate_limit for {id} must be a dict with rpm, tpm "
+                "and/or secs_burst keys.".format(id=id_model)
+            )
+
+    set_key_policy = set(("count_retry", "secs_base", "secs_max"))
+    for id_error, policy in (cfg.get("retry", None) or dict()).items():
+        if id_error not in MAP_RETRY_DEFAULT:
+            raise RuntimeError(
+                "Unsupported error class in retry: {id}".format(id=id_error)
+            )
+        if policy is not None and (
+            not isinstance(policy, dict) or not set(policy) <= set_key_policy
+        ):
+            raise RuntimeError(
+                "retry for {id} must be None or a dict with count_retry, "
+                "secs_base and/or secs_max keys.".format(id=id_error)
+            )
+
+    cfg_breaker = cfg.get("circuit_breaker", dict())
+    if cfg_breaker is not None and (
+        not isinstance(cfg_breaker, dict)
+        or not set(cfg_breaker) <= set(("count_failure", "secs_reset"))
+    ):
+        raise RuntimeError(
+            "circuit_breaker must be None or a dict with "
+            "count_failure and/or secs_reset keys."
+        )
+
+    cfg_cache = cfg.get("cache", None)
+    if cfg_cache is not None:
+        set_key_cache = set(("map_endpoint", "count_item_max", "path_db", "secs_ttl"))
+        if not isinstance(cfg_cache, dict) or not set(cfg_cache) <= set_key_cache:
+            raise RuntimeError(
+                "cache must be None or a dict with map_endpoint, "
+                "count_item_max, path_db and/or secs_ttl keys."
+            )
+        for id_endpoint, rule in cfg_cache.get("map_endpoint", dict()).items():
+            if not isinstance(rule, dict) or not set(rule) <= set(
+                ("secs_ttl", "temperature_max")
+            ):
+                raise RuntimeError(
+                    "cache rule for {id} must be a dict with secs_ttl "
+                    "and/or temperature_max keys.".format(id=id_endpoint)
+                )
+
+    cfg_batch = cfg.get("embedding_batch", None)
+    if cfg_batch is not None and (
+        not isinstance(cfg_batch, dict)
+        or not set(cfg_batch) <= set(MAP_EMBEDDING_BATCH_DEFAULT)
+    ):
+        raise RuntimeError(
+            "embedding_batch must be None or a dict with secs_window, "
+            "count_input_max and/or count_token_max keys."
+        )
+
+    if not isinstance(cfg.get("is_single_flight", True), bool):
+        raise RuntimeError("is_single_flight must be True or False.")
+
+    cfg_priority = cfg.get("priority", None)
+    if cfg_priority is not None:
+        if not isinstance(cfg_priority, dict) or not set(cfg_priority) <= set(
+            MAP_PRIORITY_DEFAULT
+        ):
+            raise RuntimeError(
+                "priority must be None or a dict with map_weight, "
+                "is_strict, id_default and/or secs_aging keys."
+            )
+        cfg_priority = dict(MAP_PRIORITY_DEFAULT, **cfg_priority)
+        map_weight = cfg_priority["map_weight"]
+        if not map_weight or not all(
+            isinstance(weight, (int, float)) and weight > 0
+            for weight in map_weight.values()
+        ):
+            raise RuntimeError("priority map_weight must map classes to weights > 0.")
+        if cfg_priority["id_default"] not in map_weight:
+            raise RuntimeError("priority id_default must be a class in map_weight.")
+
     # Configure logging for the request handling coroutine.
     #
     id_system = cfg["id_system"]
@@ -357,6 +1056,9 @@ def coro_request_handler(cfg):
     if cfg["is_async"]:
         queue_to_api = multiprocessing.Queue()  # coro --> API daemon
         queue_from_api = multiprocessing.Queue()  # API daemon --> coro
+        if cfg.get("is_ipc_codec", False):
+            queue_to_api = fl.net.ipc.EncodedQueue(queue_to_api)
+            queue_from_api = fl.net.ipc.EncodedQueue(queue_from_api)
         cfg["queue_to_api"] = queue_to_api
         cfg["queue_from_api"] = queue_from_api
         daemon = multiprocessing.Process(
@@ -375,6 +1077,10 @@ def coro_request_handler(cfg):
     #
     list_to_api = list()
     list_from_api = list()
+    if not cfg["is_async"]:
+        map_retry = _retry_policy(cfg)
+        map_breaker = _circuit_breakers(cfg)
+        cache = _response_cache(cfg)
 
     while True:
         list_to_api.clear()
@@ -416,6 +1122,9 @@ def coro_request_handler(cfg):
                         default=cfg["default"],
                         is_bit=cfg["is_bit"],
                         log_event=log_event,
+                        map_retry=map_retry,
+                        map_breaker=map_breaker,
+                        cache=cache,
                     )
                 )
 
@@ -432,7 +1141,8 @@ def _daemon_main(cfg):
     """
     Service the request queue, forwarding requests to the OpenAI API.
 
-    Each request in the queue is processed,
+    Up to count_parallel requests from the
+    queue are processed at the same time,
     pausing for secs_interval if no request
     is available at that time.
 
@@ -464,330 +1174,2306 @@ def _daemon_main(cfg):
     )
 
     openai.api_key = cfg["api_key"]
+    if cfg.get("api_base", None) is not None:
+        openai.api_base = cfg["api_base"]
+
+    log_event.info("OpenAI client is ready.")
+
+    asyncio.run(_daemon_loop(cfg, log_event, handler_log_event))
+
+
+# -----------------------------------------------------------------------------
+async def _daemon_loop(cfg, log_event, handler_log_event):
+    """
+    Service the request queue with up to count_parallel requests in flight.
+
+    Requests are taken from queue_to_api as
+    they arrive and wait for a free slot in
+    arrival order. Requests which join a
+    Flight take no slot. Results are put onto
+    queue_from_api in the order in which they
+    complete, each carrying the state from
+    its request.
+
+    If cfg["priority"] is set, the backlog is
+    instead kept in a PriorityScheduler, and
+    requests are started in order of their
+    priority class.
+
+    A request which cannot be processed, for
+    example because it is invalid, still gets
+    a result, with an error and its state.
+
+    """
+
     queue_from_api = cfg["queue_from_api"]
     queue_to_api = cfg["queue_to_api"]
+    count_parallel = cfg.get("count_parallel", 1)
+    map_task = dict()  # task -> list(request_raw)
 
-    log_event.info("OpenAI client is ready.")
+    # Requests which join a Flight only wait
+    # for its leader, so they do not count
+    # against count_parallel.
+    #
+    map_flight = dict() if cfg.get("is_single_flight", True) else None
+    map_key_flight = dict()  # task -> key_flight, for leaders
+    map_prepared = dict()  # id(request_raw) -> (prepared, key_flight)
+    map_wait_join = dict()  # key_flight -> list((request_raw, prepared))
+    set_join = set()  # task
+    queue_wait = collections.deque()  # request_raw
+
+    # Requests are paced to stay within the
+    # per-model request and token limits in
+    # cfg["rate_limit"], if configured.
+    #
+    limiter = None
+    if cfg.get("rate_limit", None):
+        limiter = RateLimiter(cfg["rate_limit"])
+
+    # Transient errors are retried after a
+    # backoff, and requests fail fast while
+    # the circuit breaker for their endpoint
+    # and model is open.
+    #
+    map_retry = _retry_policy(cfg)
+    map_breaker = _circuit_breakers(cfg)
 
-    while True:
-        # Attempt to retrieve the next request
-        # from the system. If there are no
-        # available requests, sleep for a short
-        # period so we don't end up consuming too
-        # much CPU. If a request is found, forward
-        # it to OpenAI. If a response is received
-        # from OpenAI, add it to the queue to be
-        # sent back to the rest of the system.
-        #
-        try:
-            request = queue_to_api.get(block=False)
-        except queue.Empty:
-            time.sleep(cfg["secs_interval"])
-        else:
-            list_msg = _process_one_request(
-                request_raw=request,
-                default=cfg["default"],
-                is_bit=cfg["is_bit"],
-                log_event=log_event,
-            )
-            for msg in list_msg:
+    # Responses to identical requests are
+    # served from the cache, for endpoints
+    # which opt in with cfg["cache"].
+    #
+    cache = _response_cache(cfg)
+
+    kwargs_request = dict(
+        default=cfg["default"],
+        is_bit=cfg["is_bit"],
+        log_event=log_event,
+        limiter=limiter,
+        map_retry=map_retry,
+        map_breaker=map_breaker,
+        cache=cache,
+        fcn_emit=functools.partial(_put_nowait, queue_from_api, log_event),
+        secs_stream_delta=cfg.get("secs_stream_delta", 0.1),
+        map_flight=map_flight,
+    )
+
+    # Embedding requests with the same model
+    # and parameters which arrive within a
+    # short window are sent as one request,
+    # if enabled with cfg["embedding_batch"].
+    # Each pending batch takes no slot until
+    # it is sent.
+    #
+    cfg_batch = None
+    if cfg.get("embedding_batch", None) is not None and not cfg["is_bit"]:
+        cfg_batch = dict(MAP_EMBEDDING_BATCH_DEFAULT, **cfg["embedding_batch"])
+    map_batch = dict()  # key_batch -> EmbeddingBatch
+
+    # Interactive requests may be started
+    # ahead of a backlog of bulk requests, if
+    # enabled with cfg["priority"].
+    #
+    scheduler = None
+    if cfg.get("priority", None) is not None:
+        scheduler = PriorityScheduler(**dict(MAP_PRIORITY_DEFAULT, **cfg["priority"]))
+
+    # All requests share one aiohttp session,
+    # and so one connection pool, rather than
+    # the openai library opening a new session
+    # for each request.
+    #
+    async with aiohttp.ClientSession() as session:
+        openai.aiosession.set(session)
+
+        while True:
+            # Take every request off the queue. A
+            # request which is identical to one in
+            # flight joins its Flight straight away,
+            # as it takes no slot, and one which is
+            # identical to a waiting request joins
+            # once that one starts. The rest wait
+            # for a free slot, in order of priority
+            # if a scheduler is configured.
+            #
+            while True:
                 try:
-                    queue_from_api.put(msg, block=False)
-                except queue.Full as error:
-                    log_event.exception(
-                        "One or more log_metric messages "
-                        "dropped. queue_from_api is full."
+                    request = queue_to_api.get(block=False)
+                except queue.Empty:
+                    break
+                if (
+                    map_flight is not None
+                    and not cfg["is_bit"]
+                    and (
+                        cfg_batch is None or not _is_embedding(request, cfg["default"])
+                    )
+                ):
+                    item_flight = _prepare_flight(
+                        request, cfg["default"], log_event, kwargs_request["fcn_emit"]
+                    )
+                    if item_flight is None:
+                        continue
+                    (prepared, key_flight) = item_flight
+                    if _has_leader(key_flight, map_flight, map_key_flight):
+                        task = asyncio.create_task(
+                            _process_one_request_async(
+                                request_raw=request, prepared=prepared, **kwargs_request
+                            )
+                        )
+                        map_task[task] = [request]
+                        set_join.add(task)
+                        continue
+                    if key_flight in map_wait_join:
+                        map_wait_join[key_flight].append((request, prepared))
+                        continue
+                    if key_flight is not None:
+                        map_wait_join[key_flight] = list()
+                    map_prepared[id(request)] = item_flight
+                if scheduler is None:
+                    queue_wait.append(request)
+                else:
+                    scheduler.push(request)
+
+            # Start as many waiting requests as
+            # there are free slots. If nothing is
+            # in flight, sleep for a short period
+            # so we don't end up consuming too much
+            # CPU. Otherwise, wait for a request
+            # to complete, or for secs_interval
+            # to pass, whichever is sooner.
+            #
+            while len(map_task) - len(set_join) < count_parallel:
+                if scheduler is None:
+                    if not queue_wait:
+                        break
+                    request = queue_wait.popleft()
+                else:
+                    item_next = scheduler.pop()
+                    if item_next is None:
+                        break
+                    (request, id_priority, secs_wait) = item_next
+                    kwargs_request["fcn_emit"](
+                        _metric(
+                            request,
+                            "priority.secs_wait.{id}".format(id=id_priority),
+                            secs_wait,
+                        )
                     )
 
-        # Attempt to send any available event log
-        # line items to the rest of the system.
-        #
-        while handler_log_event.list_event:
-            try:
-                queue_from_api.put(handler_log_event.list_event.pop(0), block=False)
-            except queue.Full:
-                log_event.exception(
-                    "One or more log_event messages " "dropped. queue_from_api is full."
+                if cfg_batch is None or not _is_embedding(request, cfg["default"]):
+                    (prepared, key_flight) = map_prepared.pop(id(request), (None, None))
+                    task = asyncio.create_task(
+                        _process_one_request_async(
+                            request_raw=request, prepared=prepared, **kwargs_request
+                        )
+                    )
+                    map_task[task] = [request]
+                    if key_flight is None:
+                        continue
+                    if _has_leader(key_flight, map_flight, map_key_flight):
+                        set_join.add(task)
+                    else:
+                        map_key_flight[task] = key_flight
+                    for request, prepared in map_wait_join.pop(key_flight, ()):
+                        task = asyncio.create_task(
+                            _process_one_request_async(
+                                request_raw=request, prepared=prepared, **kwargs_request
+                            )
+                        )
+                        map_task[task] = [request]
+                        set_join.add(task)
+                    continue
+
+                key_batch = _embedding_batch_key(request, cfg["default"])
+                list_input = _list_input(request.get("input", None))
+                count_token = estimate_tokens(dict(input=list_input))
+                batch = map_batch.get(key_batch, None)
+                if batch is not None and not batch.has_room(
+                    len(list_input), count_token, cfg_batch
+                ):
+                    list_request = map_batch.pop(key_batch).list_request
+                    task = asyncio.create_task(
+                        _process_embedding_batch(
+                            list_request_raw=list_request, **kwargs_request
+                        )
+                    )
+                    map_task[task] = list_request
+                    batch = None
+                if batch is None:
+                    batch = EmbeddingBatch(secs_window=cfg_batch["secs_window"])
+                    map_batch[key_batch] = batch
+                batch.add(request, len(list_input), count_token)
+
+            # Send any batches whose window has
+            # passed, while there are free slots.
+            #
+            time_now = time.monotonic()
+            for key_batch in list(map_batch):
+                if len(map_task) - len(set_join) >= count_parallel:
+                    break
+                if map_batch[key_batch].time_due <= time_now:
+                    list_request = map_batch.pop(key_batch).list_request
+                    task = asyncio.create_task(
+                        _process_embedding_batch(
+                            list_request_raw=list_request, **kwargs_request
+                        )
+                    )
+                    map_task[task] = list_request
+
+            # Batches can only be sent when a slot
+            # is free, so their deadline is only
+            # relevant until every slot is busy.
+            #
+            secs_timeout = cfg["secs_interval"]
+            if map_batch and len(map_task) - len(set_join) < count_parallel:
+                time_due = min(batch.time_due for batch in map_batch.values())
+                secs_timeout = max(0.0, min(secs_timeout, time_due - time_now))
+
+            if map_task:
+                (set_done, _) = await asyncio.wait(
+                    map_task,
+                    timeout=secs_timeout,
+                    return_when=asyncio.FIRST_COMPLETED,
                 )
+            else:
+                set_done = set()
+                await asyncio.sleep(secs_timeout)
+
+            # Requests which fail are given an
+            # error result, so that their callers
+            # are not left waiting, and the loop
+            # carries on with the rest.
+            #
+            for task in set_done:
+                list_request = map_task.pop(task)
+                map_key_flight.pop(task, None)
+                set_join.discard(task)
+                try:
+                    list_msg = task.result()
+                except RuntimeError as err:
+                    log_event.error("Invalid request: {err}".format(err=err))
+                    list_msg = list(
+                        _error_result(request, str(err)) for request in list_request
+                    )
+                except Exception as err:  # pylint: disable=W0703
+                    log_event.exception("Unexpected error processing request.")
+                    str_error = "Unexpected error: {err}".format(err=err)
+                    list_msg = list(
+                        _error_result(request, str_error) for request in list_request
+                    )
+                for msg in list_msg:
+                    try:
+                        queue_from_api.put(msg, block=False)
+                    except queue.Full as error:
+                        log_event.exception(
+                            "One or more log_metric messages "
+                            "dropped. queue_from_api is full."
+                        )
+
+            # Attempt to send any available event log
+            # line items to the rest of the system.
+            #
+            while handler_log_event.list_event:
+                try:
+                    queue_from_api.put(handler_log_event.list_event.pop(0), block=False)
+                except queue.Full:
+                    log_event.exception(
+                        "One or more log_event messages "
+                        "dropped. queue_from_api is full."
+                    )
 
 
 # -----------------------------------------------------------------------------
-def _process_one_request(request_raw, default, is_bit, log_event):
+def _process_one_request(
+    request_raw,
+    default,
+    is_bit,
+    log_event,
+    map_retry=None,
+    map_breaker=None,
+    cache=None,
+):
     """
-    Process a single request dict, returning a result dict.
-
-    The request_raw data structure is augmented
-    with information taken from the configured
-    default parameter values to produce a fully
-    specified request_full data structre.
+    Process a single request dict, returning a list of result and metric dicts.
 
-    At the same time, we determine the function
-    to call to interact with the required OpenAI
-    endpoint, any process state from request_raw
-    to pass back to the process engine, and the
-    built-in-test response to return if the bit
-    flag is set.
+    The request is sent with the blocking
+    openai endpoint function, so any retries
+    block the caller. Streamed responses are
+    read to the end before returning, and any
+    openai_result_delta items come first.
 
     """
-    (
-        fcn_endpoint,
-        request_full,
-        state,
-        response_bit,
-    ) = _build_endpoint_specific_parameters(request_raw=request_raw, default=default)
 
-    result = dict(
-        type="openai_result",
-        request=request_full,
-        response=None,
-        error=None,
-        state=state,
+    (fcn_endpoint, request_full, result, response_bit) = _prepare_request(
+        request_raw=request_raw, default=default
     )
-    list_msg = [result]
 
     if is_bit:
         result["response"] = response_bit
-    else:
+        return [result]
+
+    if result["error"] is not None:
+        log_event.warning(result["error"])
+        return [result, _metric(request_raw, "budget.count_reject", 1)]
+
+    id_endpoint = request_raw.get("id_endpoint", None) or default["id_endpoint"]
+    (key_cache, list_metric) = _lookup_cache(
+        cache, id_endpoint, request_full, result, request_raw
+    )
+    if result["response"] is not None:
+        return [result] + list_metric
+
+    breaker = _breaker_for(map_breaker, id_endpoint, request_full)
+    list_delta = list()
+    count_retry = 0
+    while True:
+        if breaker is not None and not breaker.is_allowed():
+            return _fail_fast(result, request_raw, log_event) + list_metric
+
         log_event.info("Make request to OpenAI API.")
+        assembler = None
         try:
-            result["response"] = fcn_endpoint(**request_full)
+            response = fcn_endpoint(**request_full)
+            if request_full.get("stream", False):
+                assembler = StreamAssembler(result["state"], list_delta.append, 0.0)
+                response = assembler.consume(response)
+            result["response"] = response
         except openai.OpenAIError as err:
-            result["error"] = err.user_message
-            log_event.exception(
-                "Error calling OpenAI: " "{msg}.".format(msg=err.user_message)
+            # A stream which fails part way through
+            # is not retried, as its partial text
+            # has already been passed on.
+            #
+            is_started = assembler is not None and assembler.is_started
+            secs_retry = _secs_before_retry(
+                err,
+                count_retry,
+                None if is_started else map_retry,
+                breaker,
+                log_event,
             )
+            if secs_retry is None:
+                result["error"] = err.user_message
+                list_metric.extend(_retry_metric(request_raw, count_retry))
+                return list_delta + [result] + list_metric
+            count_retry += 1
+            time.sleep(secs_retry)
         else:
-            try:
-                count_token = result["response"]["usage"]["total_tokens"]
-            except KeyError as err:
-                log_event.info(
-                    "Response recieved from the OpenAI API. " "(No token count)."
-                )
-            else:
-                log_event.info(
-                    "Response recieved from the OpenAI API. "
-                    "{num} tokens used in total.".format(num=count_token)
-                )
-                unix_time = request_raw.get("unix_time", 0)
-                pnct = string.punctuation
-                id_model = request_raw.get("model", "")
-                id_model = "".join((ch for ch in id_model if ch not in pnct))
-                map_state = request_raw.get("state", dict())
-                id_prompt = map_state.get("id_prompt", "")
-                id_session = map_state.get("id_session", "")
-                id_metric = "tokens.total"
-                if id_model:
-                    id_metric += "." + id_model
-                if id_prompt:
-                    id_metric += "." + id_prompt
-                if id_session:
-                    id_metric += "." + id_session
-                list_msg.append(
-                    dict(
-                        type="log_metric",
-                        created=unix_time,
-                        id=id_metric,
-                        value=count_token,
-                    )
-                )
+            if breaker is not None:
+                breaker.record_success()
+            break
 
-    return list_msg
+    if key_cache is not None:
+        cache.put(id_endpoint, key_cache, result["response"])
+    list_metric.extend(_retry_metric(request_raw, count_retry))
+    return list_delta + _complete_request(result, request_raw, log_event) + list_metric
 
 
 # -----------------------------------------------------------------------------
-def _build_endpoint_specific_parameters(request_raw, default):
+async def _process_one_request_async(
+    request_raw,
+    default,
+    is_bit,
+    log_event,
+    limiter=None,
+    map_retry=None,
+    map_breaker=None,
+    cache=None,
+    fcn_emit=None,
+    secs_stream_delta=0.1,
+    map_flight=None,
+    prepared=None,
+):
     """
-    Return a length 4 tuple with endpoint specific parameters.
+    Process a single request dict, returning a list of result and metric dicts.
 
-    The returned tuple contains:-
+    The request is sent with the async
+    variant of the openai endpoint function,
+    so many requests can be in flight at the
+    same time.
 
-        1. The openai function to call for the requested endpoint.
-        2. The request parameters fully fleshed out with default values.
-        3. Process state.
-        4. A built-in-test response to use when the bit flag is enabled.
+    If a RateLimiter is given, the request
+    waits until it is within the limits for
+    its model before each attempt is sent.
 
-    This information is extracted from the
-    input request_raw structure combined with
-    default values extracted from the supplied
-    configuration data.
+    Transient errors are retried according
+    to map_retry. The backoff is awaited, so
+    other requests carry on in the meantime.
+
+    Responses for cacheable requests are
+    looked up in, and added to, the cache.
+
+    Text from streamed responses is passed
+    to fcn_emit as openai_result_delta items
+    while the response arrives, or returned
+    ahead of the result if fcn_emit is None.
+
+    If map_flight is given, a request which
+    is identical to one already in flight is
+    not sent again, but joins that Flight
+    and gets a copy of its outcome.
+
+    If prepared is given, it is the return
+    value of _prepare_request for request_raw,
+    which is then not prepared again.
 
     """
 
-    # Determine which endpoint is being requested.
-    #
-    id_endpoint = request_raw.get("id_endpoint", None)
-    if id_endpoint is None:
-        id_endpoint = default.get("id_endpoint", None)
-    if id_endpoint is None:
-        raise RuntimeError("Could not determine endpoint.")
+    if prepared is None:
+        prepared = _prepare_request(request_raw=request_raw, default=default)
+    (fcn_endpoint, request_full, result, response_bit) = prepared
 
-    # Determine which endpoint API callback to use.
+    if is_bit:
+        result["response"] = response_bit
+        return [result]
+
+    if result["error"] is not None:
+        log_event.warning(result["error"])
+        return [result, _metric(request_raw, "budget.count_reject", 1)]
+
+    # The openai library provides an async
+    # variant of each endpoint function, named
+    # with an "a" prefix. For example,
+    # ChatCompletion.acreate for
+    # ChatCompletion.create, or
+    # Audio.atranscribe for Audio.transcribe.
     #
-    map_fcn_endpoint = dict(
-        completions=openai.Completion.create,
-        chat_completions=openai.ChatCompletion.create,
-        edits=openai.Edit.create,
-        images_generations=openai.Image.create,
-        images_edits=openai.Image.create_edit,
-        images_variations=openai.Image.create_variation,
-        embeddings=openai.Embedding.create,
-        audio_transcriptions=openai.Audio.transcribe,
-        audio_translations=openai.Audio.translate,
-    )
-    fcn_endpoint = map_fcn_endpoint[id_endpoint]
+    fcn_endpoint_async = getattr(fcn_endpoint.__self__, "a" + fcn_endpoint.__name__)
 
-    # Determine how to handle request parameters.
-    #
-    # Tuple is (required-internally, required-OpenAI, name-in-api, type)
-    #
-    Y = True
-    N = False
-    map_tup_tup_param = dict(  # RI, RO, name-api,           type
-        completions=(
-            (N, Y, "model", (str,)),
-            (Y, N, "prompt", (str, list)),
-            (N, N, "suffix", (str,)),
-            (N, N, "max_tokens", (int,)),
-            (N, N, "temperature", (float,)),
-            (N, N, "top_p", (float,)),
-            (N, N, "n", (int,)),
-            (N, N, "stream", (bool,)),
-            (N, N, "logprobs", (int,)),
-            (N, N, "echo", (bool,)),
-            (N, N, "stop", (str, list)),
-            (N, N, "presence_penalty", (float,)),
-            (N, N, "frequency_penalty", (float,)),
-            (N, N, "best_of", (int,)),
-            (N, N, "logit_bias", (dict,)),
-            (N, N, "user", (str,)),
-        ),
-        chat_completions=(
-            (N, Y, "model", (str,)),
-            (Y, Y, "messages", (list,)),
-            (N, N, "temperature", (float,)),
-            (N, N, "top_p", (float,)),
-            (N, N, "n", (int,)),
-            (N, N, "stream", (bool,)),
-            (N, N, "stop", (str, list)),
-            (N, N, "max_tokens", (int,)),
-            (N, N, "presence_penalty", (float,)),
-            (N, N, "frequency_penalty", (float,)),
-            (N, N, "logit_bias", (dict,)),
-            (N, N, "user", (str,)),
-        ),
-        edits=(
-            (N, Y, "model", (str,)),
-            (Y, N, "input", (str,)),
-            (Y, Y, "instruction", (str,)),
-            (N, N, "n", (int,)),
-            (N, N, "temperature", (float,)),
-            (N, N, "top_p", (float,)),
-        ),
-        images_generations=(
-            (Y, Y, "prompt", (str,)),
-            (N, N, "n", (int,)),
-            (N, N, "size", (str,)),
-            (N, N, "response_format", (str,)),
-            (N, N, "user", (str,)),
-        ),
-        images_edits=(
-            (Y, Y, "image", (str,)),
-            (N, N, "mask", (str,)),
-            (Y, Y, "prompt", (str,)),
-            (N, N, "n", (int,)),
-            (N, N, "size", (str,)),
-            (N, N, "response_format", (str,)),
-            (N, N, "user", (str,)),
-        ),
-        images_variations=(
-            (Y, Y, "image", (str,)),
-            (N, N, "n", (int,)),
-            (N, N, "size", (str,)),
-            (N, N, "response_format", (str,)),
-            (N, N, "user", (str,)),
-        ),
-        embeddings=(
-            (N, Y, "model", (str,)),
-            (Y, Y, "input", (str, list)),
-            (N, N, "user", (str,)),
-        ),
-        audio_transcriptions=(
-            (Y, Y, "file", (str,)),
-            (N, Y, "model", (str,)),
-            (N, N, "prompt", (str,)),
-            (N, N, "response_format", (str,)),
-            (N, N, "temperature", (float,)),
-            (N, N, "language", (str,)),
-        ),
-        audio_translations=(
-            (Y, Y, "file", (str,)),
-            (N, Y, "model", (str,)),
-            (N, N, "prompt", (str,)),
-            (N, N, "response_format", (str,)),
-            (N, N, "temperature", (float,)),
-        ),
+    id_endpoint = request_raw.get("id_endpoint", None) or default["id_endpoint"]
+    (key_cache, list_metric) = _lookup_cache(
+        cache, id_endpoint, request_full, result, request_raw
     )
+    if result["response"] is not None:
+        return [result] + list_metric
 
-    # Build the fully fleshed out request_full
-    # data structure.
-    #
-    request_full = dict()
-    tup_tup_param = map_tup_tup_param[id_endpoint]
-    for (
-        is_required_by_internal_api,  # Cannot be given a default value.
-        is_required_by_openai_api,  # Must be given a value of some sort.
-        id_param,
-        tup_type,
-    ) in tup_tup_param:
-        # Try to get value from request_raw.
-        #
-        param = request_raw.get(id_param, None)
-        if param is not None:
-            _check_type(id_param, param, tup_type)
-            request_full[id_param] = param
-            continue
+    list_delta = list()
+    if fcn_emit is None:
+        fcn_emit = list_delta.append
 
-        if is_required_by_internal_api:
-            msg = "{id} not in request_raw".format(id=id_param)
-            log_event.error(msg)
-            raise RuntimeError(msg)
+    # Identical requests which are already in
+    # flight are joined rather than sent.
+    #
+    flight = None
+    if map_flight is not None:
+        key_flight = key_cache or _request_key(id_endpoint, request_full)
+        flight = map_flight.get(key_flight, None)
+        if flight is not None:
+            await flight.join(result, fcn_emit)
+            return list_delta + [result, _metric(request_raw, "flight.count_join", 1)]
+        flight = Flight(fcn_emit)
+        map_flight[key_flight] = flight
+        fcn_emit = flight.emit
+
+    id_model = request_full.get("model", "")
+    breaker = _breaker_for(map_breaker, id_endpoint, request_full)
+    if limiter is not None:
+        count_token_estimate = estimate_tokens(request_full)
+
+    try:
+        count_retry = 0
+        while True:
+            if breaker is not None and not breaker.is_allowed():
+                return _fail_fast(result, request_raw, log_event) + list_metric
+
+            if limiter is not None:
+                secs_wait = await limiter.acquire(id_model, count_token_estimate)
+                if secs_wait > 0:
+                    list_metric.append(
+                        _metric(request_raw, "ratelimit.secs_wait", secs_wait)
+                    )
 
-        # Try to get value from default.
+            log_event.info("Make request to OpenAI API.")
+            assembler = None
+            try:
+                response = await fcn_endpoint_async(**request_full)
+                if request_full.get("stream", False):
+                    assembler = StreamAssembler(
+                        result["state"], fcn_emit, secs_stream_delta
+                    )
+                    response = await assembler.consume_async(response)
+                result["response"] = response
+            except openai.OpenAIError as err:
+                # A failed attempt gives back the
+                # tokens it reserved, unless the API
+                # says that the limit is used up.
+                #
+                if limiter is not None:
+                    if isinstance(err, openai.error.RateLimitError):
+                        limiter.drain(id_model)
+                    else:
+                        limiter.correct(id_model, -count_token_estimate)
+                is_started = assembler is not None and assembler.is_started
+                secs_retry = _secs_before_retry(
+                    err,
+                    count_retry,
+                    None if is_started else map_retry,
+                    breaker,
+                    log_event,
+                )
+                if secs_retry is None:
+                    result["error"] = err.user_message
+                    list_metric.extend(_retry_metric(request_raw, count_retry))
+                    return list_delta + [result] + list_metric
+                count_retry += 1
+                await asyncio.sleep(secs_retry)
+            else:
+                if breaker is not None:
+                    breaker.record_success()
+                break
+
+        if limiter is not None:
+            try:
+                count_token = result["response"]["usage"]["total_tokens"]
+            except KeyError:
+                pass
+            else:
+                limiter.correct(id_model, count_token - count_token_estimate)
+
+        if key_cache is not None:
+            cache.put(id_endpoint, key_cache, result["response"])
+        list_metric.extend(_retry_metric(request_raw, count_retry))
+        list_msg = _complete_request(result, request_raw, log_event)
+        return list_delta + list_msg + list_metric
+    finally:
+        if flight is not None:
+            del map_flight[key_flight]
+            flight.land(result)
+
+
+# -----------------------------------------------------------------------------
+async def _process_embedding_batch(list_request_raw, default, log_event, **kwargs):
+    """
+    Process a batch of embedding requests with a single API request.
+
+    Each request is looked up in the cache
+    on its own. The inputs of the rest are
+    concatenated into one request, and the
+    embeddings in the response are split
+    back into one result per request, with
+    indices relative to that request and
+    with its own state. Token counts are
+    only reported for the batch as a whole.
+
+    """
+
+    list_msg = list()
+    list_pending = list()  # (request_raw, result, key_cache, count_input)
+    cache = kwargs.pop("cache", None)
+    for request_raw in list_request_raw:
+        try:
+            (_, request_full, result, _) = _prepare_request(
+                request_raw=request_raw, default=default
+            )
+        except RuntimeError as err:
+            log_event.error("Invalid request: {err}".format(err=err))
+            list_msg.append(_error_result(request_raw, str(err)))
+            continue
+
+        (key_cache, list_metric) = _lookup_cache(
+            cache, "embeddings", request_full, result, request_raw
+        )
+        list_msg.extend(list_metric)
+        if result["response"] is not None:
+            list_msg.append(result)
+            continue
+        list_pending.append(
+            (request_raw, result, key_cache, len(_list_input(request_full["input"])))
+        )
+
+    if not list_pending:
+        return list_msg
+
+    # Requests in a batch share every parameter
+    # other than the input, so the parameters
+    # of the first are used for the batch.
+    #
+    (request_raw, result, _, _) = list_pending[0]
+    request_batch = dict(
+        result["request"],
+        id_endpoint="embeddings",
+        input=list(
+            item
+            for (_, result, _, _) in list_pending
+            for item in _list_input(result["request"]["input"])
+        ),
+        unix_time=request_raw.get("unix_time", 0),
+    )
+    (result_batch, *list_metric) = await _process_one_request_async(
+        request_raw=request_batch, default=default, log_event=log_event, **kwargs
+    )
+    list_msg.extend(list_metric)
+    list_msg.append(_metric(request_batch, "embeddings.count_batch", len(list_pending)))
+
+    if result_batch["error"] is None:
+        response = result_batch["response"]
+        list_data = sorted(response["data"], key=lambda item: item["index"])
+
+    idx_start = 0
+    for request_raw, result, key_cache, count_input in list_pending:
+        if result_batch["error"] is not None:
+            result["error"] = result_batch["error"]
+            list_msg.append(result)
+            continue
+        result["response"] = openai.util.convert_to_openai_object(
+            dict(
+                object=response.get("object", "list"),
+                model=response.get("model", request_batch["model"]),
+                data=list(
+                    dict(item, index=idx)
+                    for (idx, item) in enumerate(
+                        list_data[idx_start : idx_start + count_input]
+                    )
+                ),
+            )
+        )
+        idx_start += count_input
+        if key_cache is not None:
+            cache.put("embeddings", key_cache, result["response"])
+        list_msg.append(result)
+
+    return list_msg
+
+
+# -----------------------------------------------------------------------------
+def _is_embedding(request_raw, default):
+    """
+    Return True if request_raw is for the embeddings endpoint.
+
+    """
+
+    id_endpoint = request_raw.get("id_endpoint", None) or default.get("id_endpoint")
+    return id_endpoint == "embeddings"
+
+
+# -----------------------------------------------------------------------------
+def _embedding_batch_key(request_raw, default):
+    """
+    Return the key of the embedding batch which request_raw may join.
+
+    Requests are only batched together if
+    they have the same parameters, other
+    than the input, once merged with the
+    defaults. Inputs which are strings and
+    inputs which are arrays of tokens cannot
+    be mixed in one request, so they are
+    batched separately.
+
+    """
+
+    schema = MAP_SCHEMA_ENDPOINT["embeddings"]
+    map_param = {
+        id_param: value
+        for (id_param, value) in default.items()
+        if value is not None and id_param in schema.set_id_param_default
+    }
+    map_param.update(
+        (id_param, value)
+        for (id_param, value) in request_raw.items()
+        if value is not None and id_param in schema.map_type
+    )
+    input_raw = map_param.pop("input", None)
+    is_token = isinstance(_list_input(input_raw)[0], list)
+    return (is_token, repr(sorted(map_param.items())))
+
+
+# -----------------------------------------------------------------------------
+def _list_input(input_raw):
+    """
+    Return the list of inputs in an embeddings input parameter.
+
+    The input may be a string, a list of
+    strings, a list of tokens (a single
+    input) or a list of lists of tokens.
+
+    """
+
+    if isinstance(input_raw, list) and input_raw:
+        if isinstance(input_raw[0], (str, list)):
+            return input_raw
+    return [input_raw]
+
+
+# -----------------------------------------------------------------------------
+def _put_nowait(queue_from_api, log_event, item):
+    """
+    Put an item onto queue_from_api without blocking, logging if it is full.
+
+    """
+
+    try:
+        queue_from_api.put(item, block=False)
+    except queue.Full:
+        log_event.error(
+            "One or more {type} messages dropped. "
+            "queue_from_api is full.".format(type=item["type"])
+        )
+
+
+# -----------------------------------------------------------------------------
+def _retry_policy(cfg):
+    """
+    Return the retry policy for each error class, or None to never retry.
+
+    cfg["retry"] is merged over the default
+    policies in MAP_RETRY_DEFAULT, and a
+    class can be excluded from retries by
+    mapping it to None. Setting cfg["retry"]
+    itself to None disables all retries.
+
+    """
+
+    cfg_retry = cfg.get("retry", dict())
+    if cfg_retry is None:
+        return None
+
+    map_retry = dict()
+    for id_error, policy in MAP_RETRY_DEFAULT.items():
+        if id_error in cfg_retry:
+            if cfg_retry[id_error] is None:
+                map_retry[id_error] = None
+                continue
+            policy = dict(policy, **cfg_retry[id_error])
+        map_retry[id_error] = policy
+    return map_retry
+
+
+# -----------------------------------------------------------------------------
+def _circuit_breakers(cfg):
+    """
+    Return a map of circuit breakers created on first use, or None.
+
+    Breakers are keyed by endpoint and model
+    and configured with cfg["circuit_breaker"].
+    Setting that to None disables them.
+
+    """
+
+    cfg_breaker = cfg.get("circuit_breaker", dict())
+    if cfg_breaker is None:
+        return None
+    return collections.defaultdict(functools.partial(CircuitBreaker, **cfg_breaker))
+
+
+# -----------------------------------------------------------------------------
+def _breaker_for(map_breaker, id_endpoint, request_full):
+    """
+    Return the circuit breaker for the endpoint and model of a request.
+
+    """
+
+    if map_breaker is None:
+        return None
+    return map_breaker[(id_endpoint, request_full.get("model", ""))]
+
+
+# -----------------------------------------------------------------------------
+def _response_cache(cfg):
+    """
+    Return a ResponseCache configured with cfg["cache"], or None.
+
+    """
+
+    cfg_cache = cfg.get("cache", None)
+    if not cfg_cache:
+        return None
+    return ResponseCache(**cfg_cache)
+
+
+# -----------------------------------------------------------------------------
+def _request_key(id_endpoint, request_full):
+    """
+    Return a canonical hash of a request, for the cache and for flights.
+
+    Parameters which do not change the
+    response are left out.
+
+    """
+
+    request_key = dict(
+        (key, value)
+        for (key, value) in request_full.items()
+        if key not in SET_PARAM_UNCACHED
+    )
+    data = json.dumps((id_endpoint, request_key), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+# -----------------------------------------------------------------------------
+def _prepare_flight(request_raw, default, log_event, fcn_emit):
+    """
+    Return a prepared request and the key of its Flight, or None on error.
+
+    The key is None for requests which are
+    rejected before they are sent. Requests
+    which cannot be prepared are passed to
+    fcn_emit as an error result instead.
+
+    """
+
+    try:
+        prepared = _prepare_request(request_raw=request_raw, default=default)
+    except RuntimeError as err:
+        log_event.error("Invalid request: {err}".format(err=err))
+        fcn_emit(_error_result(request_raw, str(err)))
+        return None
+    except Exception as err:  # pylint: disable=W0703
+        log_event.exception("Unexpected error processing request.")
+        fcn_emit(_error_result(request_raw, "Unexpected error: {err}".format(err=err)))
+        return None
+
+    (_, request_full, result, _) = prepared
+    if result["error"] is not None:
+        return (prepared, None)
+    id_endpoint = request_raw.get("id_endpoint", None) or default["id_endpoint"]
+    return (prepared, _request_key(id_endpoint, request_full))
+
+
+# -----------------------------------------------------------------------------
+def _has_leader(key_flight, map_flight, map_key_flight):
+    """
+    Return True if a request with key_flight is in flight or already started.
+
+    A leader is only added to map_flight once
+    its task runs, so leaders which have been
+    started but not yet run are looked up in
+    map_key_flight.
+
+    """
+
+    if key_flight is None:
+        return False
+    return key_flight in map_flight or key_flight in map_key_flight.values()
+
+
+# -----------------------------------------------------------------------------
+def _lookup_cache(cache, id_endpoint, request_full, result, request_raw):
+    """
+    Return the cache key for a request and a list of cache metrics.
+
+    If the response is in the cache, it is
+    put into result. The key is None if the
+    request is not cacheable or if it was
+    found in the cache.
+
+    """
+
+    if cache is None:
+        return (None, list())
+
+    key_cache = cache.key(id_endpoint, request_full)
+    if key_cache is None:
+        return (None, list())
+
+    (response, count_byte) = cache.get(key_cache)
+    if response is None:
+        return (key_cache, [_metric(request_raw, "cache.miss", 1)])
+
+    result["response"] = response
+    return (
+        None,
+        [
+            _metric(request_raw, "cache.hit", 1),
+            _metric(request_raw, "cache.bytes_saved", count_byte),
+        ],
+    )
+
+
+# -----------------------------------------------------------------------------
+def _secs_before_retry(err, count_retry, map_retry, breaker, log_event):
+    """
+    Return the delay before the next attempt after err, or None to give up.
+
+    The error is also recorded with the
+    circuit breaker, if there is one. Only
+    errors in SET_ERROR_BREAKER count as
+    failures. Any other response shows
+    that the API is up.
+
+    """
+
+    if breaker is not None:
+        if _error_name(err, SET_ERROR_BREAKER) is None:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+
+    policy = None
+    if map_retry is not None:
+        id_error = _error_name(err, map_retry)
+        if id_error is not None:
+            policy = map_retry[id_error]
+
+    if policy is None or count_retry >= policy["count_retry"]:
+        log_event.exception(
+            "Error calling OpenAI: " "{msg}.".format(msg=err.user_message)
+        )
+        return None
+
+    # Full jitter spreads retries from many
+    # requests which failed together, so
+    # they do not all arrive at once again.
+    #
+    secs_retry = random.uniform(
+        0.0, min(policy["secs_max"], policy["secs_base"] * 2**count_retry)
+    )
+    secs_retry_after = _secs_retry_after(err)
+    if secs_retry_after is not None:
+        secs_retry = max(secs_retry, secs_retry_after)
+
+    log_event.warning(
+        "Error calling OpenAI: {msg}. Retry {num} in {secs:.2f}s.".format(
+            msg=err.user_message, num=count_retry + 1, secs=secs_retry
+        )
+    )
+    return secs_retry
+
+
+# -----------------------------------------------------------------------------
+def _error_name(err, container):
+    """
+    Return the name of the most specific class of err in container, or None.
+
+    """
+
+    for cls in type(err).__mro__:
+        if cls.__name__ in container:
+            return cls.__name__
+    return None
+
+
+# -----------------------------------------------------------------------------
+def _secs_retry_after(err):
+    """
+    Return the delay in the Retry-After header of err in seconds, or None.
+
+    Only the delay-seconds form of the header
+    is supported. OpenAI does not send the
+    HTTP-date form.
+
+    """
+
+    headers = getattr(err, "headers", None) or dict()
+    for key in ("retry-after", "Retry-After"):
+        try:
+            return max(0.0, float(headers[key]))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+# -----------------------------------------------------------------------------
+def _retry_metric(request_raw, count_retry):
+    """
+    Return a list with a retry.count metric, or an empty list if no retries.
+
+    """
+
+    if count_retry == 0:
+        return list()
+    return [_metric(request_raw, "retry.count", count_retry)]
+
+
+# -----------------------------------------------------------------------------
+def _fail_fast(result, request_raw, log_event):
+    """
+    Return a failed result for a request rejected by an open circuit breaker.
+
+    """
+
+    result["error"] = "OpenAI is unavailable. Please try again later."
+    log_event.warning("Request rejected: circuit breaker is open.")
+    return [result, _metric(request_raw, "breaker.count_reject", 1)]
+
+
+# -----------------------------------------------------------------------------
+def _error_result(request_raw, error):
+    """
+    Return a failed result for a request which could not be processed.
+
+    """
+
+    return dict(
+        type="openai_result",
+        request=request_raw,
+        response=None,
+        error=error,
+        state=request_raw.get("state", {}),
+    )
+
+
+# -----------------------------------------------------------------------------
+def _prepare_request(request_raw, default):
+    """
+    Return the endpoint function, full request, empty result and BIT response.
+
+    The request_raw data structure is augmented
+    with information taken from the configured
+    default parameter values to produce a fully
+    specified request_full data structre.
+
+    At the same time, we determine the function
+    to call to interact with the required OpenAI
+    endpoint, any process state from request_raw
+    to pass back to the process engine, and the
+    built-in-test response to return if the bit
+    flag is set.
+
+    Completion requests are also fitted to the
+    context window of a model before they are
+    sent, so if there is no room the result
+    has an error and the request should not
+    be sent.
+
+    """
+
+    (
+        fcn_endpoint,
+        request_full,
+        state,
+        response_bit,
+    ) = _build_endpoint_specific_parameters(request_raw=request_raw, default=default)
+
+    result = dict(
+        type="openai_result",
+        request=request_full,
+        response=None,
+        error=None,
+        state=state,
+    )
+
+    id_endpoint = request_raw.get("id_endpoint", None) or default["id_endpoint"]
+    if id_endpoint in ("completions", "chat_completions"):
+        result["error"] = _fit_to_context(request_raw, default, request_full)
+
+    return (fcn_endpoint, request_full, result, response_bit)
+
+
+# -----------------------------------------------------------------------------
+def _fit_to_context(request_raw, default, request_full):
+    """
+    Choose a model with room for the request, returning an error or None.
+
+    The prompt and max_tokens for the reply
+    must fit in the context window of the
+    model. If request_raw (or default) gives
+    a model_by_context list, the first model
+    in it with room is used instead of the
+    requested model.
+
+    Token counts are local estimates from
+    fl.net.openai.token, so a request which
+    is too long fails at once rather than
+    after a round trip to the API.
+
+    """
+
+    id_model = request_full.get("model", None)
+    tup_id_model = request_raw.get("model_by_context", None)
+    if tup_id_model is None:
+        tup_id_model = default.get("model_by_context", None)
+
+    count_token = fl.net.openai.token.count_request(request_full, id_model)
+    count_token += request_full.get("max_tokens", 0)
+
+    if tup_id_model:
+        id_model_fit = fl.net.openai.token.select_model(count_token, tup_id_model)
+        if id_model_fit is not None:
+            request_full["model"] = id_model_fit
+            return None
+        id_model = tup_id_model[-1]
+
+    count_context = fl.net.openai.token.context_size(id_model)
+    if count_context is None or count_token <= count_context:
+        return None
+
+    return (
+        "Request needs about {num} tokens, which is more than "
+        "the {max} token context of {id}.".format(
+            num=count_token, max=count_context, id=id_model
+        )
+    )
+
+
+# -----------------------------------------------------------------------------
+def _complete_request(result, request_raw, log_event):
+    """
+    Return the result, with a token count metric if the response has one.
+
+    """
+
+    list_msg = [result]
+    try:
+        count_token = result["response"]["usage"]["total_tokens"]
+    except KeyError as err:
+        log_event.info("Response recieved from the OpenAI API. " "(No token count).")
+    else:
+        log_event.info(
+            "Response recieved from the OpenAI API. "
+            "{num} tokens used in total.".format(num=count_token)
+        )
+        list_msg.append(_metric(request_raw, "tokens.total", count_token))
+
+    return list_msg
+
+
+# -----------------------------------------------------------------------------
+def _metric(request_raw, id_metric, value):
+    """
+    Return a log_metric item for the specified request.
+
+    The metric id is qualified with the model
+    (without punctuation), prompt and session
+    ids of the request, where available.
+
+    """
+
+    unix_time = request_raw.get("unix_time", 0)
+    pnct = string.punctuation
+    id_model = request_raw.get("model", "")
+    id_model = "".join((ch for ch in id_model if ch not in pnct))
+    map_state = request_raw.get("state", dict())
+    id_prompt = map_state.get("id_prompt", "")
+    id_session = map_state.get("id_session", "")
+    if id_model:
+        id_metric += "." + id_model
+    if id_prompt:
+        id_metric += "." + id_prompt
+    if id_session:
+        id_metric += "." + id_session
+    return dict(
+        type="log_metric",
+        created=unix_time,
+        id=id_metric,
+        value=value,
+    )
+
+
+# -----------------------------------------------------------------------------
+def estimate_tokens(request_full):
+    """
+    Return an estimate of the tokens that request_full will use.
+
+    The estimate is the prompt, messages or
+    input as counted by fl.net.openai.token,
+    plus the maximum number of tokens that may
+    be generated for each of the n choices, as
+    OpenAI counts both against the token rate
+    limit when a request is accepted.
+
+    """
+
+    count_token = fl.net.openai.token.count_request(request_full)
+    count_token += request_full.get("max_tokens", 0) * request_full.get("n", 1)
+    return count_token
+
+
+# =============================================================================
+class TokenBucket:
+    """
+    A token bucket which refills continuously at count_per_minute.
+
+    The bucket holds up to secs_burst worth
+    of refill, which bounds the size of any
+    burst after an idle period. The level may
+    go negative when a take or a correction
+    exceeds what is available, in which case
+    later takes wait until the deficit has
+    been refilled.
+
+    """
+
+    __slots__ = ("capacity", "rate", "level", "time_update")
+
+    # -------------------------------------------------------------------------
+    def __init__(self, count_per_minute, secs_burst=1.0):
+        """
+        Construct a full bucket.
+
+        """
+
+        self.rate = count_per_minute / 60.0
+        self.capacity = self.rate * secs_burst
+        self.level = self.capacity
+        self.time_update = time.monotonic()
+
+    # -------------------------------------------------------------------------
+    def secs_until(self, amount):
+        """
+        Return the time until amount can be taken from the bucket.
+
+        Amounts larger than the capacity wait
+        for a full bucket, so that a single
+        oversized request is not blocked
+        forever.
+
+        """
+
+        time_now = time.monotonic()
+        self.level = min(
+            self.capacity, self.level + self.rate * (time_now - self.time_update)
+        )
+        self.time_update = time_now
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    # -------------------------------------------------------------------------
+    def take(self, amount):
+        """
+        Take amount from the bucket, which may leave it in deficit.
+
+        """
+
+        self.level = min(self.capacity, self.level - amount)
+
+
+# =============================================================================
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute limits for each model.
+
+    map_limit maps model ids to dicts with
+    "rpm" and/or "tpm" keys, and may have a
+    "default" entry for models which are not
+    listed. Requests for models with no limit
+    are not paced.
+
+    OpenAI enforces limits over periods much
+    shorter than a minute, so by default the
+    buckets hold one second of capacity. This
+    can be changed with a "secs_burst" key.
+
+    Requests for each model acquire capacity
+    in FIFO order, so large requests are not
+    starved by a stream of small ones.
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(self, map_limit):
+        """
+        Construct the limiter with full buckets.
+
+        """
+
+        self.map_limit = map_limit
+        self.map_bucket = dict()  # id_model -> (bucket_rpm, bucket_tpm, lock)
+
+    # -------------------------------------------------------------------------
+    def _buckets(self, id_model):
+        """
+        Return (bucket_rpm, bucket_tpm, lock) for the model, or None.
+
+        """
+
+        try:
+            return self.map_bucket[id_model]
+        except KeyError:
+            pass
+
+        limit = self.map_limit.get(id_model, None) or self.map_limit.get("default")
+        if not limit:
+            self.map_bucket[id_model] = None
+            return None
+
+        secs_burst = limit.get("secs_burst", 1.0)
+        bucket_rpm = None
+        if limit.get("rpm", None):
+            bucket_rpm = TokenBucket(limit["rpm"], secs_burst=secs_burst)
+        bucket_tpm = None
+        if limit.get("tpm", None):
+            bucket_tpm = TokenBucket(limit["tpm"], secs_burst=secs_burst)
+        self.map_bucket[id_model] = (bucket_rpm, bucket_tpm, asyncio.Lock())
+        return self.map_bucket[id_model]
+
+    # -------------------------------------------------------------------------
+    async def acquire(self, id_model, count_token):
+        """
+        Wait until a request of count_token tokens is within limits.
+
+        Returns the number of seconds waited.
+
+        """
+
+        buckets = self._buckets(id_model)
+        if buckets is None:
+            return 0.0
+
+        (bucket_rpm, bucket_tpm, lock) = buckets
+        time_start = time.monotonic()
+        async with lock:
+            while True:
+                secs_wait = 0.0
+                if bucket_rpm is not None:
+                    secs_wait = max(secs_wait, bucket_rpm.secs_until(1))
+                if bucket_tpm is not None:
+                    secs_wait = max(secs_wait, bucket_tpm.secs_until(count_token))
+                if secs_wait <= 0.0:
+                    break
+                await asyncio.sleep(secs_wait)
+
+            if bucket_rpm is not None:
+                bucket_rpm.take(1)
+            if bucket_tpm is not None:
+                bucket_tpm.take(count_token)
+
+        return time.monotonic() - time_start
+
+    # -------------------------------------------------------------------------
+    def correct(self, id_model, count_token_delta):
+        """
+        Correct the token bucket once the actual token count is known.
+
+        """
+
+        buckets = self._buckets(id_model)
+        if buckets is not None and buckets[1] is not None:
+            buckets[1].take(count_token_delta)
+
+    # -------------------------------------------------------------------------
+    def drain(self, id_model):
+        """
+        Empty the buckets for the model, e.g. after a 429 from the API.
+
+        """
+
+        buckets = self._buckets(id_model)
+        if buckets is None:
+            return
+        for bucket in buckets[:2]:
+            if bucket is not None:
+                bucket.secs_until(0)
+                bucket.level = min(bucket.level, 0.0)
+
+
+# =============================================================================
+class EmbeddingBatch:
+    """
+    Embedding requests waiting to be sent as a single API request.
+
+    """
+
+    __slots__ = ("list_request", "count_input", "count_token", "time_due")
+
+    # -------------------------------------------------------------------------
+    def __init__(self, secs_window):
+        """
+        Construct an empty batch which is due after secs_window.
+
+        """
+
+        self.list_request = list()
+        self.count_input = 0
+        self.count_token = 0
+        self.time_due = time.monotonic() + secs_window
+
+    # -------------------------------------------------------------------------
+    def has_room(self, count_input, count_token, cfg_batch):
+        """
+        Return True if a request can be added without exceeding either cap.
+
+        """
+
+        return (
+            self.count_input + count_input <= cfg_batch["count_input_max"]
+            and self.count_token + count_token <= cfg_batch["count_token_max"]
+        )
+
+    # -------------------------------------------------------------------------
+    def add(self, request_raw, count_input, count_token):
+        """
+        Add a request to the batch.
+
+        """
+
+        self.list_request.append(request_raw)
+        self.count_input += count_input
+        self.count_token += count_token
+
+
+# =============================================================================
+class PriorityScheduler:
+    """
+    Requests waiting for a slot, queued by priority class.
+
+    Each class has its own FIFO queue, and
+    classes are listed in map_weight in order
+    of priority. If is_strict, the highest
+    priority class with a waiting request is
+    always served first. Otherwise, classes
+    are served in proportion to their weights
+    by stride scheduling, so that bulk work
+    still makes progress.
+
+    In either case, a request which has waited
+    for more than secs_aging is served ahead
+    of the others, oldest first, so that no
+    class is starved.
+
+    """
+
+    __slots__ = (
+        "map_weight",
+        "is_strict",
+        "id_default",
+        "secs_aging",
+        "map_queue",
+        "map_pass",
+        "pass_last",
+        "count_pending",
+    )
+
+    # -------------------------------------------------------------------------
+    def __init__(self, map_weight, is_strict, id_default, secs_aging):
+        """
+        Construct an empty scheduler.
+
+        """
+
+        self.map_weight = dict(map_weight)
+        self.is_strict = is_strict
+        self.id_default = id_default
+        self.secs_aging = secs_aging
+        self.map_queue = dict(
+            (id_priority, collections.deque()) for id_priority in map_weight
+        )
+        self.map_pass = dict.fromkeys(map_weight, 0.0)
+        self.pass_last = 0.0
+        self.count_pending = 0
+
+    # -------------------------------------------------------------------------
+    def push(self, request_raw):
+        """
+        Queue a request in its priority class.
+
+        The class is taken from id_priority in
+        the request, which may be set with the
+        kwargs_req of a template, or else from
+        id_priority in its state. Requests with
+        no class, or an unknown class, go in
+        id_default.
+
+        """
+
+        id_priority = request_raw.get("id_priority", None)
+        if id_priority is None:
+            id_priority = request_raw.get("state", dict()).get("id_priority", None)
+        if id_priority not in self.map_queue:
+            id_priority = self.id_default
+
+        # A class which was idle starts level
+        # with the others rather than with any
+        # credit saved up while it was idle.
         #
-        param = default.get(id_param, None)
-        if param is not None:
-            _check_type(id_param, param, tup_type)
-            request_full[id_param] = param
-            continue
+        queue_priority = self.map_queue[id_priority]
+        if not queue_priority:
+            self.map_pass[id_priority] = max(self.map_pass[id_priority], self.pass_last)
+        queue_priority.append((time.monotonic(), request_raw))
+        self.count_pending += 1
+
+    # -------------------------------------------------------------------------
+    def pop(self):
+        """
+        Return the next (request, id_priority, secs_wait), or None if empty.
+
+        """
+
+        if not self.count_pending:
+            return None
+
+        time_now = time.monotonic()
+        id_oldest = None
+        time_oldest = None
+        for id_priority, queue_priority in self.map_queue.items():
+            if queue_priority and (
+                time_oldest is None or queue_priority[0][0] < time_oldest
+            ):
+                (id_oldest, time_oldest) = (id_priority, queue_priority[0][0])
+
+        if time_now - time_oldest > self.secs_aging:
+            id_next = id_oldest
+        elif self.is_strict:
+            id_next = next(
+                id_priority
+                for (id_priority, queue_priority) in self.map_queue.items()
+                if queue_priority
+            )
+        else:
+            id_next = min(
+                (
+                    id_priority
+                    for (id_priority, queue_priority) in self.map_queue.items()
+                    if queue_priority
+                ),
+                key=self.map_pass.__getitem__,
+            )
 
-        if is_required_by_openai_api:
-            msg = "{id} not in request_raw or default".format(id=id_param)
-            log_event.error(msg)
-            raise RuntimeError(msg)
+        self.pass_last = self.map_pass[id_next]
+        self.map_pass[id_next] += 1.0 / self.map_weight[id_next]
+        (time_queued, request_raw) = self.map_queue[id_next].popleft()
+        self.count_pending -= 1
+        return (request_raw, id_next, time_now - time_queued)
 
-    state = request_raw.get("state", {})
 
-    # Work out the response to give when the
-    # built-in-test flag is enabled.
-    #
-    response_bit = built_in_test_response(id_endpoint)
+# =============================================================================
+class StreamAssembler:
+    """
+    Assemble the chunks of a streamed response into a whole response.
+
+    Text is passed to fcn_emit in
+    openai_result_delta items as it arrives,
+    one per choice. The first text is passed
+    on at once, to minimise the time to the
+    first visible token. After that, text is
+    coalesced over secs_delta so that the
+    number of items crossing the process
+    boundary stays bounded.
+
+    The assembled response has the same
+    shape as one which was not streamed, so
+    consumers of openai_result need no
+    changes. It has no usage, as OpenAI does
+    not report usage for streams.
 
-    return (fcn_endpoint, request_full, state, response_bit)
+    """
 
+    __slots__ = (
+        "state",
+        "fcn_emit",
+        "secs_delta",
+        "map_choice",
+        "map_pending",
+        "chunk_last",
+        "time_emit",
+        "is_started",
+    )
 
-# -----------------------------------------------------------------------------
-def _check_type(id_param, param, tup_type):
+    # -------------------------------------------------------------------------
+    def __init__(self, state, fcn_emit, secs_delta):
+        """
+        Construct an assembler for a single streamed response.
+
+        """
+
+        self.state = state
+        self.fcn_emit = fcn_emit
+        self.secs_delta = secs_delta
+        self.map_choice = dict()  # index -> dict(list_text, finish_reason, is_chat)
+        self.map_pending = dict()  # index -> text not yet emitted
+        self.chunk_last = None
+        self.time_emit = None
+        self.is_started = False
+
+    # -------------------------------------------------------------------------
+    async def consume_async(self, iter_chunk):
+        """
+        Return the whole response, reading the chunks from an async iterator.
+
+        """
+
+        try:
+            async for chunk in iter_chunk:
+                self.add(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            raise openai.error.APIConnectionError(
+                "Stream interrupted: {err}".format(err=err)
+            )
+        self.flush()
+        return self.response()
+
+    # -------------------------------------------------------------------------
+    def consume(self, iter_chunk):
+        """
+        Return the whole response, reading the chunks from an iterator.
+
+        """
+
+        for chunk in iter_chunk:
+            self.add(chunk)
+        self.flush()
+        return self.response()
+
+    # -------------------------------------------------------------------------
+    def add(self, chunk):
+        """
+        Add a chunk, emitting pending text if secs_delta has passed.
+
+        Chat completion chunks carry text in
+        choices[i].delta.content, and text
+        completion chunks in choices[i].text.
+
+        """
+
+        self.chunk_last = chunk
+        self.is_started = True
+        for choice in chunk["choices"]:
+            idx = choice["index"]
+            is_chat = "delta" in choice
+            if is_chat:
+                text = choice["delta"].get("content", None) or ""
+            else:
+                text = choice.get("text", None) or ""
+            if idx not in self.map_choice:
+                self.map_choice[idx] = dict(
+                    list_text=list(), finish_reason=None, is_chat=is_chat
+                )
+            info_choice = self.map_choice[idx]
+            if choice.get("finish_reason", None) is not None:
+                info_choice["finish_reason"] = choice["finish_reason"]
+            if text:
+                info_choice["list_text"].append(text)
+                self.map_pending[idx] = self.map_pending.get(idx, "") + text
+
+        if self.map_pending and (
+            self.time_emit is None
+            or time.monotonic() - self.time_emit >= self.secs_delta
+        ):
+            self.flush()
+
+    # -------------------------------------------------------------------------
+    def flush(self):
+        """
+        Emit any pending text.
+
+        """
+
+        for idx, text in self.map_pending.items():
+            self.fcn_emit(
+                dict(
+                    type="openai_result_delta", index=idx, delta=text, state=self.state
+                )
+            )
+        self.map_pending.clear()
+        self.time_emit = time.monotonic()
+
+    # -------------------------------------------------------------------------
+    def response(self):
+        """
+        Return the assembled response.
+
+        """
+
+        list_choice = list()
+        is_chat = True
+        for idx in sorted(self.map_choice):
+            info_choice = self.map_choice[idx]
+            str_text = "".join(info_choice["list_text"])
+            is_chat = info_choice["is_chat"]
+            if is_chat:
+                list_choice.append(
+                    dict(
+                        index=idx,
+                        message=dict(role="assistant", content=str_text),
+                        finish_reason=info_choice["finish_reason"],
+                    )
+                )
+            else:
+                list_choice.append(
+                    dict(
+                        index=idx,
+                        text=str_text,
+                        logprobs=None,
+                        finish_reason=info_choice["finish_reason"],
+                    )
+                )
+
+        chunk = self.chunk_last or dict()
+        return openai.util.convert_to_openai_object(
+            dict(
+                id=chunk.get("id", None),
+                object="chat.completion" if is_chat else "text_completion",
+                created=chunk.get("created", None),
+                model=chunk.get("model", None),
+                choices=list_choice,
+            )
+        )
+
+
+# =============================================================================
+class ResponseCache:
+    """
+    Two tier cache of API responses, keyed by a hash of the request.
+
+    Only requests for endpoints in map_endpoint
+    are cached, and only if their temperature
+    is no more than the temperature_max for
+    that endpoint (0.0 by default). Each rule
+    may also set secs_ttl.
+
+    The key is a SHA-256 of the endpoint and
+    the request as canonical JSON, so
+    requests which differ only in key order
+    or in SET_PARAM_UNCACHED share an entry.
+
+    Responses are kept as JSON in a memory
+    LRU of up to count_item_max items, in
+    front of an optional SQLite database at
+    path_db which persists across restarts.
+    Expiry uses wall clock time so that it
+    carries over too.
+
+    """
+
+    # -------------------------------------------------------------------------
+    def __init__(
+        self, map_endpoint, count_item_max=1024, path_db=None, secs_ttl=86400.0
+    ):
+        """
+        Construct the cache, creating the database if necessary.
+
+        """
+
+        self.map_endpoint = map_endpoint
+        self.count_item_max = count_item_max
+        self.secs_ttl = secs_ttl
+        self.map_item = collections.OrderedDict()  # key -> (time_expire, data)
+        self.db = None
+        if path_db is not None:
+            self.db = sqlite3.connect(path_db, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS response ("
+                "key TEXT PRIMARY KEY, "
+                "time_expire REAL NOT NULL, "
+                "data BLOB NOT NULL)"
+            )
+            self.db.execute(
+                "DELETE FROM response WHERE time_expire <= ?", (time.time(),)
+            )
+
+    # -------------------------------------------------------------------------
+    def key(self, id_endpoint, request_full):
+        """
+        Return the cache key for a request, or None if it is not cacheable.
+
+        """
+
+        rule = self.map_endpoint.get(id_endpoint, None)
+        if rule is None:
+            return None
+
+        temperature = request_full.get(
+            "temperature", MAP_TEMPERATURE_DEFAULT.get(id_endpoint, 0.0)
+        )
+        if temperature > rule.get("temperature_max", 0.0):
+            return None
+
+        return _request_key(id_endpoint, request_full)
+
+    # -------------------------------------------------------------------------
+    def get(self, key):
+        """
+        Return (response, count_byte) for key, or (None, 0) on a miss.
+
+        """
+
+        time_now = time.time()
+        try:
+            (time_expire, data) = self.map_item[key]
+        except KeyError:
+            data = None
+        else:
+            if time_expire > time_now:
+                self.map_item.move_to_end(key)
+            else:
+                del self.map_item[key]
+                data = None
+
+        if data is None and self.db is not None:
+            row = self.db.execute(
+                "SELECT time_expire, data FROM response WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[0] > time_now:
+                (time_expire, data) = row
+                self._remember(key, time_expire, data)
+
+        if data is None:
+            return (None, 0)
+        response = openai.util.convert_to_openai_object(json.loads(data))
+        return (response, len(data))
+
+    # -------------------------------------------------------------------------
+    def put(self, id_endpoint, key, response):
+        """
+        Add a response to both tiers of the cache.
+
+        """
+
+        secs_ttl = self.map_endpoint[id_endpoint].get("secs_ttl", self.secs_ttl)
+        time_expire = time.time() + secs_ttl
+        data = json.dumps(response, separators=(",", ":")).encode()
+        self._remember(key, time_expire, data)
+        if self.db is not None:
+            self.db.execute(
+                "INSERT OR REPLACE INTO response VALUES (?, ?, ?)",
+                (key, time_expire, data),
+            )
+
+    # -------------------------------------------------------------------------
+    def _remember(self, key, time_expire, data):
+        """
+        Add an item to the memory tier, evicting the least recently used.
+
+        """
+
+        self.map_item[key] = (time_expire, data)
+        self.map_item.move_to_end(key)
+        while len(self.map_item) > self.count_item_max:
+            self.map_item.popitem(last=False)
+
+
+# =============================================================================
+class Flight:
+    """
+    A request in flight, which identical requests can join.
+
+    Each request which joins the flight gets
+    a copy of its outcome with its own state.
+    Streamed text is passed on to each of
+    them as it arrives, and a request which
+    joins part way through first gets the
+    text so far.
+
+    """
+
+    __slots__ = ("future", "fcn_emit", "list_follower", "map_text")
+
+    # -------------------------------------------------------------------------
+    def __init__(self, fcn_emit):
+        """
+        Construct a flight for the request which is sent.
+
+        """
+
+        self.future = asyncio.get_running_loop().create_future()
+        self.fcn_emit = fcn_emit
+        self.list_follower = list()  # (state, fcn_emit) of each joined request
+        self.map_text = dict()  # choice index -> text streamed so far
+
+    # -------------------------------------------------------------------------
+    def emit(self, item):
+        """
+        Pass a streamed openai_result_delta item on to every request.
+
+        """
+
+        idx = item["index"]
+        self.map_text[idx] = self.map_text.get(idx, "") + item["delta"]
+        self.fcn_emit(item)
+        for state, fcn_emit in self.list_follower:
+            fcn_emit(dict(item, state=state))
+
+    # -------------------------------------------------------------------------
+    async def join(self, result, fcn_emit):
+        """
+        Wait for the flight to land, filling in the response or error in result.
+
+        """
+
+        for idx, text in self.map_text.items():
+            fcn_emit(
+                dict(
+                    type="openai_result_delta",
+                    index=idx,
+                    delta=text,
+                    state=result["state"],
+                )
+            )
+        self.list_follower.append((result["state"], fcn_emit))
+        (result["response"], result["error"]) = await asyncio.shield(self.future)
+
+    # -------------------------------------------------------------------------
+    def land(self, result):
+        """
+        Give the outcome of the request which was sent to every joined request.
+
+        """
+
+        if self.future.done():
+            return
+        error = result["error"]
+        if result["response"] is None and error is None:
+            error = "The request failed."
+        self.future.set_result((result["response"], error))
+
+
+# =============================================================================
+class CircuitBreaker:
+    """
+    Circuit breaker which fails fast while an endpoint is degraded.
+
+    The breaker opens after count_failure
+    consecutive failures. While it is open,
+    requests are rejected without calling
+    the API. After secs_reset, a single
+    probe request is let through (the
+    breaker is half open). If the probe
+    succeeds the breaker closes, and if it
+    fails the breaker opens again. A probe
+    which has not been recorded after another
+    secs_reset, for example because it was
+    cancelled, is given up and a new probe
+    is let through.
+
+    """
+
+    __slots__ = (
+        "count_failure",
+        "secs_reset",
+        "count_failure_consecutive",
+        "time_open",
+        "time_probe",
+    )
+
+    # -------------------------------------------------------------------------
+    def __init__(self, count_failure=5, secs_reset=30.0):
+        """
+        Construct a closed breaker.
+
+        """
+
+        self.count_failure = count_failure
+        self.secs_reset = secs_reset
+        self.count_failure_consecutive = 0
+        self.time_open = None
+        self.time_probe = None
+
+    # -------------------------------------------------------------------------
+    def is_allowed(self):
+        """
+        Return True if a request may be sent now.
+
+        """
+
+        if self.time_open is None:
+            return True
+        time_now = time.monotonic()
+        if self.time_probe is not None and time_now - self.time_probe < self.secs_reset:
+            return False
+        if time_now - self.time_open < self.secs_reset:
+            return False
+        self.time_probe = time_now
+        return True
+
+    # -------------------------------------------------------------------------
+    def record_success(self):
+        """
+        Record a response from the API, closing the breaker.
+
+        """
+
+        self.count_failure_consecutive = 0
+        self.time_open = None
+        self.time_probe = None
+
+    # -------------------------------------------------------------------------
+    def record_failure(self):
+        """
+        Record a failure, opening the breaker if there have been too many.
+
+        """
+
+        self.count_failure_consecutive += 1
+        is_probing = self.time_probe is not None
+        if is_probing or self.count_failure_consecutive >= self.count_failure:
+            self.time_open = time.monotonic()
+        self.time_probe = None
+
+
+# =============================================================================
+class WorkflowPool:
+    """
+    Worker processes which each own a partition of the workflows.
+
+    Workflows are assigned to workers by a
+    hash of uid_workflow. Each coroutine is
+    created in its worker and stays there
+    for its lifetime, because coroutines
+    cannot be moved between processes.
+
+    Each tick, every worker with active
+    workflows is sent one batch of input,
+    and the workers then run in parallel
+    while the pool waits for all of the
+    replies.
+
+    Workflow items sent to a pool must have
+    a coroutine of None, and their spec and
+    outputs must be picklable. If they are
+    not, or if the workers take longer than
+    secs_timeout to reply, step raises an
+    error.
+
+    """
+
+    __slots__ = ("list_process", "list_queue_in", "list_queue_out", "secs_timeout")
+
+    # -------------------------------------------------------------------------
+    def __init__(self, cfg, count_process, secs_timeout=60.0):
+        """
+        Start count_process worker processes.
+
+        Queues belonging to other handlers
+        are left out of the configuration
+        given to the workers.
+
+        """
+
+        cfg_worker = dict(
+            (key, value) for (key, value) in cfg.items() if not key.startswith("queue_")
+        )
+        self.list_process = list()
+        self.list_queue_in = list()
+        self.list_queue_out = list()
+        self.secs_timeout = secs_timeout
+        for idx in range(count_process):
+            queue_in = multiprocessing.Queue()  # coro --> worker
+            queue_out = multiprocessing.Queue()  # worker --> coro
+            process = multiprocessing.Process(
+                target=_workflow_worker_main,
+                args=(cfg_worker, queue_in, queue_out),
+                name="openai-workflow-{idx}".format(idx=idx),
+                daemon=True,
+            )
+            process.start()
+            self.list_process.append(process)
+            self.list_queue_in.append(queue_in)
+            self.list_queue_out.append(queue_out)
+
+    # -------------------------------------------------------------------------
+    def index(self, uid_workflow):
+        """
+        Return the index of the worker which owns the workflow.
+
+        """
+
+        return zlib.crc32(str(uid_workflow).encode("utf-8")) % len(self.list_process)
+
+    # -------------------------------------------------------------------------
+    def step(self, list_active, unix_time):
+        """
+        Step the active workflows and return the items they produce.
+
+        """
+
+        list_list_batch = list(list() for _ in self.list_process)
+        for uid_workflow, list_input in list_active:
+            list_list_batch[self.index(uid_workflow)].append((uid_workflow, list_input))
+
+        # Every batch is pickled before any is
+        # sent, so that unpicklable input raises
+        # here rather than in a feeder thread,
+        # and no worker is left with a reply.
+        #
+        list_sent = list()
+        for idx, list_batch in enumerate(list_list_batch):
+            if list_batch:
+                data = pickle.dumps(
+                    (list_batch, unix_time), protocol=pickle.HIGHEST_PROTOCOL
+                )
+                list_sent.append((idx, data))
+        for idx, data in list_sent:
+            self.list_queue_in[idx].put(data)
+
+        # Collect every reply before raising any
+        # error, so that no reply is left behind
+        # to be mistaken for the next tick's.
+        #
+        time_due = time.monotonic() + self.secs_timeout
+        list_out = list()
+        list_error = list()
+        for idx, _ in list_sent:
+            (list_item, str_error) = self._get(idx, time_due)
+            if str_error is None:
+                list_out.extend(list_item)
+            else:
+                list_error.append(str_error)
+        if list_error:
+            raise RuntimeError("Workflow failed in worker process:\n" + list_error[0])
+        return list_out
+
+    # -------------------------------------------------------------------------
+    def _get(self, idx, time_due):
+        """
+        Return the next reply from worker idx, raising if it dies or is late.
+
+        A worker which is late is stopped, as
+        its reply could otherwise be mistaken
+        for the reply to a later tick.
+
+        """
+
+        while True:
+            secs_left = time_due - time.monotonic()
+            try:
+                data = self.list_queue_out[idx].get(
+                    timeout=max(0.0, min(1.0, secs_left))
+                )
+            except queue.Empty:
+                if not self.list_process[idx].is_alive():
+                    raise RuntimeError(
+                        "Workflow worker process {idx} has stopped.".format(idx=idx)
+                    ) from None
+                if secs_left <= 0:
+                    self.list_process[idx].terminate()
+                    raise RuntimeError(
+                        "Workflow worker process {idx} timed out.".format(idx=idx)
+                    ) from None
+            else:
+                return pickle.loads(data)
+
+
+# =============================================================================
+class EndpointSchema:
     """
-    Raise an exception if param is not in the specified tup_type.
+    Request parameter schema for one endpoint, compiled for validation.
+
+    The rows of MAP_TUP_TUP_PARAM are reduced
+    to a type map and sets of names, so that
+    a request is merged with the defaults in
+    a couple of dict comprehensions, and only
+    the parameters which are present have
+    their type checked.
 
     """
 
-    if not isinstance(param, tup_type):
-        msg = 'Type error for request["{id}"]: ' "({typename} != {required})".format(
-            id=id_param, typename=type(param), required=repr(tup_type)
+    __slots__ = (
+        "id_endpoint",
+        "fcn_endpoint",
+        "map_type",
+        "set_id_param_default",
+        "tup_id_required",
+        "set_id_required_internal",
+    )
+
+    # -------------------------------------------------------------------------
+    def __init__(self, id_endpoint, fcn_endpoint, tup_tup_param):
+        """
+        Construct the schema from rows of the parameter table.
+
+        """
+
+        self.id_endpoint = id_endpoint
+        self.fcn_endpoint = fcn_endpoint
+        self.map_type = dict()
+        set_id_param_default = set()
+        list_id_required = list()
+        set_id_required_internal = set()
+        for (
+            is_required_by_internal_api,  # Cannot be given a default value.
+            is_required_by_openai_api,  # Must be given a value of some sort.
+            id_param,
+            tup_type,
+        ) in tup_tup_param:
+            self.map_type[id_param] = tup_type
+            if is_required_by_internal_api:
+                set_id_required_internal.add(id_param)
+            else:
+                set_id_param_default.add(id_param)
+            if is_required_by_internal_api or is_required_by_openai_api:
+                list_id_required.append(id_param)
+        self.set_id_param_default = frozenset(set_id_param_default)
+        self.tup_id_required = tuple(list_id_required)
+        self.set_id_required_internal = frozenset(set_id_required_internal)
+
+    # -------------------------------------------------------------------------
+    def validate(self, request_raw, default):
+        """
+        Return request_raw merged with default, raising RuntimeError if invalid.
+
+        Values in request_raw take priority,
+        and parameters set to None are treated
+        as not set.
+
+        """
+
+        map_type = self.map_type
+        request_full = {
+            id_param: value
+            for (id_param, value) in default.items()
+            if value is not None and id_param in self.set_id_param_default
+        }
+        request_full.update(
+            (id_param, value)
+            for (id_param, value) in request_raw.items()
+            if value is not None and id_param in map_type
         )
-        log_event.error(msg)
-        raise RuntimeError(msg)
+
+        for id_param in self.tup_id_required:
+            if id_param not in request_full:
+                if id_param in self.set_id_required_internal:
+                    msg = "{id} not in request_raw".format(id=id_param)
+                else:
+                    msg = "{id} not in request_raw or default".format(id=id_param)
+                raise RuntimeError(msg)
+
+        for id_param, value in request_full.items():
+            tup_type = map_type[id_param]
+            if not isinstance(value, tup_type):
+                msg = 'Type error for request["{id}"]: ({name} != {required})'.format(
+                    id=id_param, name=type(value), required=repr(tup_type)
+                )
+                raise RuntimeError(msg)
+
+        return request_full
+
+
+# Compile the schema for each endpoint once,
+# when the module is imported.
+#
+MAP_SCHEMA_ENDPOINT = {
+    id_endpoint: EndpointSchema(
+        id_endpoint=id_endpoint,
+        fcn_endpoint=MAP_FCN_ENDPOINT[id_endpoint],
+        tup_tup_param=tup_tup_param,
+    )
+    for (id_endpoint, tup_tup_param) in MAP_TUP_TUP_PARAM.items()
+}
+
+
+# -----------------------------------------------------------------------------
+def _build_endpoint_specific_parameters(request_raw, default):
+    """
+    Return a length 4 tuple with endpoint specific parameters.
+
+    The returned tuple contains:-
+
+        1. The openai function to call for the requested endpoint.
+        2. The request parameters fully fleshed out with default values.
+        3. Process state.
+        4. A built-in-test response to use when the bit flag is enabled.
+
+    This information is extracted from the
+    input request_raw structure combined with
+    default values extracted from the supplied
+    configuration data.
+
+    """
+
+    # Determine which endpoint is being requested.
+    #
+    id_endpoint = request_raw.get("id_endpoint", None)
+    if id_endpoint is None:
+        id_endpoint = default.get("id_endpoint", None)
+    if id_endpoint is None:
+        raise RuntimeError("Could not determine endpoint.")
+
+    try:
+        schema = MAP_SCHEMA_ENDPOINT[id_endpoint]
+    except KeyError:
+        raise RuntimeError(
+            "Did not recognize endpoint: {id}.".format(id=id_endpoint)
+        ) from None
+
+    request_full = schema.validate(request_raw=request_raw, default=default)
+    state = request_raw.get("state", {})
+
+    # Work out the response to give when the
+    # built-in-test flag is enabled.
+    #
+    response_bit = built_in_test_response(id_endpoint)
+
+    return (schema.fcn_endpoint, request_full, state, response_bit)
 
 
 # -----------------------------------------------------------------------------
@@ -824,77 +3510,4 @@ def built_in_test_response(id_endpoint, id_version="v1"):
     {'id': 'cmpl-uqkvlQyYK7bGYrRHQ0eXlWi7', 'object': 'text_completion', ...}
 
     """
-    map_bit_endpoint = {
-        ("v1", "completions"): {
-            "id": "cmpl-uqkvlQyYK7bGYrRHQ0eXlWi7",
-            "object": "text_completion",
-            "created": 1589478378,
-            "model": "text-davinci-003",
-            "choices": [
-                {
-                    "text": "\n\nThis is a test",
-                    "index": 0,
-                    "logprobs": None,
-                    "finish_reason": "length",
-                }
-            ],
-            "usage": {"prompt_tokens": 10, "completion_tokens": 20, "total_tokens": 30},
-        },
-        ("v1", "chat_completions"): {
-            "id": "chatcmpl-abc123",
-            "object": "chat.completion",
-            "created": 1677858242,
-            "model": "gpt-3.5-turbo-0301",
-            "choices": [
-                {
-                    "message": {"role": "assistant", "content": "\n\nTest"},
-                    "finish_reason": "stop",
-                    "index": 0,
-                }
-            ],
-            "usage": {"prompt_tokens": 10, "completion_tokens": 20, "total_tokens": 30},
-        },
-        ("v1", "edits"): {
-            "object": "edit",
-            "created": 1589478378,
-            "choices": [{"text": "Test edit response", "index": 0}],
-            "usage": {"prompt_tokens": 10, "completion_tokens": 20, "total_tokens": 30},
-        },
-        ("v1", "images_generations"): {
-            "created": 1589478378,
-            "data": [
-                {"url": "https://random_test_url_424242.co.uk"},
-                {"url": "https://random_test_url_424242.co.uk"},
-            ],
-        },
-        ("v1", "images_edits"): {
-            "created": 1589478378,
-            "data": [
-                {"url": "https://random_test_url_424242.co.uk"},
-                {"url": "https://random_test_url_424242.co.uk"},
-            ],
-        },
-        ("v1", "images_variations"): {
-            "created": 1589478378,
-            "data": [
-                {"url": "https://random_test_url_424242.co.uk"},
-                {"url": "https://random_test_url_424242.co.uk"},
-            ],
-        },
-        ("v1", "embeddings"): {
-            "object": "list",
-            "model": "text-embedding-ada-002",
-            "data": [
-                {
-                    "object": "embedding",
-                    "embedding": [0.0023064255, -0.009327292, -0.0028842222],
-                    "index": 0,
-                }
-            ],
-            "usage": {"prompt_tokens": 10, "total_tokens": 20},
-        },
-        ("v1", "audio_transcriptions"): {"text": "Test transcription response."},
-        ("v1", "audio_translations"): {"text": "Test translation response"},
-    }
-
-    return map_bit_endpoint[(id_version, id_endpoint)]
+    return MAP_BIT_RESPONSE[(id_version, id_endpoint)]
@@ -0,0 +1,362 @@
+import functools
+import re
+import threading
+
+
+# Context window of each model in tokens,
+# shared between the prompt and the reply.
+# Models are matched by the longest prefix,
+# so that dated snapshots (for example
+# gpt-3.5-turbo-0613) share an entry.
+#
+MAP_CONTEXT = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-3.5-turbo-1106": 16385,
+    "gpt-3.5-turbo-instruct": 4096,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-1106": 128000,
+    "gpt-4-turbo": 128000,
+    "text-davinci-002": 4097,
+    "text-davinci-003": 4097,
+    "text-embedding-ada-002": 8191,
+}
+
+# Chat messages are framed by a few tokens
+# each for the role and separators, and the
+# reply is primed with a few more.
+#
+COUNT_TOKEN_PER_MESSAGE = 3
+COUNT_TOKEN_PER_NAME = 1
+COUNT_TOKEN_REPLY = 3
+
+# The approximate tokenizer counts a token
+# per run of up to 6 Latin letters, per run
+# of up to 3 digits, per other letter (CJK,
+# Cyrillic and so on), per punctuation
+# character and per line break. Runs of
+# other whitespace count a token per 4
+# characters, so a single space between
+# words is free. This errs on the high side
+# with cl100k_base, which is the safe side
+# for budgets.
+#
+CHAR_LATIN_MAX = "\u024f"
+REGEX_APPROX = re.compile(
+    r"[A-Za-z\u00aa\u00b5\u00ba\u00c0-\u00d6\u00d8-\u00f6\u00f8-\u024f]+"
+    r"|\d+|\n+|[^\S\n]+|[^\W\d_]+|[^\w\s]|_+"
+)
+
+map_tokenizer = dict()  # id_model prefix -> Tokenizer
+
+# tiktoken is only allowed to read encodings
+# from its local cache, by swapping out its
+# file reader while an encoding is loaded.
+#
+_lock_tiktoken = threading.Lock()
+
+
+# -----------------------------------------------------------------------------
+def register(id_model, encode, decode=None):
+    """
+    Register a tokenizer for models whose id starts with id_model.
+
+    encode takes a string and returns a list
+    of tokens. decode, if given, takes a list
+    of tokens and returns a string, and allows
+    text to be trimmed on exact token
+    boundaries.
+
+    Registered tokenizers take precedence
+    over tiktoken and the approximation.
+
+    """
+
+    map_tokenizer[id_model] = Tokenizer(encode=encode, decode=decode)
+    _tokenizer.cache_clear()
+
+
+# -----------------------------------------------------------------------------
+def count(text, id_model=None):
+    """
+    Return the number of tokens in text for the specified model.
+
+    """
+
+    if not text:
+        return 0
+    tokenizer = _tokenizer(id_model)
+    if tokenizer is None:
+        return _count_approx(text)
+    return len(tokenizer.encode(text))
+
+
+# -----------------------------------------------------------------------------
+def count_messages(messages, id_model=None):
+    """
+    Return the number of prompt tokens in a list of chat messages.
+
+    """
+
+    count_token = COUNT_TOKEN_REPLY
+    for message in messages:
+        count_token += COUNT_TOKEN_PER_MESSAGE
+        count_token += count(message.get("content", None) or "", id_model)
+        if message.get("name", None):
+            count_token += COUNT_TOKEN_PER_NAME + count(message["name"], id_model)
+    return count_token
+
+
+# -----------------------------------------------------------------------------
+def count_request(request, id_model=None):
+    """
+    Return the number of prompt tokens in a request dict.
+
+    The prompt, messages, input, instruction
+    and suffix parameters are counted. Inputs
+    given as lists of tokens are counted by
+    their length.
+
+    """
+
+    if id_model is None:
+        id_model = request.get("model", None)
+
+    count_token = 0
+    for key in ("prompt", "input", "instruction", "suffix"):
+        value = request.get(key, None)
+        if isinstance(value, str):
+            count_token += count(value, id_model)
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, str):
+                    count_token += count(item, id_model)
+                elif isinstance(item, list):
+                    count_token += len(item)
+                else:
+                    count_token += 1
+    if request.get("messages", None):
+        count_token += count_messages(request["messages"], id_model)
+    return count_token
+
+
+# -----------------------------------------------------------------------------
+def context_size(id_model):
+    """
+    Return the context window of the model in tokens, or None if not known.
+
+    """
+
+    id_prefix = _longest_prefix(id_model, MAP_CONTEXT)
+    if id_prefix is None:
+        return None
+    return MAP_CONTEXT[id_prefix]
+
+
+# -----------------------------------------------------------------------------
+def select_model(count_token, tup_id_model):
+    """
+    Return the first model in tup_id_model with room for count_token, or None.
+
+    Models are expected in order of
+    preference, typically cheapest first.
+    Models whose context size is not known
+    are assumed to have room.
+
+    """
+
+    for id_model in tup_id_model:
+        count_context = context_size(id_model)
+        if count_context is None or count_token <= count_context:
+            return id_model
+    return None
+
+
+# -----------------------------------------------------------------------------
+def trim(text, count_token_max, id_model=None):
+    """
+    Return the longest prefix of text which is no more than count_token_max tokens.
+
+    """
+
+    if count_token_max <= 0:
+        return ""
+
+    tokenizer = _tokenizer(id_model)
+    if tokenizer is not None and tokenizer.decode is not None:
+        list_token = tokenizer.encode(text)
+        if len(list_token) <= count_token_max:
+            return text
+        return tokenizer.decode(list_token[:count_token_max])
+
+    # Without a decoder, binary search for the
+    # longest prefix that fits, starting from
+    # the whole text since it usually does.
+    #
+    if count(text, id_model) <= count_token_max:
+        return text
+    (idx_lo, idx_hi) = (0, len(text))
+    while idx_lo < idx_hi:
+        idx_mid = (idx_lo + idx_hi + 1) // 2
+        if count(text[:idx_mid], id_model) <= count_token_max:
+            idx_lo = idx_mid
+        else:
+            idx_hi = idx_mid - 1
+    return text[:idx_lo]
+
+
+# -----------------------------------------------------------------------------
+def split(text, count_token_max, id_model=None):
+    """
+    Return a list of chunks of text, each no more than count_token_max tokens.
+
+    Text is split between lines where
+    possible, and lines which are too long
+    on their own are split where they no
+    longer fit.
+
+    """
+
+    list_chunk = list()
+    list_line = list()
+    count_token_chunk = 0
+    for line in text.splitlines(keepends=True):
+        count_token_line = count(line, id_model)
+        if list_line and count_token_chunk + count_token_line > count_token_max:
+            list_chunk.append("".join(list_line))
+            list_line.clear()
+            count_token_chunk = 0
+        while count_token_line > count_token_max:
+            part = trim(line, count_token_max, id_model) or line[:1]
+            list_chunk.append(part)
+            line = line[len(part) :]
+            count_token_line = count(line, id_model)
+        if line:
+            list_line.append(line)
+            count_token_chunk += count_token_line
+    if list_line:
+        list_chunk.append("".join(list_line))
+    return list_chunk
+
+
+# =============================================================================
+class Tokenizer:
+    """
+    An encode function with an optional decode function.
+
+    """
+
+    __slots__ = ("encode", "decode")
+
+    # -------------------------------------------------------------------------
+    def __init__(self, encode, decode=None):
+        """
+        Construct the tokenizer.
+
+        """
+
+        self.encode = encode
+        self.decode = decode
+
+
+# -----------------------------------------------------------------------------
+@functools.lru_cache(maxsize=64)
+def _tokenizer(id_model):
+    """
+    Return the Tokenizer for the model, or None to use the approximation.
+
+    tiktoken is used if it is installed and
+    has an encoding for the model which is
+    already in its local cache. Encodings
+    are never downloaded, so counting never
+    waits on the network. Otherwise, the
+    approximation is used.
+
+    """
+
+    id_prefix = _longest_prefix(id_model, map_tokenizer)
+    if id_prefix is not None:
+        return map_tokenizer[id_prefix]
+
+    if id_model is None:
+        return None
+
+    try:
+        import tiktoken
+        import tiktoken.load
+    except ImportError:
+        return None
+
+    read_file = tiktoken.load.read_file
+    with _lock_tiktoken:
+        tiktoken.load.read_file = functools.partial(_read_file_local, read_file)
+        try:
+            encoding = tiktoken.encoding_for_model(id_model)
+        except Exception:  # pylint: disable=W0703
+            return None
+        finally:
+            tiktoken.load.read_file = read_file
+
+    return Tokenizer(
+        encode=functools.partial(encoding.encode, disallowed_special=()),
+        decode=encoding.decode,
+    )
+
+
+# -----------------------------------------------------------------------------
+def _read_file_local(read_file, blobpath):
+    """
+    Read a tiktoken file with read_file, unless it would be downloaded.
+
+    tiktoken only reads a file if it is not
+    in the cache, so remote files raise an
+    OSError instead.
+
+    """
+
+    if "://" in blobpath:
+        raise OSError("Not in the tiktoken cache: {path}".format(path=blobpath))
+    return read_file(blobpath)
+
+
+# -----------------------------------------------------------------------------
+def _count_approx(text):
+    """
+    Return an approximate number of tokens in text.
+
+    """
+
+    count_token = 0
+    for match in REGEX_APPROX.finditer(text):
+        (idx_start, idx_end) = match.span()
+        count_char = idx_end - idx_start
+        char = text[idx_start]
+        if char.isdigit():
+            count_token += (count_char + 2) // 3
+        elif char.isalpha() and char <= CHAR_LATIN_MAX:
+            count_token += (count_char + 5) // 6
+        elif char.isalpha():
+            count_token += count_char
+        elif char.isspace() and char != "\n":
+            count_token += (count_char + 2) // 4
+        else:
+            count_token += 1
+    return count_token
+
+
+# -----------------------------------------------------------------------------
+def _longest_prefix(id_model, container):
+    """
+    Return the longest key in container which id_model starts with, or None.
+
+    """
+
+    if not id_model:
+        return None
+    id_best = None
+    for id_prefix in container:
+        if id_model.startswith(id_prefix):
+            if id_best is None or len(id_prefix) > len(id_best):
+                id_best = id_prefix
+    return id_best
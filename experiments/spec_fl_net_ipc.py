@@ -0,0 +1,166 @@
+import collections
+import queue
+
+import pytest
+
+
+ButtonData = collections.namedtuple("ButtonData", ["label", "id_btn"])
+
+
+# -----------------------------------------------------------------------------
+@pytest.fixture
+def testvector_items_valid():
+    """
+    Return a list of valid items of the kind which cross the IPC queues.
+
+    """
+
+    return [
+        dict(
+            type="msg_guild",
+            id_prev=None,
+            id_msg=1133468915722616893,
+            id_author=1101530813427544074,
+            name_author="participant_01",
+            id_channel=1101531220316676117,
+            name_channel="deliberation",
+            content="I think we should prioritise the community garden.",
+        ),
+        dict(
+            type="msg_dm",
+            id_user=1101530813427544074,
+            content="Joined session 3fa2c1.",
+        ),
+        dict(
+            type="appcmd_dm",
+            name_command="ask",
+            id_channel=1101531220316676117,
+            id_user=1101530813427544074,
+            name_user="admin_01",
+            args=("What should we do with the vacant lot?",),
+        ),
+        dict(type="cfg_filter", track=[1101530813427544074]),
+        dict(state=dict(id_prompt="summary"), model="gpt-3.5-turbo", messages=[]),
+    ]
+
+
+# =============================================================================
+class SpecifyFlNetIpc:
+    """
+    Spec for the fl.net.ipc package.
+
+    """
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e003_discord
+    def it_supports_import_of_fl_net_ipc(self):
+        """
+        fl.net.ipc can be imported.
+
+        """
+        import fl.net.ipc
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e003_discord
+    def it_roundtrips_valid_items(self, testvector_items_valid):
+        """
+        Decoding an encoded item yields an equal item.
+
+        """
+        import fl.net.ipc
+
+        for item in testvector_items_valid:
+            assert fl.net.ipc.decode(fl.net.ipc.encode(item)) == item
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e003_discord
+    def it_roundtrips_keys_not_named_in_the_schema(self):
+        """
+        Keys which are not in the registered schema are preserved.
+
+        """
+        import fl.net.ipc
+
+        item = dict(type="btn", id_btn="join_3fa2c1", extra={"a": 1})
+        assert fl.net.ipc.decode(fl.net.ipc.encode(item)) == item
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e003_discord
+    def it_roundtrips_items_with_the_same_keys_but_different_types(self):
+        """
+        Items with the same keys but different types keep their own type.
+
+        """
+        import fl.net.ipc
+
+        item_guild = dict(type="msg_guild", id_channel=1, content="hi")
+        item_log = dict(type="log_event", id_channel=1, content="oops")
+        assert fl.net.ipc.decode(fl.net.ipc.encode(item_guild)) == item_guild
+        assert fl.net.ipc.decode(fl.net.ipc.encode(item_log)) == item_log
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e003_discord
+    def it_falls_back_to_pickle_for_non_builtin_types(self):
+        """
+        Items containing named tuples can still be encoded.
+
+        """
+        import fl.net.ipc
+
+        item = dict(
+            type="msg_dm",
+            id_user=1101530813427544074,
+            content="Topic",
+            button=ButtonData(label="Submit", id_btn="submit_3fa2c1"),
+        )
+        assert fl.net.ipc.decode(fl.net.ipc.encode(item)) == item
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e003_discord
+    def it_encodes_registered_types_more_compactly_than_pickle(
+        self, testvector_items_valid
+    ):
+        """
+        Registered item types take fewer bytes than a pickled dict.
+
+        """
+        import pickle
+
+        import fl.net.ipc
+
+        item = testvector_items_valid[0]
+        assert len(fl.net.ipc.encode(item)) < len(pickle.dumps(item))
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e003_discord
+    def it_rejects_unsupported_wire_versions(self):
+        """
+        Data with an unknown wire format version cannot be decoded.
+
+        """
+        import marshal
+
+        import fl.net.ipc
+
+        data = marshal.dumps((fl.net.ipc.VERSION_WIRE + 1, 0, 0, (), dict()))
+        with pytest.raises(ValueError):
+            fl.net.ipc.decode(data)
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e003_discord
+    def it_encodes_and_decodes_items_passing_through_a_queue(
+        self, testvector_items_valid
+    ):
+        """
+        fl.net.ipc.EncodedQueue is transparent to the caller.
+
+        """
+        import fl.net.ipc
+
+        queue_encoded = fl.net.ipc.EncodedQueue(queue.Queue())
+        for item in testvector_items_valid:
+            queue_encoded.put(item, block=False)
+        for item in testvector_items_valid:
+            assert queue_encoded.get(block=False) == item
+        with pytest.raises(queue.Empty):
+            queue_encoded.get(block=False)
@@ -1426,3 +1426,878 @@ class SpecifyFlNetOpenAiClient:
             cfg=cfg_valid, list_list_input=[[workflow_valid, param_valid]]
         )
         assert list_output_3 == list_output_expected
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    @pytest.mark.e003_discord
+    def it_processes_requests_concurrently_in_the_daemon(
+        self, testvector_chat_completions_valid_bit
+    ):
+        """
+        The daemon returns a result, with its state, for each request.
+
+        """
+        import fl.net.openai.client
+
+        (cfg_valid, _, _, _, request_valid, _) = testvector_chat_completions_valid_bit
+        cfg = dict(cfg_valid, is_async=True, count_parallel=4)
+        request_handler = fl.net.openai.client.coro_request_handler(cfg=cfg)
+
+        list_request = list(
+            dict(request_valid, state=dict(idx=idx)) for idx in range(8)
+        )
+        list_result = list()
+        for _ in range(TESTRUNNER_MAXITER):
+            for item in request_handler.send((list_request, 0)):
+                if item.get("type", None) == "openai_result":
+                    list_result.append(item)
+            list_request = []
+            if len(list_result) == 8:
+                break
+            time.sleep(TESTRUNNER_DELAY_SECS)
+
+        assert sorted(result["state"]["idx"] for result in list_result) == list(
+            range(8)
+        )
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    @pytest.mark.e003_discord
+    def it_paces_requests_to_the_configured_rate_limit(self):
+        """
+        The rate limiter holds requests beyond the RPM limit until there is capacity.
+
+        """
+        import asyncio
+
+        import fl.net.openai.client
+
+        limiter = fl.net.openai.client.RateLimiter(
+            dict(default=dict(rpm=600, secs_burst=0.1))
+        )
+
+        async def _acquire_all():
+            time_start = time.monotonic()
+            for _ in range(4):
+                await limiter.acquire("gpt-3.5-turbo", count_token=10)
+            return time.monotonic() - time_start
+
+        # One request fits in the burst, and the
+        # other three are paced at 10 per second.
+        #
+        secs_elapsed = asyncio.run(_acquire_all())
+        assert 0.25 < secs_elapsed < 1.0
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    @pytest.mark.e003_discord
+    def it_gives_back_the_tokens_reserved_by_a_failed_attempt(self, monkeypatch):
+        """
+        Only the tokens used by the attempt which succeeds stay taken.
+
+        """
+        import asyncio
+
+        import openai
+
+        import fl.net.openai.client
+
+        list_call = list()
+
+        async def acreate(**kwargs):
+            list_call.append(kwargs)
+            if len(list_call) < 3:
+                raise openai.error.APIError("Server error")
+            return dict(object="list", data=[], usage=dict(total_tokens=7))
+
+        monkeypatch.setattr(openai.Embedding, "acreate", acreate, raising=False)
+
+        limiter = fl.net.openai.client.RateLimiter(
+            dict(default=dict(tpm=60, secs_burst=1000))
+        )
+
+        async def run():
+            return await fl.net.openai.client._process_one_request_async(
+                request_raw=dict(input="hello", state=dict()),
+                default=dict(id_endpoint="embeddings", model="text-embedding-ada-002"),
+                is_bit=False,
+                log_event=logging.getLogger("spec"),
+                limiter=limiter,
+                map_retry=dict(
+                    APIError=dict(count_retry=3, secs_base=0.001, secs_max=0.001)
+                ),
+            )
+
+        list_msg = asyncio.run(run())
+        assert len(list_call) == 3
+        assert list_msg[0]["error"] is None
+        bucket_tpm = limiter.map_bucket["text-embedding-ada-002"][1]
+        assert 992.0 < bucket_tpm.level <= 993.5
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    @pytest.mark.e003_discord
+    def it_fails_fast_while_the_circuit_breaker_is_open(self):
+        """
+        The circuit breaker opens after consecutive failures and closes on a probe.
+
+        """
+        import fl.net.openai.client
+
+        breaker = fl.net.openai.client.CircuitBreaker(count_failure=3, secs_reset=0.1)
+        for _ in range(3):
+            assert breaker.is_allowed()
+            breaker.record_failure()
+        assert not breaker.is_allowed()
+
+        # After secs_reset, exactly one probe is
+        # allowed through until it completes.
+        #
+        time.sleep(0.15)
+        assert breaker.is_allowed()
+        assert not breaker.is_allowed()
+
+        # A probe which is never recorded, for
+        # example because it was cancelled, is
+        # given up after another secs_reset.
+        #
+        time.sleep(0.15)
+        assert breaker.is_allowed()
+        breaker.record_success()
+        assert breaker.is_allowed()
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    @pytest.mark.e003_discord
+    def it_caches_deterministic_responses_in_memory_and_on_disk(self, tmp_path):
+        """
+        Cached responses are keyed by content and persist in the database.
+
+        """
+        import fl.net.openai.client
+
+        cfg_cache = dict(
+            map_endpoint=dict(chat_completions=dict()),
+            count_item_max=1,
+            path_db=str(tmp_path / "cache.sqlite"),
+        )
+        cache = fl.net.openai.client.ResponseCache(**cfg_cache)
+        request = dict(
+            model="gpt-3.5-turbo",
+            messages=[dict(role="user", content="Hello")],
+            temperature=0.0,
+        )
+        key = cache.key("chat_completions", request)
+        assert key == cache.key("chat_completions", dict(reversed(request.items())))
+        assert key == cache.key("chat_completions", dict(request, user="someone"))
+        assert cache.key("chat_completions", dict(request, temperature=0.7)) is None
+        assert cache.key("embeddings", dict(model="x", input="Hello")) is None
+        assert cache.get(key) == (None, 0)
+
+        cache.put("chat_completions", key, dict(choices=[dict(text="Hi")]))
+        (response, count_byte) = cache.get(key)
+        assert response["choices"][0]["text"] == "Hi"
+        assert count_byte > 0
+
+        # A new cache with the same database
+        # starts with an empty memory tier.
+        #
+        cache_restarted = fl.net.openai.client.ResponseCache(**cfg_cache)
+        assert not cache_restarted.map_item
+        (response, _) = cache_restarted.get(key)
+        assert response["choices"][0]["text"] == "Hi"
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    @pytest.mark.e003_discord
+    def it_caps_the_size_of_embedding_batches(self):
+        """
+        An embedding batch has no room once it reaches its input or token cap.
+
+        """
+        import fl.net.openai.client
+
+        cfg_batch = dict(secs_window=0.02, count_input_max=3, count_token_max=100)
+        batch = fl.net.openai.client.EmbeddingBatch(secs_window=0.02)
+        assert batch.has_room(3, 100, cfg_batch)
+        batch.add(dict(input=["a", "b"]), 2, 10)
+        assert batch.has_room(1, 90, cfg_batch)
+        assert not batch.has_room(2, 10, cfg_batch)
+        assert not batch.has_room(1, 91, cfg_batch)
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    @pytest.mark.e003_discord
+    def it_batches_embedding_requests_with_the_same_parameters(self, monkeypatch):
+        """
+        Each batched embedding request gets its own vectors, indices and state.
+
+        """
+        import asyncio
+        import queue
+        import types
+
+        import openai
+
+        import fl.net.openai.client
+
+        # The fake endpoint returns each input
+        # as its own embedding vector.
+        #
+        list_call = list()
+
+        async def acreate(**kwargs):
+            list_call.append(kwargs)
+            return openai.util.convert_to_openai_object(
+                dict(
+                    object="list",
+                    model=kwargs["model"],
+                    data=list(
+                        dict(object="embedding", index=idx, embedding=item)
+                        for (idx, item) in reversed(list(enumerate(kwargs["input"])))
+                    ),
+                )
+            )
+
+        monkeypatch.setattr(openai.Embedding, "acreate", acreate, raising=False)
+
+        map_input = {
+            0: "alpha",
+            1: ["beta", "gamma"],
+            2: "delta",
+            3: [1, 2, 3],
+            4: [[4, 5], [6]],
+        }
+        cfg = dict(
+            queue_to_api=queue.Queue(),
+            queue_from_api=queue.Queue(),
+            count_parallel=4,
+            default=dict(id_endpoint="embeddings", model="text-embedding-ada-002"),
+            is_bit=False,
+            secs_interval=0.01,
+            embedding_batch=dict(secs_window=0.05),
+        )
+        for idx, input_raw in map_input.items():
+            request = dict(input=input_raw, state=dict(idx=idx))
+            if idx == 2:
+                request["user"] = "participant_01"
+            cfg["queue_to_api"].put(request)
+
+        async def run():
+            task = asyncio.create_task(
+                fl.net.openai.client._daemon_loop(
+                    cfg,
+                    logging.getLogger("spec"),
+                    types.SimpleNamespace(list_event=list()),
+                )
+            )
+            map_result = dict()
+            for _ in range(TESTRUNNER_MAXITER):
+                await asyncio.sleep(TESTRUNNER_DELAY_SECS)
+                while True:
+                    try:
+                        item = cfg["queue_from_api"].get(block=False)
+                    except queue.Empty:
+                        break
+                    if item.get("type", None) == "openai_result":
+                        map_result[item["state"]["idx"]] = item
+                if len(map_result) == len(map_input):
+                    break
+            task.cancel()
+            return map_result
+
+        map_result = asyncio.run(run())
+
+        # Strings and token arrays are batched
+        # apart, as are requests with different
+        # parameters, which are passed on.
+        #
+        list_input_batch = list(
+            call["input"] for call in list_call if "user" not in call
+        )
+        assert sorted(list_input_batch, key=repr) == [
+            ["alpha", "beta", "gamma"],
+            [[1, 2, 3], [4, 5], [6]],
+        ]
+        assert [call["input"] for call in list_call if "user" in call] == [["delta"]]
+        assert [call["user"] for call in list_call if "user" in call] == [
+            "participant_01"
+        ]
+
+        for idx, input_raw in map_input.items():
+            result = map_result[idx]
+            assert result["error"] is None
+            assert result["state"] == dict(idx=idx)
+            list_input = fl.net.openai.client._list_input(input_raw)
+            list_data = result["response"]["data"]
+            assert [item["index"] for item in list_data] == list(range(len(list_input)))
+            assert [item["embedding"] for item in list_data] == list_input
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    @pytest.mark.e003_discord
+    def it_returns_an_error_result_for_requests_which_fail(self, monkeypatch):
+        """
+        Invalid requests and unexpected errors give a result with the state.
+
+        """
+        import asyncio
+        import queue
+        import types
+
+        import openai
+
+        import fl.net.openai.client
+
+        async def acreate(**kwargs):
+            if kwargs["input"] == "crash":
+                raise ValueError("Unexpected")
+            return dict(object="list", data=[dict(index=0, embedding=[0.0])])
+
+        monkeypatch.setattr(openai.Embedding, "acreate", acreate, raising=False)
+
+        cfg = dict(
+            queue_to_api=queue.Queue(),
+            queue_from_api=queue.Queue(),
+            count_parallel=2,
+            default=dict(id_endpoint="embeddings", model="text-embedding-ada-002"),
+            is_bit=False,
+            secs_interval=0.01,
+        )
+        for idx, input_raw in enumerate((5, "crash", "fine")):
+            cfg["queue_to_api"].put(dict(input=input_raw, state=dict(idx=idx)))
+
+        async def run():
+            task = asyncio.create_task(
+                fl.net.openai.client._daemon_loop(
+                    cfg,
+                    logging.getLogger("spec"),
+                    types.SimpleNamespace(list_event=list()),
+                )
+            )
+            map_result = dict()
+            for _ in range(TESTRUNNER_MAXITER):
+                await asyncio.sleep(TESTRUNNER_DELAY_SECS)
+                while True:
+                    try:
+                        item = cfg["queue_from_api"].get(block=False)
+                    except queue.Empty:
+                        break
+                    if item.get("type", None) == "openai_result":
+                        map_result[item["state"]["idx"]] = item
+                if len(map_result) == 3:
+                    break
+            assert not task.done()
+            task.cancel()
+            return map_result
+
+        map_result = asyncio.run(run())
+        assert "Type error" in map_result[0]["error"]
+        assert "Unexpected" in map_result[1]["error"]
+        assert map_result[2]["error"] is None
+        assert all(map_result[idx]["state"] == dict(idx=idx) for idx in range(3))
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    @pytest.mark.e003_discord
+    def it_does_not_take_a_slot_for_requests_which_join_a_flight(self, monkeypatch):
+        """
+        Identical requests are sent once, even with a single slot.
+
+        """
+        import asyncio
+        import queue
+        import types
+
+        import openai
+
+        import fl.net.openai.client
+
+        list_call = list()
+
+        async def acreate(**kwargs):
+            list_call.append(kwargs["input"])
+            await asyncio.sleep(0.05)
+            return dict(object="list", data=[dict(index=0, embedding=[0.0])])
+
+        monkeypatch.setattr(openai.Embedding, "acreate", acreate, raising=False)
+
+        cfg = dict(
+            queue_to_api=queue.Queue(),
+            queue_from_api=queue.Queue(),
+            count_parallel=1,
+            default=dict(id_endpoint="embeddings", model="text-embedding-ada-002"),
+            is_bit=False,
+            secs_interval=0.01,
+        )
+        for idx, input_raw in enumerate(("same", "same", "same", "other")):
+            cfg["queue_to_api"].put(dict(input=input_raw, state=dict(idx=idx)))
+
+        async def run():
+            task = asyncio.create_task(
+                fl.net.openai.client._daemon_loop(
+                    cfg,
+                    logging.getLogger("spec"),
+                    types.SimpleNamespace(list_event=list()),
+                )
+            )
+            map_result = dict()
+            for _ in range(TESTRUNNER_MAXITER):
+                await asyncio.sleep(TESTRUNNER_DELAY_SECS)
+                while True:
+                    try:
+                        item = cfg["queue_from_api"].get(block=False)
+                    except queue.Empty:
+                        break
+                    if item.get("type", None) == "openai_result":
+                        map_result[item["state"]["idx"]] = item
+                if len(map_result) == 4:
+                    break
+            task.cancel()
+            return map_result
+
+        map_result = asyncio.run(run())
+        assert list_call == ["same", "other"]
+        assert all(map_result[idx]["error"] is None for idx in range(4))
+        assert all(map_result[idx]["state"] == dict(idx=idx) for idx in range(4))
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    @pytest.mark.e003_discord
+    def it_assembles_streamed_chat_completions(self):
+        """
+        Streamed chunks are emitted as deltas and assembled into a whole response.
+
+        """
+        import fl.net.openai.client
+
+        list_delta = list()
+        assembler = fl.net.openai.client.StreamAssembler(
+            state=dict(id_prompt="summary"), fcn_emit=list_delta.append, secs_delta=0.0
+        )
+        list_chunk = [
+            dict(
+                id="chatcmpl-1",
+                model="gpt-3.5-turbo",
+                choices=[dict(index=0, delta=dict(role="assistant"))],
+            ),
+            dict(choices=[dict(index=0, delta=dict(content="Hello"))]),
+            dict(
+                choices=[
+                    dict(index=0, delta=dict(content=" world"), finish_reason="stop")
+                ]
+            ),
+        ]
+        response = assembler.consume(iter(list_chunk))
+
+        assert "".join(item["delta"] for item in list_delta) == "Hello world"
+        assert all(item["type"] == "openai_result_delta" for item in list_delta)
+        assert all(item["state"]["id_prompt"] == "summary" for item in list_delta)
+        assert response["object"] == "chat.completion"
+        assert response["choices"][0]["message"]["content"] == "Hello world"
+        assert response["choices"][0]["finish_reason"] == "stop"
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    @pytest.mark.e003_discord
+    def it_rejects_requests_which_do_not_fit_the_context_window(
+        self, testvector_chat_completions_valid_bit
+    ):
+        """
+        A request too long for any candidate model fails without an API call.
+
+        """
+        import fl.net.openai.client
+
+        (cfg_valid, _, _, _, request_valid, _) = testvector_chat_completions_valid_bit
+        cfg = dict(cfg_valid, is_bit=False, is_async=False, api_key="none")
+        request_handler = fl.net.openai.client.coro_request_handler(cfg=cfg)
+        request = dict(
+            request_valid,
+            messages=[dict(role="user", content="word " * 30000)],
+            model_by_context=("gpt-3.5-turbo", "gpt-3.5-turbo-16k"),
+        )
+
+        list_item = request_handler.send(([request], 0))
+        (result,) = (item for item in list_item if item["type"] == "openai_result")
+        assert result["response"] is None
+        assert "context" in result["error"]
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    def it_rejects_bad_templates_and_params_at_intake(
+        self, testvector_chat_completions_valid_bit
+    ):
+        """
+        Templates are compiled on registration and params checked on arrival.
+
+        """
+        import fl.net.openai.client
+
+        (
+            cfg,
+            _,
+            template_valid,
+            param_valid,
+            _,
+            _,
+        ) = testvector_chat_completions_valid_bit
+        template = dict(
+            template_valid,
+            messages=[dict(role="user", content="{greeting}, {user.name}!")],
+        )
+        list_captured = list()
+
+        def coro_capture():
+            list_from_api = list()
+            while True:
+                (list_request, _) = yield list_from_api
+                list_captured.extend(list_request)
+
+        request_handler = coro_capture()
+        request_handler.send(None)
+        template_handler = fl.net.openai.client.coro_template_handler(
+            cfg=cfg, request_handler=request_handler
+        )
+
+        class User:
+            name = "Ada"
+
+        param = dict(param_valid, kwargs_tmpl=dict(greeting="Hello", user=User))
+        template_handler.send(([template, param], 0))
+        assert list_captured[0]["messages"][0]["content"] == "Hello, Ada!"
+
+        with pytest.raises(RuntimeError, match="user"):
+            template_handler.send(
+                ([dict(param, kwargs_tmpl=dict(greeting="Hello"))], 0)
+            )
+
+        template_handler = fl.net.openai.client.coro_template_handler(
+            cfg=cfg, request_handler=request_handler
+        )
+        template_bad = dict(template, messages=[dict(role="user", content="{0}")])
+        with pytest.raises(RuntimeError, match="Positional"):
+            template_handler.send(([template_bad], 0))
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    def it_merges_and_validates_request_parameters_with_compiled_schemas(self):
+        """
+        Raw params take priority over defaults and are checked against the schema.
+
+        """
+        import fl.net.openai.client
+
+        schema = fl.net.openai.client.MAP_SCHEMA_ENDPOINT["completions"]
+        default = dict(id_endpoint="completions", model="davinci", prompt="x", n=2)
+
+        request_full = schema.validate(
+            request_raw=dict(prompt="Hello", n=None, temperature=0.5, state={}),
+            default=default,
+        )
+        assert request_full == dict(
+            model="davinci", prompt="Hello", n=2, temperature=0.5
+        )
+
+        with pytest.raises(RuntimeError, match="prompt not in request_raw"):
+            schema.validate(request_raw=dict(), default=default)
+        with pytest.raises(RuntimeError, match="Type error"):
+            schema.validate(request_raw=dict(prompt="Hello", n="2"), default=default)
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    def it_only_steps_workflows_with_input_or_a_due_timer(
+        self, testvector_completions_valid_bit
+    ):
+        """
+        Idle workflows are not stepped, except when their timer is due.
+
+        """
+        import fl.net.openai.client
+
+        (cfg_valid, _, _, _, _, _) = testvector_completions_valid_bit
+        cfg = dict(cfg_valid, list_step=list())
+        str_spec = (
+            "def coro(cfg):\n"
+            "    while True:\n"
+            "        list_in = yield []\n"
+            "        cfg['list_step'].append(('{id}', len(list_in)))\n"
+        )
+
+        def coro_template():
+            while True:
+                yield list()
+
+        template_handler = coro_template()
+        template_handler.send(None)
+        workflow_handler = fl.net.openai.client.coro_workflow_handler(
+            cfg=cfg, request_handler=None, template_handler=template_handler
+        )
+
+        def workflow(id_workflow, **kwargs):
+            return dict(
+                uid_workflow=id_workflow,
+                type={"id": "prompt_workflow", "ver": "1.0"},
+                spec=str_spec.format(id=id_workflow),
+                coroutine=None,
+                **kwargs,
+            )
+
+        param = dict(type={"id": "prompt_params"}, uid_workflow="a")
+        list_tick = [
+            (0, [workflow("a"), workflow("b", secs_interval=10)]),
+            (1, []),
+            (2, [param, param]),
+            (5, []),
+            (10, []),
+        ]
+        list_step_expected = [
+            [("a", 1), ("b", 1)],
+            [],
+            [("a", 2)],
+            [],
+            [("b", 0)],
+        ]
+        for (unix_time, list_input), list_step in zip(list_tick, list_step_expected):
+            cfg["list_step"].clear()
+            workflow_handler.send((list_input, unix_time))
+            assert cfg["list_step"] == list_step
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    def it_compiles_each_inline_workflow_spec_once(self, tmp_path):
+        """
+        Workflow instances share compiled code but not their namespaces.
+
+        """
+        import fl.net.openai.client
+
+        str_spec = (
+            "list_seen = []\n"
+            "def coro(cfg):\n"
+            "    while True:\n"
+            "        list_seen.extend((yield list(list_seen)))\n"
+        )
+        cfg = dict(path_workflow_code=str(tmp_path))
+        fl.net.openai.client.map_code_workflow.clear()
+
+        list_workflow = list(
+            fl.net.openai.client._ensure_init_workflow(
+                cfg, dict(spec=str_spec, coroutine=None)
+            )
+            for _ in range(3)
+        )
+        assert len(fl.net.openai.client.map_code_workflow) == 1
+        assert list_workflow[0]["coroutine"].send([1]) == [1]
+        assert list_workflow[1]["coroutine"].send([2]) == [2]
+
+        # Bytecode is reloaded from disk when
+        # the memory cache is empty.
+        #
+        (path_file,) = tmp_path.iterdir()
+        code = fl.net.openai.client.map_code_workflow.pop(path_file.name.split(".")[0])
+        code_loaded = fl.net.openai.client._compile_workflow(str_spec, str(tmp_path))
+        assert code_loaded is not code
+        assert code_loaded == code
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    def it_runs_workflows_in_a_pool_of_worker_processes(
+        self, testvector_completions_valid_bit
+    ):
+        """
+        Each workflow lives in one worker process, and errors are raised here.
+
+        """
+        import os
+
+        import fl.net.openai.client
+
+        (cfg_valid, _, _, _, _, _) = testvector_completions_valid_bit
+        cfg = dict(cfg_valid, count_process_workflow=2)
+        str_spec = (
+            "import os\n"
+            "def coro(cfg):\n"
+            "    list_out = []\n"
+            "    while True:\n"
+            "        list_in = yield list_out\n"
+            "        if any(item.get('is_fail') for item in list_in):\n"
+            "            raise ValueError('spec failure')\n"
+            "        list_out = [dict(id='{id}', pid=os.getpid(), n=len(list_in))]\n"
+        )
+        list_captured = list()
+
+        def coro_capture():
+            while True:
+                (list_item, _) = yield list()
+                list_captured.append(list(list_item))
+
+        template_handler = coro_capture()
+        template_handler.send(None)
+        workflow_handler = fl.net.openai.client.coro_workflow_handler(
+            cfg=cfg, request_handler=None, template_handler=template_handler
+        )
+
+        tup_id = tuple("w{idx}".format(idx=idx) for idx in range(6))
+        workflow_handler.send(
+            (
+                list(
+                    dict(
+                        uid_workflow=id_workflow,
+                        type={"id": "prompt_workflow", "ver": "1.0"},
+                        spec=str_spec.format(id=id_workflow),
+                        coroutine=None,
+                    )
+                    for id_workflow in tup_id
+                ),
+                0,
+            )
+        )
+        param = dict(type={"id": "prompt_params"}, uid_workflow="w0")
+        workflow_handler.send(([param, param], 1))
+
+        (list_first, list_second) = list_captured
+        map_pid = dict((item["id"], item["pid"]) for item in list_first)
+        assert sorted(map_pid) == list(tup_id)
+        assert os.getpid() not in map_pid.values()
+        assert len(set(map_pid.values())) == 2
+        assert list_second == [dict(id="w0", pid=map_pid["w0"], n=2)]
+
+        with pytest.raises(RuntimeError, match="spec failure"):
+            workflow_handler.send(([dict(param, is_fail=True)], 2))
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    @pytest.mark.e003_discord
+    def it_raises_for_unpicklable_or_late_workflow_replies(
+        self, testvector_completions_valid_bit
+    ):
+        """
+        A pool raises rather than waiting forever for a reply which never comes.
+
+        """
+        import fl.net.openai.client
+
+        (cfg_valid, _, _, _, _, _) = testvector_completions_valid_bit
+        cfg = dict(cfg_valid, count_process_workflow=1, secs_timeout_workflow=0.5)
+        str_spec = (
+            "import time\n"
+            "def coro(cfg):\n"
+            "    list_out = []\n"
+            "    while True:\n"
+            "        list_in = yield list_out\n"
+            "        if any(item.get('is_slow') for item in list_in):\n"
+            "            time.sleep(5)\n"
+            "        list_out = [dict(fcn=lambda: None)]\n"
+        )
+
+        def coro_discard():
+            while True:
+                yield list()
+
+        template_handler = coro_discard()
+        template_handler.send(None)
+        workflow_handler = fl.net.openai.client.coro_workflow_handler(
+            cfg=cfg, request_handler=None, template_handler=template_handler
+        )
+        item_workflow = dict(
+            uid_workflow="w0",
+            type={"id": "prompt_workflow", "ver": "1.0"},
+            spec=str_spec,
+            coroutine=None,
+        )
+        with pytest.raises(RuntimeError, match="pickle"):
+            workflow_handler.send(([item_workflow], 0))
+
+        workflow_handler = fl.net.openai.client.coro_workflow_handler(
+            cfg=cfg, request_handler=None, template_handler=template_handler
+        )
+        with pytest.raises(RuntimeError, match="timed out"):
+            workflow_handler.send(([dict(item_workflow, is_slow=True)], 0))
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    @pytest.mark.e003_discord
+    def it_schedules_requests_by_priority_class(self):
+        """
+        Interactive requests are started ahead of a bulk backlog, within limits.
+
+        """
+        import fl.net.openai.client
+
+        def drain(scheduler):
+            list_id = list()
+            while scheduler.count_pending:
+                (request, _, _) = scheduler.pop()
+                list_id.append(request["id"])
+            return list_id
+
+        def fill(scheduler):
+            for idx in range(4):
+                scheduler.push(dict(id="b{idx}".format(idx=idx), id_priority="bulk"))
+            for idx in range(2):
+                scheduler.push(
+                    dict(
+                        id="i{idx}".format(idx=idx),
+                        state=dict(id_priority="interactive"),
+                    )
+                )
+            scheduler.push(dict(id="d0"))
+
+        kwargs = dict(
+            map_weight=dict(interactive=2, default=1, bulk=1),
+            id_default="default",
+            secs_aging=60.0,
+        )
+
+        scheduler = fl.net.openai.client.PriorityScheduler(is_strict=True, **kwargs)
+        fill(scheduler)
+        assert drain(scheduler) == ["i0", "i1", "d0", "b0", "b1", "b2", "b3"]
+
+        scheduler = fl.net.openai.client.PriorityScheduler(is_strict=False, **kwargs)
+        fill(scheduler)
+        assert drain(scheduler) == ["i0", "d0", "b0", "i1", "b1", "b2", "b3"]
+
+        kwargs["secs_aging"] = -1.0
+        scheduler = fl.net.openai.client.PriorityScheduler(is_strict=True, **kwargs)
+        fill(scheduler)
+        assert drain(scheduler) == ["b0", "b1", "b2", "b3", "i0", "i1", "d0"]
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    @pytest.mark.e003_discord
+    def it_gives_requests_which_join_a_flight_its_outcome_and_stream(self):
+        """
+        A joined request gets the text so far, later text, and the response.
+
+        """
+        import asyncio
+
+        import fl.net.openai.client
+
+        list_leader = list()
+        list_follower = list()
+
+        def delta(text):
+            return dict(
+                type="openai_result_delta", index=0, delta=text, state=dict(id=0)
+            )
+
+        async def run():
+            flight = fl.net.openai.client.Flight(list_leader.append)
+            flight.emit(delta("Hello"))
+            result = dict(response=None, error=None, state=dict(id=1))
+            task = asyncio.create_task(flight.join(result, list_follower.append))
+            await asyncio.sleep(0)
+            flight.emit(delta(" world"))
+            flight.land(dict(response=dict(text="Hello world"), error=None))
+            await task
+            return result
+
+        result = asyncio.run(run())
+        assert [item["delta"] for item in list_leader] == ["Hello", " world"]
+        assert [item["delta"] for item in list_follower] == ["Hello", " world"]
+        assert all(item["state"] == dict(id=1) for item in list_follower)
+        assert result == dict(
+            response=dict(text="Hello world"), error=None, state=dict(id=1)
+        )
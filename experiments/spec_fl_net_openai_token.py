@@ -0,0 +1,119 @@
+import pytest
+
+
+# =============================================================================
+class SpecifyFlNetOpenaiToken:
+    """
+    Spec for the fl.net.openai.token package.
+
+    """
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    def it_supports_import_of_fl_net_openai_token(self):
+        """
+        fl.net.openai.token can be imported.
+
+        """
+        import fl.net.openai.token
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    def it_counts_tokens_with_a_registered_tokenizer(self):
+        """
+        A registered tokenizer is used for models with a matching prefix.
+
+        """
+        import fl.net.openai.token
+
+        fl.net.openai.token.register("spec-words", encode=str.split, decode=" ".join)
+        try:
+            text = "one two three four five"
+            assert fl.net.openai.token.count(text, "spec-words-0613") == 5
+            assert fl.net.openai.token.trim(text, 2, "spec-words") == "one two"
+        finally:
+            del fl.net.openai.token.map_tokenizer["spec-words"]
+            fl.net.openai.token._tokenizer.cache_clear()
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    def it_trims_and_splits_text_to_a_token_budget(self):
+        """
+        Trimmed text and split chunks fit the budget, and split text is lossless.
+
+        """
+        import fl.net.openai.token
+
+        text = "".join(
+            "Participant {idx} said something about the garden.\n".format(idx=idx)
+            for idx in range(200)
+        )
+        count_token = fl.net.openai.token.count(text)
+        assert count_token > 100
+
+        str_trimmed = fl.net.openai.token.trim(text, 100)
+        assert text.startswith(str_trimmed)
+        assert 90 <= fl.net.openai.token.count(str_trimmed) <= 100
+
+        list_chunk = fl.net.openai.token.split(text, 100)
+        assert "".join(list_chunk) == text
+        assert all(fl.net.openai.token.count(chunk) <= 100 for chunk in list_chunk)
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    def it_selects_the_first_model_with_room_in_its_context(self):
+        """
+        Models are chosen in order of preference by context size.
+
+        """
+        import fl.net.openai.token
+
+        tup_id_model = ("gpt-3.5-turbo-0613", "gpt-3.5-turbo-16k-0613")
+        assert fl.net.openai.token.context_size("gpt-3.5-turbo-16k-0613") == 16384
+        assert fl.net.openai.token.select_model(3000, tup_id_model) == tup_id_model[0]
+        assert fl.net.openai.token.select_model(9000, tup_id_model) == tup_id_model[1]
+        assert fl.net.openai.token.select_model(20000, tup_id_model) is None
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    def it_never_downloads_tiktoken_encodings(self, monkeypatch, tmp_path):
+        """
+        Encodings which are not in the tiktoken cache are not fetched.
+
+        """
+        tiktoken = pytest.importorskip("tiktoken")
+        import tiktoken.load
+
+        import fl.net.openai.token
+
+        list_blobpath = list()
+
+        def read_file(blobpath):
+            list_blobpath.append(blobpath)
+            raise OSError("Offline")
+
+        monkeypatch.setenv("TIKTOKEN_CACHE_DIR", str(tmp_path))
+        monkeypatch.setattr(tiktoken.load, "read_file", read_file)
+        fl.net.openai.token._tokenizer.cache_clear()
+        try:
+            assert fl.net.openai.token.count("Hello world", "gpt-4") > 0
+        finally:
+            fl.net.openai.token._tokenizer.cache_clear()
+        assert list_blobpath == []
+        assert tiktoken.load.read_file is read_file
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e002_general_research
+    def it_counts_other_scripts_and_whitespace_in_the_approximation(self):
+        """
+        Non-Latin letters count at least one token each, and whitespace counts.
+
+        """
+        import fl.net.openai.token
+
+        text_cjk = "春眠不觉晓处处闻"
+        text_cyrillic = "Привет мир как дела"
+        assert fl.net.openai.token.count(text_cjk) >= 8
+        assert fl.net.openai.token.count(text_cyrillic) >= 16
+        assert fl.net.openai.token.count(" " * 500) >= 100
+        assert fl.net.openai.token.count("one two three") == 3
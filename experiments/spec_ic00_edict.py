@@ -0,0 +1,190 @@
+import pytest
+
+
+# -----------------------------------------------------------------------------
+@pytest.fixture
+def state_edict():
+    """
+    Return a fresh state for the ic00_edict coroutine.
+
+    """
+
+    return dict(
+        session=dict(),
+        user=dict(),
+        prompt=dict(summary="Topic: {str_topic}\nTranscript: {str_transcript}"),
+        summary=dict(),
+        count_summary=0,
+    )
+
+
+# =============================================================================
+class SpecifyIc00Edict:
+    """
+    Spec for the ic00_edict coroutine.
+
+    """
+
+    # -------------------------------------------------------------------------
+    @pytest.mark.e003_discord
+    def it_summarises_contributions_posted_in_the_session_thread(self, state_edict):
+        """
+        Join, reply in the thread, submit and summary use the thread replies.
+
+        """
+        import ic00_edict
+
+        id_admin = 1101530813427544074
+        id_user = 1101530813427544075
+        id_other = 1101530813427544076
+        id_channel = 1101531220316676117
+        id_thread = 1133468915722616893
+
+        # Ask in a guild channel.
+        #
+        (discord, _) = ic00_edict._update(
+            state_edict,
+            dict(
+                type="appcmd_guild",
+                name_command="ask",
+                id_channel=id_channel,
+                id_user=id_admin,
+                name_user="admin_01",
+                args=("What should we do with the vacant lot?",),
+            ),
+        )
+        list_thread = [item for item in discord if item["type"] == "msg_thread"]
+        assert len(list_thread) == 1
+        id_session = list_thread[0]["key_thread"]
+
+        # Join the session. The user is added
+        # to the session thread.
+        #
+        for id_join, name_join in ((id_user, "user_01"), (id_other, "user_02")):
+            (discord, _) = ic00_edict._update(
+                state_edict,
+                dict(
+                    type="btn",
+                    id_btn=ic00_edict.PREFIX_JOIN + id_session,
+                    id_user=id_join,
+                    name_user=name_join,
+                    id_channel=id_channel,
+                ),
+            )
+            assert any(
+                item["type"] == "msg_thread" and item["add_user"] == [id_join]
+                for item in discord
+            )
+
+        # Reply in the session thread, in some
+        # other thread and in the parent channel.
+        # Only the reply in the session thread
+        # is part of the contribution.
+        #
+        for key_thread, content in (
+            (id_session, "Plant a community garden."),
+            ("other", "Off topic in another session."),
+            (None, "Off topic in the channel."),
+        ):
+            item = dict(
+                type="msg_guild",
+                id_prev=None,
+                id_msg=1,
+                id_author=id_user,
+                name_author="user_01",
+                id_channel=id_thread if key_thread is not None else id_channel,
+                name_channel="deliberation",
+                content=content,
+            )
+            if key_thread is not None:
+                item["key_thread"] = key_thread
+            ic00_edict._update(state_edict, item)
+
+        # Edits to a reply in the session thread
+        # are part of the contribution too.
+        #
+        ic00_edict._update(
+            state_edict,
+            dict(
+                type="edit_guild",
+                id_prev=1,
+                id_msg=1,
+                id_author=id_user,
+                name_author="user_01",
+                nick_author=None,
+                id_channel=id_thread,
+                name_channel="deliberation",
+                content="Plant a community orchard.",
+                key_thread=id_session,
+            ),
+        )
+
+        assert state_edict["user"][id_user]["transcript"] == [
+            "Plant a community garden.",
+            "Plant a community orchard.",
+        ]
+
+        # Submit, then ask for the summary.
+        #
+        (discord, _) = ic00_edict._update(
+            state_edict,
+            dict(
+                type="btn",
+                id_btn=ic00_edict.PREFIX_SUBMIT + id_session,
+                id_user=id_user,
+                name_user="user_01",
+                id_channel=id_thread,
+            ),
+        )
+        assert discord[0]["id_user"] == id_admin
+        assert "(1 pending)" in discord[0]["content"]
+
+        (discord, openai) = ic00_edict._update(
+            state_edict,
+            dict(
+                type="btn",
+                id_btn=ic00_edict.PREFIX_SUMMARY + id_session,
+                id_user=id_admin,
+                name_user="admin_01",
+                id_channel=None,
+            ),
+        )
+        assert len(openai) == 1
+        str_prompt = openai[0]["messages"][0]["content"]
+        assert "Plant a community garden." in str_prompt
+        assert "Off topic" not in str_prompt
+        assert discord == [
+            dict(
+                key_stream=id_session,
+                key_thread=id_session,
+                id_channel=id_channel,
+                add_user=[id_user, id_other],
+                type="msg_stream",
+                content="",
+            )
+        ]
+
+        # The summary is posted to the thread.
+        #
+        (discord, _) = ic00_edict._update(
+            state_edict,
+            dict(
+                type="openai_result",
+                request=openai[0],
+                response=dict(choices=[dict(message=dict(content="Build a garden."))]),
+                error=None,
+                state=openai[0]["state"],
+                unix_time=0,
+            ),
+        )
+        assert discord == [
+            dict(
+                key_stream=id_session,
+                key_thread=id_session,
+                id_channel=id_channel,
+                add_user=[id_user, id_other],
+                type="msg_stream",
+                content="Build a garden.",
+                is_final=True,
+            )
+        ]